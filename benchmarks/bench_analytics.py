@@ -0,0 +1,145 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+"""
+Benchmarks the analytics engine (business/analytics.py) on a month of the full report x agency matrix (15 reports x 27
+agencies = 405 endpoints, one cache file per endpoint per day).
+
+For every report it times loading the month into a ReportFrame, then the four aggregates on it (group totals, top-N,
+day-over-day deltas and the cross-agency rollup). They are compared against the throwaway-script way of getting a top
+10: reading every record ("python read") and summing visits per dimension value in a python dict, then sorting ("python
+top-10", timed on records already in memory, against the vectorized top-10 on the loaded frame).
+
+Usage (from the repository root):
+    python benchmarks/bench_analytics.py [--days 30] [--records 50] [--format jsonl]
+"""
+
+VALUES = ["Chrome", "Safari", "Edge", "Firefox", "Samsung Internet", "Opera", "Android Webview", "(not set)",
+          "Windows", "iOS", "Android", "Macintosh", "Linux", "Chrome OS", "desktop", "mobile", "tablet",
+          "www.nps.gov", "www.usgs.gov", "www.fbi.gov", "studentaid.gov", "www.irs.gov", "www.weather.gov"]
+
+
+def build_records(report_name: str, agency_name: str, day: str, count: int, rng, dimension_field: str,
+                  metric_field: str) -> list:
+    """
+    Generates count DAP-like records of one report/agency/day
+    :return: list of dicts
+    """
+    return [{'id': i, 'date': day, 'report_name': report_name, 'report_agency': agency_name,
+             dimension_field: f"{rng.choice(VALUES)}-{rng.randrange(count)}",
+             metric_field: int(rng.paretovariate(1.2) * 10)} for i in range(count)]
+
+
+def populate(dal, db_service, validation, days: list, records: int, format_name: str) -> int:
+    """
+    Writes a cache file and a search_history row for every report x agency x day
+    :return: the number of records written
+    """
+    rng = random.Random(7)
+    written = 0
+    for report_name in validation.REPORTS_LIST:
+        dimension_field = db_service.REPORT_DIMENSIONS[report_name]
+        metric_field = db_service.REPORT_METRICS.get(report_name, 'visits')
+        rows = []
+        for agency_name in validation.AGENCY_LIST:
+            for day in days:
+                file_name = dal.build_file_name(report_name, agency_name, day, format_name, 'none')
+                with dal.get_format(format_name).open_writer(file_name) as writer:
+                    for record in build_records(report_name, agency_name, day, records, rng, dimension_field,
+                                                metric_field):
+                        writer.write(record)
+                        written += 1
+                rows.append((report_name, agency_name, day, file_name))
+        db_service.insert_search_data_many(rows)
+    return written
+
+
+def python_read(dal, db_service, report_name: str, start: str, end: str) -> list:
+    """
+    Reads every record of a report's window, the way a throwaway script would
+    :return: list of records
+    """
+    return [record for agency_name, day, file_name in db_service.find_files_between(report_name, start, end)
+            for record in dal.iter_from_txt(file_name)]
+
+
+def python_top_n(db_service, report_name: str, records: list, n: int = 10) -> list:
+    """
+    The per-record python loop analytics replaces: sum per dimension value, sort
+    :return: the top n (value, total) pairs
+    """
+    dimension_field = db_service.REPORT_DIMENSIONS[report_name]
+    metric_field = db_service.REPORT_METRICS.get(report_name, 'visits')
+    totals = {}
+    for record in records:
+        key = record.get(dimension_field)
+        totals[key] = totals.get(key, 0) + (record.get(metric_field) or 0)
+    return sorted(totals.items(), key=lambda item: -item[1])[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analytics engine on a month of the full matrix")
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--records', type=int, default=50, help="records per report/agency/day")
+    parser.add_argument('--format', default='jsonl', choices=['jsonl', 'txt', 'npz'])
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    work_dir = tempfile.mkdtemp(prefix='bench_analytics_')
+    with open(os.path.join(work_dir, 'config.ini'), 'w') as config_file:
+        config_file.write("[DATABASE]\npath = database/search_log.db\n\n[APIKEY]\nkey = unused\n")
+    os.makedirs(os.path.join(work_dir, 'logs'), exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'database'), exist_ok=True)
+    os.chdir(work_dir)  # config.ini, logs/ and database/ are resolved against the working directory
+    sys.path.insert(0, repo_root)
+    import business
+    import dal
+    import db_service
+    import validation
+
+    first = date(2024, 1, 1)
+    days = [f"{first + timedelta(days=offset)}" for offset in range(args.days)]
+    start = time.perf_counter()
+    written = populate(dal, db_service, validation, days, args.records, args.format)
+    print(f"wrote {written} records in {len(validation.REPORTS_LIST) * len(validation.AGENCY_LIST) * len(days)} "
+          f"{args.format} files in {time.perf_counter() - start:.1f}s ({work_dir})")
+
+    print(f"{'report':<20} {'rows':>8} {'load (ms)':>10} {'totals':>8} {'top-10':>8} {'deltas':>8} {'rollup':>8} "
+          f"{'python read':>12} {'python top-10':>14} {'top-10 speedup':>15}")
+    totals = dict.fromkeys(('load', 'ops', 'read', 'python'), 0.0)
+    for report_name in validation.REPORTS_LIST:
+        timings = []
+        start = time.perf_counter()
+        frame = business.load_frame(report_name, None, days[0], days[-1])
+        timings.append(time.perf_counter() - start)
+        for operation in (lambda: business.group_totals(frame, ('dimension',)), lambda: business.top_n(frame, 10),
+                          lambda: business.daily_deltas(frame, 'dimension', 10), lambda: business.agency_rollup(frame)):
+            start = time.perf_counter()
+            operation()
+            timings.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        records = python_read(dal, db_service, report_name, days[0], days[-1])
+        read_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        expected = python_top_n(db_service, report_name, records)
+        python_seconds = time.perf_counter() - start
+        top = business.top_n(frame, 10)
+        assert [row[frame.metric_field] for row in top] == [total for _, total in expected]
+        totals['load'] += timings[0]
+        totals['ops'] += sum(timings[1:])
+        totals['read'] += read_seconds
+        totals['python'] += python_seconds
+        print(f"{report_name:<20} {len(frame):>8} " + ' '.join(f"{seconds * 1000:>{width}.1f}" for seconds, width in
+                                                                zip(timings, (10, 8, 8, 8, 8))) +
+              f" {read_seconds * 1000:>12.1f} {python_seconds * 1000:>14.1f} {python_seconds / timings[2]:>14.0f}x")
+    print(f"all 405 endpoints: load {totals['load']:.2f}s, four aggregates {totals['ops']:.3f}s, "
+          f"python read {totals['read']:.2f}s, python top-10 {totals['python']:.3f}s (times in ms above)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+"""
+Benchmarks the cache file compression codecs on representative DAP report payloads: write throughput, read throughput
+(both in MB/s of uncompressed JSON Lines) and the size on disk, for each codec and level.
+
+The records mimic a "domain" style report: one row per date/agency/domain with a visit count, the shape most of the
+cache files have. Codecs that aren't available here (zstd without the zstandard package) are skipped.
+
+Usage (from the repository root):
+    python benchmarks/bench_compression.py [--records 100000] [--format jsonl] [--codecs gzip bz2] [--levels 1 6 9]
+"""
+
+AGENCIES = ["interior", "justice", "education", "energy", "treasury", "commerce", "defense", "labor", "state"]
+DOMAINS = ["www.nps.gov", "www.usgs.gov", "www.fbi.gov", "studentaid.gov", "www.energy.gov", "www.irs.gov",
+           "www.census.gov", "www.weather.gov", "www.dol.gov", "travel.state.gov", "www.usa.gov"]
+
+
+def build_records(count: int) -> list:
+    """
+    Generates count DAP-like report records
+    :param count: number of records
+    :return: list of dicts
+    """
+    rng = random.Random(12)
+    records = []
+    for i in range(count):
+        agency = AGENCIES[i % len(AGENCIES)]
+        records.append({'id': 40_000_000 + i, 'date': f"2023-{1 + i // 28_000 % 12:02d}-{1 + i // 1000 % 28:02d}",
+                        'report_name': 'domain', 'report_agency': agency,
+                        'domain': f"{rng.choice(['', 'm.', 'apps.'])}{rng.choice(DOMAINS)}",
+                        'visits': int(rng.paretovariate(1.2) * 10)})
+    return records
+
+
+def time_codec(cache_format, file_name: str, records: list, level) -> tuple:
+    """
+    Writes then reads back records through a codec, timing both
+    :param cache_format: the CacheFormat to write in
+    :param file_name: the file to write (its suffix picks the codec)
+    :param records: records to write
+    :param level: compression level (None for the codec's default)
+    :return: (write seconds, read seconds, bytes on disk)
+    """
+    start = time.perf_counter()
+    with cache_format.open_writer(file_name, level) as writer:
+        for record in records:
+            writer.write(record)
+    written = time.perf_counter() - start
+    start = time.perf_counter()
+    read_count = sum(1 for _ in cache_format.iter_records(file_name))
+    read = time.perf_counter() - start
+    assert read_count == len(records)
+    return written, read, os.path.getsize(file_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cache file compression codecs")
+    parser.add_argument('--records', type=int, default=100_000)
+    parser.add_argument('--format', default='jsonl', choices=['jsonl', 'txt'])
+    parser.add_argument('--codecs', nargs='+', default=None, help="codecs to compare (default: all available)")
+    parser.add_argument('--levels', type=int, nargs='+', default=None, help="levels to try (default: codec default)")
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    work_dir = tempfile.mkdtemp(prefix='bench_compression_')
+    with open(os.path.join(work_dir, 'config.ini'), 'w') as config_file:
+        config_file.write("[DATABASE]\npath = search_log.db\n\n[APIKEY]\nkey = unused\n")
+    os.makedirs(os.path.join(work_dir, 'logs'), exist_ok=True)
+    os.chdir(work_dir)  # config.ini and logs/ are resolved against the working directory
+    sys.path.insert(0, repo_root)
+    import dal
+
+    cache_format = dal.get_format(args.format)
+    records = build_records(args.records)
+    codec_names = args.codecs or list(dal.CODECS)
+
+    baseline = None
+    print(f"{'codec':>6} {'level':>6} {'write MB/s':>11} {'read MB/s':>10} {'disk (KB)':>10} {'ratio':>7}")
+    for codec_name in codec_names:
+        codec = dal.get_codec(codec_name)
+        if not codec.is_available():
+            print(f"{codec_name:>6} {'':>6} skipped, not available")
+            continue
+        levels = [None] if not args.levels or not codec.suffix else args.levels
+        for level in levels:
+            file_name = f"bench{cache_format.extension}{codec.suffix}"
+            written, read, size = time_codec(cache_format, file_name, records, level)
+            os.remove(file_name)
+            if baseline is None:
+                if codec.suffix:
+                    # throughput is measured against the uncompressed size, so write one plain file first
+                    plain_name = f"plain{cache_format.extension}"
+                    baseline = time_codec(cache_format, plain_name, records, None)[2]
+                    os.remove(plain_name)
+                else:
+                    baseline = size
+            megabytes = baseline / 1_000_000
+            print(f"{codec_name:>6} {'default' if level is None else level:>6} {megabytes / written:>11.1f} "
+                  f"{megabytes / read:>10.1f} {size / 1000:>10.0f} {baseline / size:>6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
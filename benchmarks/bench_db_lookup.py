@@ -0,0 +1,123 @@
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+"""
+Benchmarks a single search_history lookup at different table sizes, before and after the one-time schema setup.
+
+"before" replays what search_for_match used to do for every lookup: os.path.exists on the db file, a
+SELECT COUNT(*) table probe and an unindexed SELECT, each on a brand new connection that commits and closes.
+"after" calls the current db_service.search_for_match against a migrated db (unique index, persistent connection).
+
+Usage (from the repository root):
+    python benchmarks/bench_db_lookup.py [--sizes 10000 100000 1000000] [--lookups 200]
+"""
+
+REPORTS = ["download", "traffic-source", "device-model", "domain", "site", "second-level-domain", "language",
+           "os-browser", "windows-browser", "browser", "windows-ie", "os", "windows", "ie", "device"]
+
+
+def build_rows(size: int):
+    """
+    Generates size distinct (report, agency, date, file name) rows
+    :param size: number of rows
+    :return: yields row tuples
+    """
+    for i in range(size):
+        report = REPORTS[i % len(REPORTS)]
+        agency = f"agency-{(i // len(REPORTS)) % 500}"
+        date = f"{2000 + i // (len(REPORTS) * 500 * 365)}-{1 + (i // (len(REPORTS) * 500)) % 365:03d}"
+        yield report, agency, date, f"database/{report}_{agency}_{date}.txt"
+
+
+def create_legacy_db(path: str, size: int):
+    """
+    Creates a search_history table the way the original CREATE_TABLE did (no index) and fills it
+    :param path: db file path
+    :param size: number of rows
+    :return: list of a few keys spread across the table, to look up
+    """
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE search_history (id INTEGER PRIMARY KEY AUTOINCREMENT, report_name TEXT, "
+                       "agency_name TEXT, date TEXT, file_name TEXT)")
+    connection.executemany("INSERT INTO search_history (report_name, agency_name, date, file_name) VALUES (?, ?, ?, ?)",
+                           build_rows(size))
+    connection.commit()
+    keys = connection.execute("SELECT report_name, agency_name, date FROM search_history "
+                              "WHERE id % ? = 0", (max(1, size // 50),)).fetchall()
+    connection.close()
+    return keys
+
+
+def legacy_lookup(path: str, key: tuple):
+    """
+    Replays the original per-lookup work: file check, COUNT(*) probe and unindexed select, one connection each
+    :param path: db file path
+    :param key: (report, agency, date)
+    :return: the file name (or False)
+    """
+    if not os.path.exists(path):
+        return False
+    for query, params in (("SELECT COUNT(*) FROM search_history;", ()),
+                          ("SELECT file_name FROM search_history WHERE report_name = ? AND agency_name = ? "
+                           "AND date = ?", key)):
+        connection = sqlite3.connect(path)
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        connection.commit()
+        result = cursor.fetchall()
+        cursor.close()
+        connection.close()
+    return result[0][0] if result else False
+
+
+def time_lookups(lookup, keys: list, count: int) -> float:
+    """
+    Times count lookups, cycling through keys
+    :param lookup: callable taking a key
+    :param keys: keys to look up
+    :param count: number of lookups
+    :return: mean seconds per lookup
+    """
+    start = time.perf_counter()
+    for i in range(count):
+        assert lookup(keys[i % len(keys)])
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark search_history lookup latency before/after schema init")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    work_dir = tempfile.mkdtemp(prefix='bench_db_lookup_')
+    with open(os.path.join(work_dir, 'config.ini'), 'w') as config_file:
+        config_file.write("[DATABASE]\npath = search_log.db\n\n[APIKEY]\nkey = unused\n")
+    os.makedirs(os.path.join(work_dir, 'logs'), exist_ok=True)
+    os.chdir(work_dir)  # config.ini and logs/ are resolved against the working directory
+    sys.path.insert(0, repo_root)
+    import dal
+    import db_service
+
+    print(f"{'rows':>10} {'before (ms)':>12} {'after (ms)':>12} {'speedup':>9}")
+    for size in args.sizes:
+        dal.close_db_connections()
+        db_service.reset_schema_state()
+        if os.path.exists('search_log.db'):
+            os.remove('search_log.db')
+        keys = create_legacy_db('search_log.db', size)
+        # the legacy path gets a fraction of the lookups at large sizes, it is a full scan per call
+        before = time_lookups(lambda key: legacy_lookup('search_log.db', key), keys,
+                              max(5, args.lookups * 10_000 // size))
+        db_service.init_schema()
+        after = time_lookups(lambda key: db_service.search_for_match(*key), keys, args.lookups)
+        print(f"{size:>10} {before * 1000:>12.3f} {after * 1000:>12.3f} {before / after:>8.0f}x")
+
+
+if __name__ == '__main__':
+    main()
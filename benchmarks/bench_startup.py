@@ -0,0 +1,120 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+"""
+Benchmarks (and guards) the cold start of main.py: the wall time of a whole `python main.py --help` process, run in an
+empty directory (no config.ini, no database), and the time each module it imports takes, as reported by
+python -X importtime.
+
+Cron and batch runs are often all cache hits, so the app must not pay for what only a cache miss or another subcommand
+needs before it gets to work. The benchmark fails (exit code 1) if:
+    - main.py --help exits with an error, or leaves anything (e.g. a database directory) in the empty directory: --help
+      must not read config.ini or open the db,
+    - it imports any of LAZY_MODULES, which should only be imported when first used: config.config (config.ini is
+      parsed when a setting is first read), requests (api_dal, loaded by dal on the first api call), http.server (the
+      serve command), numpy (analytics) and multiprocessing's process pool (rollup rebuilds),
+    - the time it takes on top of the bare interpreter (median of --runs) is over --budget-ratio times the bare
+      interpreter's own start up time. Both scale with the machine, so the budget holds on slow and fast machines
+      alike: main.py --help costs less than one bare interpreter now, importing the whole app up front (as main.py once
+      did) cost two to three.
+
+Usage (from the repository root):
+    python benchmarks/bench_startup.py [--runs 10] [--budget-ratio 2] [--top 15]
+"""
+
+LAZY_MODULES = ('config.config', 'requests', 'urllib3', 'http.server', 'numpy', 'concurrent.futures.process')
+
+
+def parse_importtime(stderr: str) -> list:
+    """
+    Parses the output of python -X importtime
+    :param stderr: the stderr of the process
+    :return: list of (module name, self us, cumulative us, depth) tuples, in import order
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def app_imports(imports: list) -> list:
+    """
+    Returns the imports of the script itself, i.e. those after the interpreter's own start up (site and its imports)
+    :param imports: the parsed import times, see parse_importtime
+    :return: the script's part of imports
+    """
+    site_index = max((i for i, (name, _, _, depth) in enumerate(imports) if name == 'site' and depth == 0), default=-1)
+    return imports[site_index + 1:]
+
+
+def wall_time(command: list, repo_root: str, work_dir: str) -> float:
+    """
+    Runs a command to completion
+    :return: its wall time in seconds
+    """
+    env = dict(os.environ, PYTHONPATH=repo_root)
+    start = time.perf_counter()
+    subprocess.run(command, cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark and guard the start up of python main.py --help")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget-ratio', type=float, default=2.0,
+                        help="max median time of main.py --help on top of the bare interpreter, in bare interpreters")
+    parser.add_argument('--top', type=int, default=15, help="number of slowest imports to list")
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    work_dir = tempfile.mkdtemp(prefix='bench_startup_')  # empty: no config.ini, no database
+    help_command = [sys.executable, os.path.join(repo_root, 'main.py'), '--help']
+
+    failures = []
+    env = dict(os.environ, PYTHONPATH=repo_root)
+    # also the warm up: writes the .pyc files, so every timed run is a cached cold start
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + help_command[1:], cwd=work_dir, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        last_line = (result.stderr.strip().splitlines() or [''])[-1]
+        failures.append(f"main.py --help exited with {result.returncode} without a config.ini: {last_line}")
+    if os.listdir(work_dir):
+        failures.append(f"main.py --help created {', '.join(sorted(os.listdir(work_dir)))}")
+    imports = app_imports(parse_importtime(result.stderr))
+    imported = {name for name, _, _, _ in imports}
+    for module in LAZY_MODULES:
+        if module in imported:
+            failures.append(f"main.py --help imported {module}, which should only be imported when first used")
+
+    if not failures:
+        interpreter = statistics.median(wall_time([sys.executable, '-c', 'pass'], repo_root, work_dir)
+                                        for _ in range(args.runs))
+        help_run = statistics.median(wall_time(help_command, repo_root, work_dir) for _ in range(args.runs))
+        overhead = help_run - interpreter
+        ratio = overhead / interpreter
+        print(f"python main.py --help: {help_run * 1000:.1f} ms wall, {overhead * 1000:.1f} ms on top of "
+              f"the bare interpreter's {interpreter * 1000:.1f} ms, i.e. {ratio:.2f} bare interpreters (median of "
+              f"{args.runs} runs, budget {args.budget_ratio:.1f})")
+        if ratio > args.budget_ratio:
+            failures.append(f"main.py --help took {ratio:.2f} bare interpreters, over the {args.budget_ratio:.1f} "
+                            f"budget")
+
+    print(f"\n{'module':<40} {'self (ms)':>10} {'cumulative (ms)':>16}")
+    for name, self_us, cumulative_us, depth in sorted(imports, key=lambda item: -item[1])[:args.top]:
+        print(f"{name:<40} {self_us / 1000:>10.1f} {cumulative_us / 1000:>16.1f}")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1 +1,9 @@
 from .business_layer import *
+from .single_flight import SingleFlight
+from .memory_cache import get_cache_stats, clear_cache, read_records
+from .batch_fetch import build_jobs, expand_job, fetch_job, fetch_many, STATUS_CACHED, STATUS_FETCHED, \
+    STATUS_ERROR
+from .refresh import find_stale_keys, refresh_one, refresh_stale, STATUS_REFRESHED, STATUS_NOT_MODIFIED
+from .prefetch import find_missing_keys, plan_prefetch, run_prefetch, load_state, STATUS_DEFERRED
+from .rollups import compute_rollup, update_rollups, rebuild_rollups, rollup_totals, rollup_top
+from .analytics import ReportFrame, load_frame, group_totals, top_n, daily_deltas, agency_rollup, AXES
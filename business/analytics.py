@@ -0,0 +1,303 @@
+import dal
+import db_service
+from exceptions import DalException, BusinessLogicException
+from logging_config import get_logger
+
+"""
+This module contains the analytics engine over cached reports. A report's cached keys (any agencies, any date window)
+are loaded into a ReportFrame: one numpy array per column (day, agency, main dimension and metric, the categorical
+columns dictionary encoded as integer codes). Every aggregate is then computed on whole arrays (bincount over combined
+codes, argpartition, diff along the day axis), with no per-row python loops; only loading parses records, and npz cache
+files are loaded straight from their typed columns.
+
+numpy is only needed for this module (like the 'npz' cache format), and is imported when a frame is first loaded.
+
+Methods:
+--------
+    import_numpy():
+        Imports numpy, raising a BusinessLogicException if it isn't installed
+    load_frame(report_name: str, agency_names: list = None, start_date: str = None, end_date: str = None)
+            -> ReportFrame:
+        Loads the cached keys of a report within a date window into a ReportFrame
+    group_totals(frame: ReportFrame, by=('dimension',)) -> list:
+        Sums the metric per group of one or more axes, largest first
+    top_n(frame: ReportFrame, n: int = 10, by: str = 'dimension') -> list:
+        Returns the n groups of an axis with the largest totals
+    daily_deltas(frame: ReportFrame, by: str = 'dimension', top: int = None) -> list:
+        Returns each group's daily totals with their change from the day before
+    agency_rollup(frame: ReportFrame, top: int = None) -> list:
+        Rolls each dimension value up across agencies: total, share, number of agencies and the top agency
+
+Classes:
+--------
+    ReportFrame:
+        Columnar, dictionary encoded view of a report's records over agencies and dates
+
+Constants:
+----------
+    AXES: the axes a frame can be grouped by
+"""
+
+logger = get_logger(__name__)
+
+AXES = ('dimension', 'agency', 'date')
+
+
+def import_numpy():
+    """
+    Imports numpy, which is only needed for analytics
+    :return: the numpy module
+    """
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        raise BusinessLogicException("Analytics require numpy (pip install numpy)")
+
+
+class ReportFrame:
+    def __init__(self, report_name: str, dimension_field: str, metric_field: str, codes: dict, labels: dict, values,
+                 skipped: list = None):
+        """
+        :param report_name: the report the records belong to
+        :param dimension_field: the record field the dimension axis holds (e.g. 'browser')
+        :param metric_field: the record field values holds (e.g. 'visits')
+        :param codes: dict of axis -> int array, each row's code on that axis
+        :param labels: dict of axis -> array of the labels the codes index
+        :param values: int64 array of each row's metric
+        :param skipped: file names that could not be read
+        """
+        self.report_name = report_name
+        self.dimension_field = dimension_field
+        self.metric_field = metric_field
+        self.codes = codes
+        self.labels = labels
+        self.values = values
+        self.skipped = skipped or []
+
+    def __len__(self):
+        return len(self.values)
+
+    def label_name(self, axis: str) -> str:
+        """
+        Returns the key an axis' labels are given under in results
+        :param axis: one of AXES
+        :return: the dimension field for 'dimension', 'agency_name' for 'agency', 'date' for 'date'
+        """
+        return {'dimension': self.dimension_field, 'agency': 'agency_name', 'date': 'date'}[axis]
+
+    def group_codes(self, by: tuple) -> tuple:
+        """
+        Combines the codes of one or more axes into a single group code per row
+        :param by: axes to group by
+        :return: (int array of group codes, shape of the group space)
+        """
+        np = import_numpy()
+        for axis in by:
+            if axis not in AXES:
+                raise BusinessLogicException(f"Can't group by {axis}, expected one of {list(AXES)}")
+        shape = tuple(len(self.labels[axis]) for axis in by)
+        if not len(self):
+            return np.zeros(0, dtype=np.int64), shape
+        return np.ravel_multi_index(tuple(self.codes[axis] for axis in by), shape), shape
+
+    def sums(self, by: tuple):
+        """
+        Sums the metric over every group of the given axes
+        :param by: axes to group by
+        :return: int64 array of totals, shaped like the group space (zeros for groups without rows)
+        """
+        np = import_numpy()
+        group, shape = self.group_codes(by)
+        size = int(np.prod(shape)) if shape else 1
+        return np.bincount(group, weights=self.values, minlength=size).astype(np.int64).reshape(shape)
+
+
+def _as_strings(np, values):
+    """
+    Converts a column to a numpy string array, missing values becoming ''
+    :param np: the numpy module
+    :param values: list or array of values
+    :return: the string array
+    """
+    if isinstance(values, np.ndarray) and values.dtype.kind == 'U':
+        return values
+    values = np.asarray(values, dtype=object)
+    values[np.equal(values, None)] = ''
+    return values.astype(str)
+
+
+def _as_counts(np, values):
+    """
+    Converts a column to an int64 array, missing values becoming 0
+    :param np: the numpy module
+    :param values: list or array of values
+    :return: the int64 array
+    """
+    if isinstance(values, np.ndarray) and values.dtype.kind in 'iu':
+        return values.astype(np.int64, copy=False)
+    return np.nan_to_num(np.asarray(values, dtype=np.float64)).astype(np.int64)  # None -> nan -> 0
+
+
+def _encode(np, values):
+    """
+    Dictionary encodes a column
+    :param np: the numpy module
+    :param values: list or array of values
+    :return: (int array of codes, array of labels)
+    """
+    labels, codes = np.unique(_as_strings(np, values), return_inverse=True)
+    return codes.astype(np.int64), labels
+
+
+def load_frame(report_name: str, agency_names: list = None, start_date: str = None, end_date: str = None) \
+        -> ReportFrame:
+    """
+    Loads the cached keys of a report within a date window into a ReportFrame. Only keys already in the cache are
+        loaded (fetch the window first to fill gaps); files that can't be read are skipped and listed in frame.skipped.
+    :param report_name: report name
+    :param agency_names: (optional) only these agencies, all cached agencies if None
+    :param start_date: (optional) YYYY-MM-DD, first date of the window
+    :param end_date: (optional) YYYY-MM-DD, last date of the window (inclusive), defaults to start_date if that is set
+    :return: the ReportFrame
+    """
+    np = import_numpy()
+    dimension_field = db_service.REPORT_DIMENSIONS.get(report_name)
+    metric_field = db_service.REPORT_METRICS.get(report_name, 'visits')
+    if dimension_field is None:
+        raise BusinessLogicException(f"{report_name} is not a valid report name")
+    try:
+        rows = db_service.find_files_between(report_name, start_date or '0000-00-00',
+                                             end_date or start_date or '9999-99-99')
+    except DalException:
+        logger.error("Ran into exception (already logged)")
+        raise BusinessLogicException
+    if agency_names:
+        rows = [row for row in rows if row[0] in agency_names]
+
+    dimensions, metrics, counts, file_agencies, file_dates, skipped = [], [], [], [], [], []
+    for agency_name, date, file_name in rows:
+        try:
+            columns = dal.read_fields(file_name, [dimension_field, metric_field])
+        except DalException:
+            logger.warning("Skipping %s, it could not be read", file_name)
+            skipped.append(file_name)
+            continue
+        dimensions.append(_as_strings(np, columns[dimension_field]))
+        metrics.append(_as_counts(np, columns[metric_field]))
+        counts.append(len(metrics[-1]))
+        file_agencies.append(agency_name)
+        file_dates.append(date)
+
+    counts = np.asarray(counts, dtype=np.int64)
+    agency_codes, agency_labels = _encode(np, file_agencies)
+    date_codes, date_labels = _encode(np, file_dates)
+    dimension_codes, dimension_labels = _encode(np, np.concatenate(dimensions) if dimensions else [])
+    values = np.concatenate(metrics) if metrics else np.zeros(0, dtype=np.int64)
+    codes = {'dimension': dimension_codes, 'agency': np.repeat(agency_codes, counts),
+             'date': np.repeat(date_codes, counts)}
+    labels = {'dimension': dimension_labels, 'agency': agency_labels, 'date': date_labels}
+    logger.info("Loaded %s %s rows from %s files (%s skipped)", len(values), report_name, len(counts), len(skipped))
+    return ReportFrame(report_name, dimension_field, metric_field, codes, labels, values, skipped)
+
+
+def group_totals(frame: ReportFrame, by=('dimension',)) -> list:
+    """
+    Sums the metric per group of one or more axes, e.g. visits per browser, or per agency and date
+    :param frame: the ReportFrame
+    :param by: axis name or tuple of axes (see AXES)
+    :return: list of dicts of each axis' label plus the total (groups without rows are left out), largest first
+    """
+    np = import_numpy()
+    by = (by,) if isinstance(by, str) else tuple(by)
+    sums = frame.sums(by)
+    present = np.bincount(frame.group_codes(by)[0], minlength=sums.size).reshape(sums.shape) > 0
+    indexes = np.nonzero(present)
+    totals = sums[indexes]
+    order = np.argsort(-totals, kind='stable')
+    columns = {frame.label_name(axis): frame.labels[axis][index[order]].tolist() for axis, index in zip(by, indexes)}
+    columns[frame.metric_field] = totals[order].tolist()
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+
+def top_n(frame: ReportFrame, n: int = 10, by: str = 'dimension') -> list:
+    """
+    Returns the n groups of an axis with the largest totals, e.g. the top 10 domains across every agency
+    :param frame: the ReportFrame
+    :param n: number of groups
+    :param by: the axis (see AXES)
+    :return: list of dicts of the axis' label, the total and its share of the grand total, largest first
+    """
+    np = import_numpy()
+    sums = frame.sums((by,))
+    n = min(n, len(sums))
+    if n <= 0:
+        return []
+    top = np.argpartition(-sums, n - 1)[:n]
+    top = top[np.argsort(-sums[top], kind='stable')]
+    grand_total = sums.sum()
+    shares = sums[top] / grand_total if grand_total else np.zeros(n)
+    return [{frame.label_name(by): label, frame.metric_field: total, 'share': round(share, 6)}
+            for label, total, share in zip(frame.labels[by][top].tolist(), sums[top].tolist(), shares.tolist())]
+
+
+def daily_deltas(frame: ReportFrame, by: str = 'dimension', top: int = None) -> list:
+    """
+    Returns each group's daily totals with their change from the previous day of the frame (a group missing on a day
+        counts as 0 that day)
+    :param frame: the ReportFrame
+    :param by: the axis to group by ('dimension' or 'agency')
+    :param top: (optional) only the top groups by total over the whole window
+    :return: list of dicts of the group label, date, total, 'delta' and 'pct_change' (None on the first day, or when
+        the previous day was 0), grouped by label then in date order
+    """
+    np = import_numpy()
+    if by == 'date':
+        raise BusinessLogicException("Daily deltas are grouped by 'dimension' or 'agency', not 'date'")
+    matrix = frame.sums((by, 'date'))
+    groups = np.arange(matrix.shape[0])
+    if top is not None:
+        groups = groups[np.argsort(-matrix.sum(axis=1), kind='stable')[:top]]
+    matrix = matrix[groups]
+    deltas = np.zeros_like(matrix)
+    deltas[:, 1:] = np.diff(matrix, axis=1)
+    previous = np.zeros_like(matrix)
+    previous[:, 1:] = matrix[:, :-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = np.where(previous > 0, deltas / np.where(previous > 0, previous, 1), np.nan)
+    pct[:, 0] = np.nan
+    label_name = frame.label_name(by)
+    labels = np.repeat(frame.labels[by][groups], matrix.shape[1]).tolist()
+    dates = np.tile(frame.labels['date'], len(groups)).tolist()
+    first_day = np.tile(np.arange(matrix.shape[1]) == 0, len(groups)).tolist()
+    return [{label_name: label, 'date': date, frame.metric_field: total, 'delta': None if first else delta,
+             'pct_change': None if change != change else change}
+            for label, date, total, delta, change, first in
+            zip(labels, dates, matrix.ravel().tolist(), deltas.ravel().tolist(), np.round(pct, 6).ravel().tolist(),
+                first_day)]
+
+
+def agency_rollup(frame: ReportFrame, top: int = None) -> list:
+    """
+    Rolls each dimension value up across agencies: its total, its share of the grand total, how many agencies report it
+        and which agency contributes the most
+    :param frame: the ReportFrame
+    :param top: (optional) only the top dimension values by total
+    :return: list of dicts, largest total first
+    """
+    np = import_numpy()
+    matrix = frame.sums(('dimension', 'agency'))
+    if not matrix.size:
+        return []
+    totals = matrix.sum(axis=1)
+    order = np.argsort(-totals, kind='stable')[:top]
+    grand_total = totals.sum()
+    shares = totals[order] / grand_total if grand_total else np.zeros(len(order))
+    agencies = (matrix[order] > 0).sum(axis=1)
+    top_agencies = frame.labels['agency'][matrix[order].argmax(axis=1)]
+    top_values = matrix[order].max(axis=1)
+    return [{frame.dimension_field: label, frame.metric_field: total, 'share': round(share, 6), 'agencies': count,
+             'top_agency': agency, 'top_agency_' + frame.metric_field: top_value}
+            for label, total, share, count, agency, top_value in
+            zip(frame.labels['dimension'][order].tolist(), totals[order].tolist(), shares.tolist(), agencies.tolist(),
+                top_agencies.tolist(), top_values.tolist())]
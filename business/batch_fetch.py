@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import config
+import dal
+import db_service
+import validation
+from exceptions import DalException, BusinessLogicException
+from logging_config import get_logger
+from .business_layer import NewData, bundle_to_dict, group_date_runs
+
+"""
+This module contains methods to fetch many report/agency/date combinations at once, without going through the
+interactive presentation layer. Every job goes through the same search_history lookup and NewData persistence as an
+interactive search, so the cache stays consistent. The missing dates of a job are fetched with one request per run of
+consecutive days, rather than one request per date.
+
+Methods:
+--------
+    build_jobs(report_names: list, agency_names: list, start_date: str, end_date: str = None) -> list:
+        Builds one (report, agency, start_date, end_date) job for every report x agency combination
+    expand_job(job) -> list:
+        Turns a single job into one bundle per date in its date range
+    fetch_job(bundles: list) -> list:
+        Returns the cached files for the bundles of one job, fetching every missing run of dates with a single request
+    fetch_many(jobs, max_workers: int = None):
+        Runs a list of jobs concurrently (merged per report & agency), yielding result dicts as each job finishes
+
+Constants:
+----------
+    STATUS_CACHED: result status for a bundle that was already in search_history
+    STATUS_FETCHED: result status for a bundle that was fetched from the API and saved
+    STATUS_ERROR: result status for a bundle that failed (see result['error'])
+"""
+
+logger = get_logger(__name__)
+
+STATUS_CACHED = 'cached'
+STATUS_FETCHED = 'fetched'
+STATUS_ERROR = 'error'
+
+
+def build_jobs(report_names: list, agency_names: list, start_date: str, end_date: str = None) -> list:
+    """
+    Builds one (report, agency, start_date, end_date) job for every report x agency combination
+    :param report_names: report names to fetch (e.g. validation.REPORTS_LIST)
+    :param agency_names: agency names to fetch (e.g. validation.AGENCY_LIST)
+    :param start_date: first date to fetch, YYYY-MM-DD
+    :param end_date: (optional) last date to fetch, YYYY-MM-DD, defaults to start_date
+    :return: list of job tuples
+    """
+    return [(report_name, agency_name, start_date, end_date or start_date)
+            for report_name in report_names
+            for agency_name in agency_names]
+
+
+def expand_job(job) -> list:
+    """
+    Turns a single job into one bundle per date in its date range
+    :param job: a (report_name, agency_name, date) or (report_name, agency_name, start_date, end_date) tuple
+    :return: list of bundles (see business_layer.bundle_to_dict)
+    """
+    report_name, agency_name, start_date, *rest = job
+    end_date = rest[0] if rest and rest[0] else start_date
+    if report_name not in validation.REPORTS_LIST:
+        raise BusinessLogicException(f"{report_name} is not a valid report name")
+    if agency_name not in validation.AGENCY_LIST:
+        raise BusinessLogicException(f"{agency_name} is not a valid agency name")
+    try:
+        day = datetime.strptime(start_date, '%Y-%m-%d').date()
+        last_day = datetime.strptime(end_date, '%Y-%m-%d').date()
+    except ValueError:
+        raise BusinessLogicException(f"Invalid date range {start_date} - {end_date}")
+    bundles = []
+    while day <= last_day:
+        bundles.append(bundle_to_dict(report_name, agency_name, f"{day}", False))
+        day += timedelta(days=1)
+    return bundles
+
+
+def fetch_job(bundles: list) -> list:
+    """
+    Returns the cached files for the bundles of one job (same report & agency), fetching every missing run of
+        consecutive dates with a single request that is split back out per date.
+    :param bundles: bundles of a single job (see expand_job)
+    :return: list of result dicts: the bundles, with 'file_name', 'status' and 'error' filled in
+    """
+    results = {}
+    missing = {}
+    for bundle in bundles:
+        result = dict(bundle, status=STATUS_ERROR, error=None)
+        results[bundle['date']] = result
+        try:
+            file_name = db_service.search_for_match(bundle['report_name'], bundle['agency_name'], bundle['date'])
+            if file_name and dal.check_if_file_exists(file_name):
+                result.update(file_name=file_name, status=STATUS_CACHED)
+            else:
+                missing[bundle['date']] = bundle
+        except DalException as e:
+            result['error'] = f"{e}" or type(e).__name__
+    for dates in group_date_runs(missing):
+        report_name, agency_name = bundles[0]['report_name'], bundles[0]['agency_name']
+        try:
+            file_names = NewData().fetch_and_store_dates(report_name, agency_name, dates)
+            for date, file_name in file_names.items():
+                results[date].update(file_name=file_name, status=STATUS_FETCHED)
+        except (DalException, BusinessLogicException) as e:
+            logger.error("Batch fetch failed for %s/%s/%s..%s", report_name, agency_name, dates[0], dates[-1])
+            for date in dates:
+                results[date]['error'] = f"{e}" or type(e).__name__
+        except Exception as e:
+            logger.error("Unexpected error in batch fetch for %s/%s/%s: %s", report_name, agency_name, dates, e)
+            for date in dates:
+                results[date]['error'] = f"{e}"
+    return list(results.values())
+
+
+def fetch_many(jobs, max_workers: int = None):
+    """
+    Runs a list of jobs concurrently, yielding the result dict of each bundle as soon as its job finishes. At most
+        max_workers jobs are in flight at once, and a failing job never stops the rest of the batch.
+    :param jobs: iterable of (report_name, agency_name, start_date[, end_date]) tuples
+    :param max_workers: max number of jobs fetched at the same time (defaults to BATCH_MAX_WORKERS)
+    :return: yields result dicts (see fetch_job)
+    """
+    if max_workers is None:
+        max_workers = config.BATCH_MAX_WORKERS
+    # jobs for the same report & agency are merged, so their dates can share requests
+    merged_jobs = {}
+    for job in jobs:
+        try:
+            for bundle in expand_job(job):
+                key = (bundle['report_name'], bundle['agency_name'])
+                merged_jobs.setdefault(key, {})[bundle['date']] = bundle
+        except (BusinessLogicException, ValueError) as e:
+            logger.error("Skipping invalid batch job %s: %s", job, e)
+            yield {'job': job, 'status': STATUS_ERROR, 'error': f"{e}"}
+    logger.info("Starting batch fetch of %s report/agency jobs with %s workers", len(merged_jobs), max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_job, list(bundles.values())) for bundles in merged_jobs.values()]
+        for future in as_completed(futures):
+            yield from future.result()
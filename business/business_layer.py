@@ -1,32 +1,56 @@
 from abc import ABC, abstractmethod
 import dal
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import config
 import db_service
-import presentation_layer
+from . import memory_cache
+from .derived_data import update_derived
+from .rollups import update_rollups
+from .single_flight import SingleFlight
 from exceptions import DalException, BusinessLogicException
 from logging_config import get_logger
 
 """
 This module contains classes and methods to act as an intermediary between the data access layer and the 
-presentation layer. 
+presentation layer. It doesn't import the presentation layer: the interactive session registers a Presenter (see
+set_presenter), which check_current_files shows its results through.
 
 Methods:
 --------
+    set_presenter(presenter: Presenter):
+        Sets the Presenter that check_current_files shows its results through
+    get_presenter() -> Presenter:
+        Returns the Presenter set with set_presenter
     check_current_files(report_name: str, agency_name: str, date: str):
         Searches for a report in the search_log.db
+    prepare_database():
+        Readies the search db for a command that uses it (schema, and a cache check after a crash)
+    find_cached_file(report_name: str, agency_name: str, date: str):
+        Returns the cache file of a key if it has one (and it is still on disk), without any presentation
+    lookup(report_name: str, agency_name: str, date: str) -> tuple:
+        Returns the cache file of a key, fetching it first if needed, without any presentation
     evaluate_file_name(bundle: dict):
         Creates either a NewDataFactory or a ExistingDataFactory class, based on weather there is a file name in 
         bundle['file_name'], or if it is set to false.
     bundle_to_dict(report_name: str, agency_name: str, date: str, file_name) -> dict:
         Creates a dict with report_name, agency_name, date and file_name inside
-    build_date_params(date: str) -> dict:
-        Builds date params for the API query, using today as the 'before' param and the date the user is searching for as 
-        the 'after'
+    build_date_params(start_date: str, end_date: str = None) -> dict:
+        Builds date params for the API query, so the API returns exactly the [start_date, end_date] window
+    group_date_runs(dates) -> list:
+        Splits a collection of dates into runs of consecutive days, each of which can be fetched with one request
+    is_complete(date: str, fetched_at: datetime) -> bool:
+        Checks if the api had all of a date's data by the time it was fetched
+    read_stored_records(bundle: dict):
+        Returns the records of a key from the row store, or None if the row store can't answer for it
+    query_rows(report_name: str, agency_names: list = None, start_date: str = None, end_date: str = None, **filters):
+        Returns the row store records of a report across agencies and dates, filtered and projected in sql
     use_factory(factory, bundle: dict):
         Calls the get_data method for the given factory type (either NewData or ExistingData) 
     
 Classes:
 --------
+    Presenter(ABC):
+        Abstract class representing how check_current_files shows its results (e.g. the command line)
     DataFactory(ABC):
         Abstract class representing a data factory
     NewDataFactory(DataFactory):
@@ -39,29 +63,121 @@ Classes:
         Class to hold methods that execute when the user is searching for data that is not already in our database
     ExistingData(Data):
         Class that holds methods that execute when the user is searching for data that is already in our database
+
+Constants:
+----------
+    FETCHES: the SingleFlight that coalesces concurrent fetches of the same key within this process
             
 """
 
 logger = get_logger(__name__)
 
+FETCHES = SingleFlight()
+
+_presenter = None
+
+
+class Presenter(ABC):
+    @abstractmethod
+    def on_new_data(self, file_name=None, data_list=None):
+        pass
+
+    @abstractmethod
+    def on_old_data(self, file_name, data_list):
+        pass
+
+    @abstractmethod
+    def on_error(self, error_message=None):
+        pass
+
+
+def set_presenter(presenter: Presenter):
+    """
+    Sets the Presenter that check_current_files shows its results through
+    :param presenter: the presenter
+    :return: n/a
+    """
+    global _presenter
+    _presenter = presenter
+
+
+def get_presenter() -> Presenter:
+    """
+    Returns the Presenter set with set_presenter
+    :return: the presenter
+    """
+    if _presenter is None:
+        raise BusinessLogicException("No presenter has been set, see set_presenter")
+    return _presenter
+
 
 def check_current_files(report_name: str, agency_name: str, date: str):
     """
-    Searches for a report in the search_log.db
+    Searches for a report in the in-process cache, then the search_log.db
     :param report_name: report name to search for
     :param agency_name: agency name to search for
     :param date: date to search for
     :return: returns False if no match, returns file name of previous search if match is found.
     """
+    file_name = find_cached_file(report_name, agency_name, date)
+    bundle = bundle_to_dict(report_name, agency_name, date, file_name)
+    return evaluate_file_name(bundle)
+
+
+def prepare_database():
+    """
+    Readies the search db for a command that uses it: creates / migrates its schema, and checks the cache if an earlier
+        process didn't exit cleanly (see db_service.fsck_after_crash). Commands call it once their arguments are parsed,
+        so --help and usage errors never read config.ini or open the db.
+    :return: n/a
+    """
+    try:
+        db_service.init_schema()
+        db_service.fsck_after_crash()
+    except DalException:
+        logger.error("Ran into exception (already logged)")
+        raise BusinessLogicException
+
+
+def find_cached_file(report_name: str, agency_name: str, date: str):
+    """
+    Returns the cache file of a key if it has one, from the in-process cache or the search_log.db, without any
+        presentation. A row whose file has gone missing counts as no file, so the key gets fetched again.
+    :param report_name: report name to search for
+    :param agency_name: agency name to search for
+    :param date: date to search for
+    :return: the file name, or False if the key has to be fetched
+    """
     try:
-        file_name = db_service.search_for_match(report_name, agency_name, date)
-        bundle = bundle_to_dict(report_name, agency_name, date, file_name)
-        return evaluate_file_name(bundle)
+        file_name = memory_cache.lookup_file_name(report_name, agency_name, date)
+        if file_name and not memory_cache.has_records(file_name) and not dal.check_if_file_exists(file_name):
+            # the file was lost since the row was recorded, fetch it again (the row is re-pointed on write)
+            logger.warning("%s is recorded in search_history but missing, fetching it again", file_name)
+            memory_cache.forget_file_name(report_name, agency_name, date)
+            file_name = False
+        return file_name
     except DalException:
         logger.error("Encountered error, raising exception...")
         raise BusinessLogicException
 
 
+def lookup(report_name: str, agency_name: str, date: str) -> tuple:
+    """
+    Returns the cache file of a key, fetching and saving it first if it has never been fetched, without any
+        presentation (for callers like the http service). Concurrent lookups missing on the same key share a single
+        fetch (see NewData.fetch_and_store).
+    :param report_name: report name to look up
+    :param agency_name: agency name to look up
+    :param date: date to look up
+    :return: tuple of (file name, true if it had to be fetched)
+    """
+    file_name = find_cached_file(report_name, agency_name, date)
+    if file_name:
+        return file_name, False
+    bundle = bundle_to_dict(report_name, agency_name, date, False)
+    return NewData().fetch_and_store(bundle), True
+
+
 def evaluate_file_name(bundle: dict):
     """
     Creates either a NewDataFactory or a ExistingDataFactory class, based on weather there is a file name in
@@ -70,7 +186,7 @@ def evaluate_file_name(bundle: dict):
     :return: calls use_factory
     """
     if not bundle['file_name']:  # no file exists
-        presentation_layer.on_new_data()
+        get_presenter().on_new_data()
         new_data = NewDataFactory()
         return use_factory(new_data, bundle)
     else:  # data has already been retrieved from api
@@ -93,18 +209,87 @@ def bundle_to_dict(report_name: str, agency_name: str, date: str, file_name) ->
             'file_name': file_name}
 
 
-def build_date_params(date: str) -> dict:
+def build_date_params(start_date: str, end_date: str = None) -> dict:
     """
-    Builds date params for the API query, using today as the 'before' param and the date the user is searching for as
-        the 'after'
-    :param date: the date the user is searching for
+    Builds date params for the API query, so the API returns exactly the [start_date, end_date] window (both 'after'
+        and 'before' are inclusive) instead of everything from start_date up to today.
+    :param start_date: the first date the user is searching for
+    :param end_date: (optional) the last date the user is searching for, defaults to start_date
     :return: the params dict
     """
-    today = datetime.today().date()
-    params = {'before': f"{today}", 'after': f"{date}"}
+    params = {'after': f"{start_date}", 'before': f"{end_date or start_date}"}
     return params
 
 
+def group_date_runs(dates) -> list:
+    """
+    Splits a collection of dates into runs of consecutive days, each of which can be fetched with one request without
+        downloading days nobody asked for.
+    :param dates: iterable of YYYY-MM-DD strings
+    :return: list of sorted lists of YYYY-MM-DD strings
+    """
+    runs = []
+    previous = None
+    for day in sorted({datetime.strptime(date, '%Y-%m-%d').date() for date in dates}):
+        if previous is None or day - previous > timedelta(days=1):
+            runs.append([])
+        runs[-1].append(f"{day}")
+        previous = day
+    return runs
+
+
+def is_complete(date: str, fetched_at: datetime) -> bool:
+    """
+    Checks if the api had all of a date's data by the time it was fetched, i.e. it was fetched at least
+        FRESHNESS_SETTLE_DAYS days after the date (earlier fetches may be partial, and are refreshed later)
+    :param date: YYYY-MM-DD string
+    :param fetched_at: when the date was fetched
+    :return: true if complete
+    """
+    return (fetched_at.date() - datetime.strptime(date, '%Y-%m-%d').date()).days >= config.FRESHNESS_SETTLE_DAYS
+
+
+def read_stored_records(bundle: dict):
+    """
+    Returns the records of a key from the row store (see db_service.row_store), with the bundle's optional 'offset',
+        'limit', 'dimension' (only records with this main dimension value) and 'fields' (only these fields of each
+        record) applied in sql.
+    :param bundle: dict of search parameters
+    :return: an iterable of records, or None if the row store is disabled or doesn't have the key (read its file
+        instead)
+    """
+    if not config.ROW_STORE_ENABLED:
+        return None
+    try:
+        if db_service.stored_row_count(bundle['report_name'], bundle['agency_name'], bundle['date']) is None:
+            return None
+    except DalException:
+        logger.warning("Row store unavailable, reading the cache file instead")
+        return None
+    return db_service.query_rows(bundle['report_name'], [bundle['agency_name']], bundle['date'], bundle['date'],
+                                 dimension=bundle.get('dimension'), fields=bundle.get('fields'),
+                                 offset=bundle.get('offset', 0), limit=bundle.get('limit'))
+
+
+def query_rows(report_name: str, agency_names: list = None, start_date: str = None, end_date: str = None, **filters):
+    """
+    Returns the row store records of a report across agencies and dates, e.g. every agency's os report for a week, with
+        the filtering, projection and ordering done in sql. Only keys fetched while the row store was enabled (or
+        backfilled with db_service.backfill_row_store) are included.
+    :param report_name: report name
+    :param agency_names: (optional) only these agencies
+    :param start_date: (optional) YYYY-MM-DD, only records on or after this date
+    :param end_date: (optional) YYYY-MM-DD, only records on or before this date
+    :param filters: dimension, min_visits, fields, order_by_visits, offset & limit (see db_service.query_rows)
+    :return: list of records
+    """
+    try:
+        return list(db_service.query_rows(report_name, agency_names, start_date, end_date, **filters))
+    except DalException:
+        logger.error("Ran into exception (already logged)")
+        raise BusinessLogicException
+
+
 def use_factory(factory, bundle: dict):
     """
     Calls the get_data method for the given factory type (either NewData or ExistingData)
@@ -150,77 +335,210 @@ class Data(ABC):
 class NewData(Data):
     def get_data(self, bundle: dict):
         """
-        Retrieves API response from the dal, calls log_data_to_db, passes response to parse_response
+        Retrieves and saves the API response via fetch_and_store, then passes the new file to return_response
         :param bundle: dict of search parameters from the command line
-        :return: calls self.parse_response
+        :return: calls self.return_response
+        """
+        file_name = self.fetch_and_store(bundle)
+        return self.return_response(file_name, bundle['date'])
+
+    def fetch_and_store(self, bundle: dict) -> str:
+        """
+        Streams the API response from the dal page by page, writes the parsed response to its txt file and then logs the
+            search to the db, without touching the presentation layer (used by get_data and by batch fetches).
+            Concurrent calls for the same key in this process share one fetch, and every caller gets its file name.
+        :param bundle: dict of search parameters
+        :return: the name of the file the data was saved to
+        """
+        key = (bundle['report_name'], bundle['agency_name'], bundle['date'])
+        file_names = FETCHES.do(key, self.fetch_and_store_dates, *key[:2], [key[2]])
+        return file_names[bundle['date']]
+
+    def fetch_and_store_dates(self, report_name: str, agency_name: str, dates) -> dict:
+        """
+        Fetches several dates of the same report/agency with a single API request covering [first date, last date], then
+            splits the records back out into one txt file (and one search_history row) per date in a single pass. The
+            rows are only recorded once every file is safely on disk, so search_history never points at a file that
+            wasn't written.
+            The fetch-and-persist holds the report/agency's lock file (see dal.report_lock), so another process (or
+            thread) missing on the same dates waits, then finds them cached instead of fetching them again: dates that
+            are cached by the time the lock is held are not re-fetched.
+        :param report_name: report name to fetch
+        :param agency_name: agency name to fetch
+        :param dates: YYYY-MM-DD strings to fetch (ideally consecutive, see group_date_runs)
+        :return: dict of date -> the name of the file that date was saved to
         """
         try:
-            params = build_date_params(bundle['date'])
-            response = dal.make_request(bundle['report_name'], bundle['agency_name'], params=params)
-            self.log_data_to_db(bundle)
-            return self.parse_response(bundle, response.json())
+            dates = sorted(set(dates))
+            with dal.report_lock(report_name, agency_name):
+                file_names = {}
+                for date in dates:
+                    file_name = find_cached_file(report_name, agency_name, date)
+                    if file_name:
+                        logger.info("%s/%s/%s was saved while waiting for its lock", report_name, agency_name, date)
+                        file_names[date] = file_name
+                for run in group_date_runs(date for date in dates if date not in file_names):
+                    params = build_date_params(run[0], run[-1])
+                    response = dal.make_conditional_request(report_name, agency_name, params=params)
+                    file_names.update(self.store_response(report_name, agency_name, run, response))
+                return file_names
+        except (DalException, OSError) as e:
+            logger.error("Ran into exception: %s", e)
+            raise BusinessLogicException
+
+    def refresh_date(self, report_name: str, agency_name: str, date: str, etag: str = None,
+                     last_modified: str = None) -> bool:
+        """
+        Re-fetches a date that was cached before its data was complete. The request carries the validators of the
+            previous fetch, so unchanged data only costs a 304 (and just its freshness is updated); changed data
+            atomically replaces the old file.
+        :param report_name: report name to refresh
+        :param agency_name: agency name to refresh
+        :param date: YYYY-MM-DD string to refresh
+        :param etag: ETag of the previous fetch (or None)
+        :param last_modified: Last-Modified of the previous fetch (or None)
+        :return: true if new data was written, false if the api said nothing changed
+        """
+        try:
+            with dal.report_lock(report_name, agency_name):
+                response = dal.make_conditional_request(report_name, agency_name, build_date_params(date), etag,
+                                                        last_modified)
+                if response.not_modified:
+                    self.mark_fetched(report_name, agency_name, [date], response.etag, response.last_modified)
+                    return False
+                self.store_response(report_name, agency_name, [date], response)
+                return True
+        except (DalException, OSError) as e:
+            logger.error("Ran into exception: %s", e)
+            raise BusinessLogicException
+
+    def store_response(self, report_name: str, agency_name: str, dates: list, response) -> dict:
+        """
+        Writes a (conditional) response to one file per date, then records the search_history rows and their freshness,
+            updates the dates' rollups (see update_rollups) and drops the dates from the in-process cache.
+        :param report_name: report name the response is for
+        :param agency_name: agency name the response is for
+        :param dates: sorted dates the response covers
+        :param response: the dal.ConditionalResponse
+        :return: dict of date -> the name of the file that date was saved to
+        """
+        file_names = self.parse_response_by_date(report_name, agency_name, dates, response.records)
+        self.log_dates_to_db(report_name, agency_name, file_names)
+        # a multi-date response's validators don't describe any one date, and a paged one has none (see
+        # dal.make_conditional_request)
+        if len(dates) == 1:
+            self.mark_fetched(report_name, agency_name, dates, response.etag, response.last_modified)
+        else:
+            self.mark_fetched(report_name, agency_name, dates)
+        update_rollups(report_name, agency_name, file_names)
+        memory_cache.invalidate(report_name, agency_name, file_names)
+        return file_names
+
+    def log_dates_to_db(self, report_name: str, agency_name: str, file_names: dict):
+        """
+        Logs several dates of the same report/agency, and the files they were written to, to search_log.db in one
+            transaction
+        :param report_name: report name that was fetched
+        :param agency_name: agency name that was fetched
+        :param file_names: dict of date -> the file that date was written to
+        :return: tuple of (rows inserted, rows already present)
+        """
+        try:
+            return db_service.insert_search_data_many([(report_name, agency_name, date, file_name)
+                                                       for date, file_name in file_names.items()])
         except DalException:
             logger.error("Ran into exception (already logged)")
             raise BusinessLogicException
 
-    def log_data_to_db(self, bundle: dict):
+    def mark_fetched(self, report_name: str, agency_name: str, dates, etag: str = None, last_modified: str = None):
         """
-        Upon new data being received from the API, logs the search parameters and file name to search_log.db
-        :param bundle: dict of search params from the user
-        :return: n/a
+        Records in search_log.db that dates were just fetched, whether their data was complete (see is_complete) and
+            the validators of the response
+        :param report_name: report name that was fetched
+        :param agency_name: agency name that was fetched
+        :param dates: the dates that were fetched
+        :param etag: ETag of the response (or None)
+        :param last_modified: Last-Modified of the response (or None)
+        :return: the number of rows updated
         """
+        fetched_at = datetime.now(timezone.utc)
         try:
-            return db_service.insert_search_data(bundle['report_name'], bundle['agency_name'], bundle['date'])
+            return db_service.mark_fetched([(report_name, agency_name, date, fetched_at.isoformat(timespec='seconds'),
+                                             is_complete(date, fetched_at), etag, last_modified) for date in dates])
         except DalException:
             logger.error("Ran into exception (already logged)")
             raise BusinessLogicException
 
-    def parse_response(self, bundle: dict, response):
+    def parse_response_by_date(self, report_name: str, agency_name: str, dates: list, response) -> dict:
         """
-        Parses the response to only include items in which the user's searched for date matches the item's date. Also
-            calls a method from the dal to write this data to a txt file.
-        :param bundle: dict of search params from the user
-        :param response: response from the API to write to txt file
-        :return: calls self.return_response
+        Routes each item of a multi-date response to the txt file for its date, in a single pass over the response.
+            Items for dates that weren't asked for are dropped.
+        :param report_name: report name the response is for
+        :param agency_name: agency name the response is for
+        :param dates: the dates the user is searching for
+        :param response: iterable of records from the API
+        :return: dict of date -> the name of the file that date was written to
         """
         try:
-            parsed_response = []
-            for line in response:
-                if line['date'] == bundle['date']:
-                    parsed_response.append(line)
-            file_name = dal.save_json_to_txt(bundle['report_name'], bundle['agency_name'], bundle['date'],
-                                             parsed_response)
-            return self.return_response(file_name)
+            file_names = dal.save_json_by_date(report_name, agency_name, dates, response)
         except DalException:
             logger.error("Ran into exception (already logged)")
             raise BusinessLogicException
+        self.store_rows(report_name, agency_name, file_names)
+        return file_names
+
+    def store_rows(self, report_name: str, agency_name: str, file_names: dict):
+        """
+        Loads the records of newly written files into the row store, replacing the dates' previous rows in one
+            transaction. While the row store is disabled (or if storing fails) the dates' rows are dropped instead, so
+            they are read from their files (see update_derived).
+        :param report_name: report name that was written
+        :param agency_name: agency name that was written
+        :param file_names: dict of date -> the file that date was written to
+        :return: n/a
+        """
+        store = None
+        if config.ROW_STORE_ENABLED:
+            def store():
+                db_service.store_rows(report_name, agency_name,
+                                      {date: dal.iter_from_txt(file_name) for date, file_name in file_names.items()})
+        update_derived('rows', report_name, agency_name, file_names, store,
+                       lambda: db_service.forget_rows(report_name, agency_name, file_names))
 
-    def return_response(self, file_name):
+    def return_response(self, file_name, date: str = None):
         """
-        Reads the data we have just loaded from its newly created txt file to the console.
+        Reads the data we have just loaded from its newly created txt file to the console. The records are read lazily,
+            as they are displayed (and kept in the in-process cache, if they fit).
         :param file_name: name of txt file to read from
+        :param date: the date the file holds
         :return: n/a
         """
         try:
-            data_list = dal.read_from_txt(file_name)
-            return presentation_layer.on_new_data(file_name, data_list)
+            data_list = memory_cache.read_records(file_name, date)
+            return get_presenter().on_new_data(file_name, data_list)
         except DalException as dal_err:
             logger.error("Ran into exception (already logged)")
-            presentation_layer.on_error(f"{dal_err}")
+            get_presenter().on_error(f"{dal_err}")
             raise BusinessLogicException
 
 
 class ExistingData(Data):
     def get_data(self, bundle: dict):
         """
-        Reads data from txt file to the console.
+        Reads data from txt file to the console. The records are read lazily, as they are displayed, and the bundle can
+            carry an optional 'offset' / 'limit' to only show a slice of the file. Hot files are served from the
+            in-process cache without touching disk. With the row store enabled, keys it holds are read from sql
+            instead (see read_stored_records).
         :param bundle: dict of search parameters from the
         :return: n/a
         """
         try:
-            data_list = dal.read_from_txt(bundle['file_name'])
-            return presentation_layer.on_old_data(bundle['file_name'], data_list)
+            data_list = read_stored_records(bundle)
+            if data_list is None:
+                data_list = memory_cache.read_records(bundle['file_name'], bundle['date'], bundle.get('offset', 0),
+                                                      bundle.get('limit'))
+            return get_presenter().on_old_data(bundle['file_name'], data_list)
         except DalException as dal_err:
             logger.error("Ran into exception (already logged)")
-            presentation_layer.on_error(f"{dal_err}")
+            get_presenter().on_error(f"{dal_err}")
             raise BusinessLogicException
@@ -0,0 +1,41 @@
+from exceptions import DalException
+from logging_config import get_logger
+
+"""
+This module contains what the row store (see db_service/row_store.py) and the rollups (see rollups.py) share: both are
+derived from the cache files as they are written, and the files stay the source of truth. So updating them never fails
+a fetch, and dates whose derived data couldn't be updated (or that were written while the feature was disabled) have
+it dropped instead: a stale copy would otherwise be served once the feature is enabled again.
+
+Methods:
+--------
+    update_derived(name: str, report_name: str, agency_name: str, file_names: dict, store, forget):
+        Updates the data derived from newly written cache files, or drops it if it can't (or shouldn't) be updated
+"""
+
+logger = get_logger(__name__)
+
+
+def update_derived(name: str, report_name: str, agency_name: str, file_names: dict, store, forget):
+    """
+    Updates the data derived from newly written cache files, or drops it if it can't (or shouldn't) be updated. A
+        failure only logs.
+    :param name: what is derived (e.g. 'rollups'), for log messages
+    :param report_name: report name that was written
+    :param agency_name: agency name that was written
+    :param file_names: dict of date -> the file that date was written to
+    :param store: function (no arguments) that stores the derived data, None while the feature is disabled
+    :param forget: function (no arguments) that drops the dates' derived data
+    :return: n/a
+    """
+    if store is not None:
+        try:
+            store()
+            return
+        except DalException:
+            logger.warning("Could not update the %s of %s/%s %s", name, report_name, agency_name, sorted(file_names))
+    try:
+        forget()
+    except DalException:
+        logger.error("Could not drop the %s of %s/%s %s, they may be stale until they are rebuilt", name,
+                     report_name, agency_name, sorted(file_names))
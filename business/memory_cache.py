@@ -0,0 +1,327 @@
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import date as date_type
+from itertools import islice
+import config
+import dal
+import db_service
+from logging_config import get_logger
+
+"""
+This module contains the in-process cache that sits in front of the search db and the cache files, for long running
+processes that keep asking for the same report/agency/date keys. It has two tiers:
+
+    - FILE_NAMES: report/agency/date -> file name, so a hot key skips search_for_match
+    - RECORDS: file name -> the file's parsed records, bounded by (approximate) bytes rather than entries, so a hot file
+      skips the file read entirely
+
+Entries for today's date (or later) expire after MEMORY_CACHE_TODAY_TTL seconds, since that data can still change.
+NewData invalidates the keys and files it writes. A value is only cached if its key wasn't invalidated while it was
+being read (see LRUCache.generation), so a reader still streaming the old file can't put stale records back.
+
+Methods:
+--------
+    estimate_size(record: dict) -> int:
+        Roughly estimates how many bytes a parsed record holds in memory
+    ttl_for(date: str):
+        Returns how long cached data for a date can be trusted (None for forever)
+    lookup_file_name(report_name: str, agency_name: str, date: str):
+        Returns the file name recorded for a key, from memory if possible, otherwise from the search db
+    forget_file_name(report_name: str, agency_name: str, date: str):
+        Drops the cached file name of a key
+    has_records(file_name: str) -> bool:
+        Checks if a file's records are in memory
+    read_records(file_name: str, date: str = None, offset: int = 0, limit: int = None):
+        Returns the records of a cache file (or a slice of them), from memory if possible
+    invalidate(report_name: str, agency_name: str, file_names: dict):
+        Drops the cached file names and records of keys that have just been (re)written
+    get_cache_stats() -> dict:
+        Returns hit/miss/eviction counters and sizes of both tiers
+    clear_cache():
+        Empties both tiers and resets their counters
+
+Classes:
+--------
+    LRUCache:
+        Thread safe LRU cache bounded by a total size (entries, or bytes when the caller passes sizes), with optional
+        per-entry expiry, a generation that guards against caching values whose key was invalidated while they were
+        read, and hit/miss/eviction counters. The bound can be given as the name of a setting, which is read when first
+        needed.
+
+Constants:
+----------
+    FILE_NAMES: the key -> file name LRUCache
+    RECORDS: the file name -> records LRUCache
+"""
+
+logger = get_logger(__name__)
+
+
+class LRUCache:
+    FIELDS = ('hits', 'misses', 'evictions', 'expirations', 'invalidations')
+    RECENT_INVALIDATIONS = 1024  # invalidations remembered to tell whether a read in progress raced one of them
+    _CLEARED = object()  # recorded by clear(), invalidates every key
+
+    def __init__(self, max_size):
+        self._max_size = max_size  # int, or the name of the setting that holds it (see config)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size, expires_at), least recently used first
+        self._size = 0
+        self._counters = dict.fromkeys(self.FIELDS, 0)
+        self._generation = 0  # number of invalidations (and clears) so far
+        self._recent = deque(maxlen=self.RECENT_INVALIDATIONS)  # keys of the latest invalidations, oldest first
+
+    @property
+    def max_size(self) -> int:
+        if isinstance(self._max_size, str):
+            self._max_size = getattr(config, self._max_size)
+        return self._max_size
+
+    def generation(self) -> int:
+        """
+        Returns the cache's current generation, which is bumped by every invalidation (and clear). Take it before
+            reading a value and pass it to put, so a value read while its key was invalidated isn't cached. Only the
+            latest RECENT_INVALIDATIONS invalidations are remembered, so memory stays bounded: a value whose read
+            outlived more of them than that isn't cached either.
+        :return: the generation
+        """
+        with self._lock:
+            return self._generation
+
+    def _invalidated_since(self, key, generation: int) -> bool:
+        missed = self._generation - generation
+        if missed <= 0:
+            return False
+        if missed > len(self._recent):
+            return True
+        recent = list(islice(reversed(self._recent), missed))
+        return key in recent or self._CLEARED in recent
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached under key and marks it as most recently used
+        :param key: the key to look up
+        :param default: returned if the key isn't cached (or has expired)
+        :return: the cached value or default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return default
+            if entry[2] is not None and entry[2] <= time.monotonic():
+                self._remove(key)
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[0]
+
+    def contains(self, key) -> bool:
+        """
+        Checks if an unexpired value is cached under key, without counting a hit or miss
+        :param key: the key to look up
+        :return: true if cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (entry[2] is None or entry[2] > time.monotonic())
+
+    def put(self, key, value, size: int = 1, ttl: float = None, generation: int = None) -> bool:
+        """
+        Caches value under key, evicting least recently used entries until the cache fits in max_size
+        :param key: the key
+        :param value: the value
+        :param size: how much of max_size the value takes up
+        :param ttl: seconds until the entry expires (None for never)
+        :param generation: (optional) the cache's generation when value was read, see generation()
+        :return: true if the value was cached (false if it is bigger than the whole cache, or the key was invalidated
+            since generation)
+        """
+        with self._lock:
+            if generation is not None and self._invalidated_since(key, generation):
+                return False
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_size:
+                return False
+            while self._entries and self._size + size > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self._counters['evictions'] += 1
+            expires_at = None if ttl is None else time.monotonic() + ttl
+            self._entries[key] = (value, size, expires_at)
+            self._size += size
+            return True
+
+    def invalidate(self, key):
+        """
+        Drops the value cached under key, if there is one
+        :param key: the key
+        :return: n/a
+        """
+        with self._lock:
+            self._generation += 1
+            self._recent.append(key)
+            if key in self._entries:
+                self._remove(key)
+                self._counters['invalidations'] += 1
+
+    def clear(self):
+        """
+        Drops every entry and resets the counters
+        :return: n/a
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._generation += 1
+            self._recent.append(self._CLEARED)
+            self._counters = dict.fromkeys(self.FIELDS, 0)
+
+    def stats(self) -> dict:
+        """
+        Returns a copy of the counters, plus the number of entries and their total size
+        :return: dict of name -> value
+        """
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), size=self._size, max_size=self.max_size)
+
+    def _remove(self, key):
+        self._size -= self._entries.pop(key)[1]
+
+
+FILE_NAMES = LRUCache('MEMORY_CACHE_MAX_KEYS')
+RECORDS = LRUCache('MEMORY_CACHE_MAX_BYTES')
+
+
+def estimate_size(record: dict) -> int:
+    """
+    Roughly estimates how many bytes a parsed record holds in memory (the dict plus its keys and values)
+    :param record: the record
+    :return: approximate size in bytes
+    """
+    size = sys.getsizeof(record)
+    for key, value in record.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
+
+
+def ttl_for(date: str):
+    """
+    Returns how long cached data for a date can be trusted: data for today (or later) can still change, older data
+        can't
+    :param date: YYYY-MM-DD string (None if unknown, treated as old data)
+    :return: seconds, or None for forever
+    """
+    if date is not None and date >= f"{date_type.today()}":
+        return config.MEMORY_CACHE_TODAY_TTL
+    return None
+
+
+def lookup_file_name(report_name: str, agency_name: str, date: str):
+    """
+    Returns the file name recorded for a key, from memory if possible, otherwise from the search db (found names are
+        then kept in memory)
+    :param report_name: report name to search for
+    :param agency_name: agency name to search for
+    :param date: date to search for
+    :return: the file name, or False if the key has never been fetched
+    """
+    key = (report_name, agency_name, date)
+    file_name = FILE_NAMES.get(key)
+    if file_name is not None:
+        return file_name
+    generation = FILE_NAMES.generation()
+    file_name = db_service.search_for_match(report_name, agency_name, date)
+    if file_name:
+        FILE_NAMES.put(key, file_name, ttl=ttl_for(date), generation=generation)
+    return file_name
+
+
+def forget_file_name(report_name: str, agency_name: str, date: str):
+    """
+    Drops the cached file name of a key (e.g. because its file turned out to be missing)
+    :param report_name: report name
+    :param agency_name: agency name
+    :param date: date
+    :return: n/a
+    """
+    FILE_NAMES.invalidate((report_name, agency_name, date))
+
+
+def has_records(file_name: str) -> bool:
+    """
+    Checks if a file's records are in memory
+    :param file_name: the cache file
+    :return: true if they are
+    """
+    return RECORDS.contains(file_name)
+
+
+def read_records(file_name: str, date: str = None, offset: int = 0, limit: int = None):
+    """
+    Returns the records of a cache file (or an offset/limit slice of them), from memory if possible. Otherwise the file
+        is read lazily through the dal as usual, and a complete read that fits in the cache is kept for next time.
+    :param file_name: the cache file
+    :param date: the date the file holds (decides the ttl, see ttl_for)
+    :param offset: number of records to skip
+    :param limit: max number of records to yield (None for all)
+    :return: an iterable of records (dicts)
+    """
+    records = RECORDS.get(file_name)
+    if records is not None:
+        stop = None if limit is None else offset + limit
+        return islice(records, offset, stop)
+    generation = RECORDS.generation()
+    data = dal.iter_from_txt(file_name, offset, limit)  # raises here if the file is missing
+    if offset or limit is not None or RECORDS.max_size <= 0:
+        return data
+    return _read_and_cache(file_name, date, data, generation)
+
+
+def _read_and_cache(file_name: str, date: str, data, generation: tuple):
+    collected = []
+    size = 0
+    for record in data:
+        if collected is not None:
+            size += estimate_size(record)
+            if size <= RECORDS.max_size:
+                collected.append(record)
+            else:
+                collected = None  # too big to ever fit, stop collecting
+        yield record
+    if collected is not None:
+        RECORDS.put(file_name, collected, size=size, ttl=ttl_for(date), generation=generation)
+
+
+def invalidate(report_name: str, agency_name: str, file_names: dict):
+    """
+    Drops the cached file names and records of keys that have just been (re)written
+    :param report_name: report name that was written
+    :param agency_name: agency name that was written
+    :param file_names: dict of date -> the file that date was written to
+    :return: n/a
+    """
+    for date, file_name in file_names.items():
+        FILE_NAMES.invalidate((report_name, agency_name, date))
+        RECORDS.invalidate(file_name)
+
+
+def get_cache_stats() -> dict:
+    """
+    Returns hit/miss/eviction counters and sizes of both tiers
+    :return: dict of 'file_names' / 'records' -> dict of counter name -> value (the records tier's sizes are in bytes)
+    """
+    return {'file_names': FILE_NAMES.stats(), 'records': RECORDS.stats()}
+
+
+def clear_cache():
+    """
+    Empties both tiers and resets their counters
+    :return: n/a
+    """
+    FILE_NAMES.clear()
+    RECORDS.clear()
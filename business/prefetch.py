@@ -0,0 +1,264 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import date as date_type, datetime, timedelta
+import config
+import dal
+import db_service
+import validation
+from exceptions import DalException, BusinessLogicException
+from logging_config import get_logger
+from .batch_fetch import STATUS_FETCHED, STATUS_ERROR
+from .business_layer import NewData, group_date_runs
+
+"""
+This module contains the prefetch (cache warm-up) scheduler: for a date window it works out which report x agency x
+date keys are missing from search_history and fetches only those, hottest first, through the same fetch-and-persist path
+as every other lookup (so the key locks, search_history rows and memory cache stay consistent).
+
+    - Priority: keys are ordered by the configured hotness of their report and agency (PREFETCH_HOT_REPORTS /
+      PREFETCH_HOT_AGENCIES, hottest first, unlisted names last), then newest date first. The missing dates of a
+      report/agency are fetched with one request per run of consecutive days.
+    - Budget: a run stops starting new jobs once it has made max_requests api requests (retries and extra pages
+      count), on top of the shared rate limiter every request already goes through.
+    - Resuming: search_history is the record of what is done, so re-running the same window only plans what is still
+      missing. The state file (PREFETCH_STATE_PATH) keeps the run's progress and the keys that failed, which a resumed
+      run schedules after everything else instead of retrying them first.
+
+Methods:
+--------
+    hotness(report_name: str, agency_name: str) -> tuple:
+        Returns the sort key of a report/agency, lower is hotter
+    find_missing_keys(report_names: list, agency_names: list, start_date: str, end_date: str) -> list:
+        Returns the keys of the window that aren't in search_history
+    plan_prefetch(report_names: list, agency_names: list, start_date: str, end_date: str,
+                  state_path: str = None) -> dict:
+        Returns the prioritised jobs that would fetch every missing key
+    run_prefetch(plan: dict, max_requests: int = None, max_workers: int = None,
+                 state_path: str = None):
+        Runs a plan's jobs within the request budget, yielding a result dict per job and recording progress
+    load_state(state_path: str = None) -> dict:
+        Reads the state file of the last run
+    save_state(state: dict, state_path: str = None):
+        Atomically writes the state file
+
+Constants:
+----------
+    STATUS_DEFERRED: result status for a job that wasn't started because the request budget ran out
+"""
+
+logger = get_logger(__name__)
+
+STATUS_DEFERRED = 'deferred'
+
+
+def _key_string(report_name: str, agency_name: str, date: str) -> str:
+    return f"{report_name}/{agency_name}/{date}"
+
+
+def hotness(report_name: str, agency_name: str) -> tuple:
+    """
+    Returns the sort key of a report/agency: its position in PREFETCH_HOT_REPORTS and PREFETCH_HOT_AGENCIES (unlisted
+        names sort after every listed one), lower is hotter
+    :param report_name: report name
+    :param agency_name: agency name
+    :return: (report rank + agency rank, report rank, agency rank) tuple
+    """
+    hot_reports, hot_agencies = config.PREFETCH_HOT_REPORTS, config.PREFETCH_HOT_AGENCIES
+    report_rank = hot_reports.index(report_name) if report_name in hot_reports else len(hot_reports)
+    agency_rank = hot_agencies.index(agency_name) if agency_name in hot_agencies else len(hot_agencies)
+    return report_rank + agency_rank, report_rank, agency_rank
+
+
+def find_missing_keys(report_names: list, agency_names: list, start_date: str, end_date: str) -> list:
+    """
+    Returns the keys of the report x agency x date matrix that aren't in search_history (one query for the whole window)
+    :param report_names: reports to prefetch (validation.REPORTS_LIST for all of them)
+    :param agency_names: agencies to prefetch (validation.AGENCY_LIST for all of them)
+    :param start_date: first date of the window, YYYY-MM-DD
+    :param end_date: last date of the window (inclusive), YYYY-MM-DD
+    :return: list of (report_name, agency_name, date) tuples
+    """
+    for report_name in report_names:
+        if report_name not in validation.REPORTS_LIST:
+            raise BusinessLogicException(f"{report_name} is not a valid report name")
+    for agency_name in agency_names:
+        if agency_name not in validation.AGENCY_LIST:
+            raise BusinessLogicException(f"{agency_name} is not a valid agency name")
+    first = datetime.strptime(start_date, '%Y-%m-%d').date()
+    last = min(datetime.strptime(end_date, '%Y-%m-%d').date(), date_type.today())
+    dates = [f"{first + timedelta(days=offset)}" for offset in range((last - first).days + 1)]
+    try:
+        present = db_service.find_keys_between(start_date, f"{last}")
+    except DalException:
+        logger.error("Ran into exception (already logged)")
+        raise BusinessLogicException
+    return [(report_name, agency_name, date) for report_name in report_names for agency_name in agency_names
+            for date in dates if (report_name, agency_name, date) not in present]
+
+
+def plan_prefetch(report_names: list, agency_names: list, start_date: str, end_date: str,
+                  state_path: str = None) -> dict:
+    """
+    Returns the prioritised jobs that would fetch every missing key of the window. Keys that failed in the last run of
+        the same window (see load_state) are planned after every other key.
+    :param report_names: reports to prefetch
+    :param agency_names: agencies to prefetch
+    :param start_date: first date of the window, YYYY-MM-DD
+    :param end_date: last date of the window (inclusive), YYYY-MM-DD
+    :param state_path: the state file of the last run (defaults to PREFETCH_STATE_PATH)
+    :return: dict with 'window' (the plan's parameters), 'missing' (number of missing keys) and 'jobs', a list of
+        {'report_name', 'agency_name', 'dates', 'retry'} dicts in the order they will run
+    """
+    window = {'reports': sorted(report_names), 'agencies': sorted(agency_names), 'start_date': start_date,
+              'end_date': end_date}
+    state = load_state(state_path)
+    failed = state.get('failed', {}) if state.get('window') == window else {}
+    missing = find_missing_keys(report_names, agency_names, start_date, end_date)
+
+    grouped = {}
+    for report_name, agency_name, date in missing:
+        retry = _key_string(report_name, agency_name, date) in failed
+        grouped.setdefault((retry, report_name, agency_name), []).append(date)
+    jobs = []
+    for (retry, report_name, agency_name), dates in grouped.items():
+        for run in group_date_runs(dates):
+            jobs.append({'report_name': report_name, 'agency_name': agency_name, 'dates': run, 'retry': retry})
+    # newest dates first within a hotness level, they are the ones most likely to be looked up next
+    jobs.sort(key=lambda job: job['dates'][-1], reverse=True)
+    jobs.sort(key=lambda job: (job['retry'], hotness(job['report_name'], job['agency_name'])))
+    return {'window': window, 'missing': len(missing), 'jobs': jobs}
+
+
+def load_state(state_path: str = None) -> dict:
+    """
+    Reads the state file of the last run
+    :param state_path: the state file (defaults to PREFETCH_STATE_PATH)
+    :return: the state dict, empty if there is no (readable) state file
+    """
+    state_path = state_path or config.PREFETCH_STATE_PATH
+    try:
+        with open(state_path, encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable prefetch state %s: %s", state_path, e)
+        return {}
+
+
+def save_state(state: dict, state_path: str = None):
+    """
+    Atomically writes the state file (temp file, then os.replace), so a run killed mid-write leaves the previous state
+    :param state: the state dict
+    :param state_path: the state file (defaults to PREFETCH_STATE_PATH)
+    :return: n/a
+    """
+    state_path = state_path or config.PREFETCH_STATE_PATH
+    directory = os.path.dirname(state_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{state_path}.tmp-{os.getpid()}"
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=1, sort_keys=True)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, state_path)
+
+
+def run_job(job: dict) -> dict:
+    """
+    Fetches and saves the dates of one job, never raising
+    :param job: a job of a plan (see plan_prefetch)
+    :return: dict with the job's report_name, agency_name & dates, status (STATUS_FETCHED or STATUS_ERROR) and error
+    """
+    result = dict(job, status=STATUS_ERROR, error=None)
+    try:
+        NewData().fetch_and_store_dates(job['report_name'], job['agency_name'], job['dates'])
+        result['status'] = STATUS_FETCHED
+    except (DalException, BusinessLogicException) as e:
+        logger.error("Prefetch failed for %s/%s/%s..%s",
+                     job['report_name'], job['agency_name'], job['dates'][0], job['dates'][-1])
+        result['error'] = f"{e}" or type(e).__name__
+    except Exception as e:
+        logger.error("Unexpected error prefetching %s: %s", job, e)
+        result['error'] = f"{e}"
+    return result
+
+
+def _run_counted(job: dict, counters: dict) -> dict:
+    with dal.track_requests(counters):
+        return run_job(job)
+
+
+def run_prefetch(plan: dict, max_requests: int = None, max_workers: int = None,
+                 state_path: str = None):
+    """
+    Runs a plan's jobs in order, at most max_workers at once, yielding the result dict of each job as soon as it
+        finishes. A job in flight counts as the requests it has made so far, but at least the one request every job
+        takes, and no new job is started once the jobs run so far count max_requests; the jobs that weren't started
+        are yielded as STATUS_DEFERRED. So only jobs that need more than one request (e.g. retries) can overshoot the
+        budget, and only a little.
+        The state file is rewritten after every job, so a killed run loses nothing but the jobs that were in flight.
+    :param plan: the plan (see plan_prefetch)
+    :param max_requests: request budget of this run, 0 for no limit (defaults to PREFETCH_MAX_REQUESTS)
+    :param max_workers: max number of jobs fetched at the same time (defaults to BATCH_MAX_WORKERS)
+    :param state_path: the state file (defaults to PREFETCH_STATE_PATH)
+    :return: yields result dicts (see run_job)
+    """
+    if max_requests is None:
+        max_requests = config.PREFETCH_MAX_REQUESTS
+    if max_workers is None:
+        max_workers = config.BATCH_MAX_WORKERS
+    state_path = state_path or config.PREFETCH_STATE_PATH
+    previous = load_state(state_path)
+    state = {'window': plan['window'], 'started_at': f"{datetime.now().isoformat(timespec='seconds')}",
+             'fetched_keys': 0, 'failed': {}, 'finished': False}
+    if previous.get('window') == plan['window'] and not previous.get('finished'):
+        state.update(started_at=previous.get('started_at', state['started_at']),
+                     fetched_keys=previous.get('fetched_keys', 0), failed=previous.get('failed', {}))
+        logger.info("Resuming prefetch started at %s", state['started_at'])
+
+    def record(result: dict):
+        for date in result['dates']:
+            key = _key_string(result['report_name'], result['agency_name'], date)
+            if result['status'] == STATUS_FETCHED:
+                state['fetched_keys'] += 1
+                state['failed'].pop(key, None)
+            else:
+                state['failed'][key] = result['error']
+        state['updated_at'] = f"{datetime.now().isoformat(timespec='seconds')}"
+        save_state(state, state_path)
+
+    start_requests = dal.get_request_stats()['requests']
+    deferred = 0
+    pending = list(reversed(plan['jobs']))  # popped from the end, so in plan order
+    logger.info("Prefetching %s keys in %s jobs with %s workers, budget %s requests",
+                plan['missing'], len(pending), max_workers, max_requests or 'unlimited')
+    save_state(state, state_path)
+    finished_requests = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}  # future -> the request counters of its job
+        while pending or running:
+            while pending and len(running) < max_workers:
+                spent = finished_requests + sum(max(counters.get('requests', 0), 1) for counters in running.values())
+                if max_requests and spent >= max_requests:
+                    logger.info("Request budget of %s spent (or reserved by the jobs in flight), deferring %s jobs",
+                                max_requests, len(pending))
+                    deferred = len(pending)
+                    while pending:
+                        yield dict(pending.pop(), status=STATUS_DEFERRED, error=None)
+                    break
+                counters = {}
+                running[executor.submit(_run_counted, pending.pop(), counters)] = counters
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                finished_requests += running.pop(future).get('requests', 0)
+                result = future.result()
+                record(result)
+                yield result
+    state.update(finished=not deferred and not state['failed'], deferred_jobs=deferred,
+                 requests=dal.get_request_stats()['requests'] - start_requests)
+    save_state(state, state_path)
@@ -0,0 +1,98 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date as date_type, timedelta
+import config
+import db_service
+from exceptions import DalException, BusinessLogicException
+from logging_config import get_logger
+from .batch_fetch import STATUS_ERROR
+from .business_layer import NewData
+
+"""
+This module contains the refresh mode of the cache: cached dates whose data may still change (fetched before the api
+had all of it, see business_layer.is_complete) are re-fetched with conditional requests, so a date that hasn't changed
+costs a 304 instead of a download, and one that has is atomically replaced.
+
+Methods:
+--------
+    find_stale_keys(since: str = None, until: str = None, report_names: list = None, agency_names: list = None) -> list:
+        Returns the cached keys that should be refreshed
+    refresh_one(row) -> dict:
+        Refreshes a single stale key
+    refresh_stale(since: str = None, until: str = None, report_names: list = None, agency_names: list = None,
+                  max_workers: int = None):
+        Refreshes every stale key concurrently, yielding a result dict for each
+
+Constants:
+----------
+    STATUS_REFRESHED: result status for a key whose data changed and was re-written
+    STATUS_NOT_MODIFIED: result status for a key the api said hadn't changed (304)
+"""
+
+logger = get_logger(__name__)
+
+STATUS_REFRESHED = 'refreshed'
+STATUS_NOT_MODIFIED = 'not_modified'
+
+
+def find_stale_keys(since: str = None, until: str = None, report_names: list = None, agency_names: list = None) -> list:
+    """
+    Returns the cached keys that should be refreshed: every key fetched before its data was complete, plus keys of
+        unknown completeness (cached before freshness was recorded) from the last FRESHNESS_SETTLE_DAYS days
+    :param since: (optional) YYYY-MM-DD, only keys on or after this date
+    :param until: (optional) YYYY-MM-DD, only keys on or before this date
+    :param report_names: (optional) only keys of these reports
+    :param agency_names: (optional) only keys of these agencies
+    :return: list of (report_name, agency_name, date, file_name, etag, last_modified) tuples
+    """
+    unknown_since = f"{date_type.today() - timedelta(days=config.FRESHNESS_SETTLE_DAYS)}"
+    try:
+        return db_service.find_stale(unknown_since, since, until, report_names, agency_names)
+    except DalException:
+        logger.error("Ran into exception (already logged)")
+        raise BusinessLogicException
+
+
+def refresh_one(row) -> dict:
+    """
+    Refreshes a single stale key, never raising
+    :param row: (report_name, agency_name, date, file_name, etag, last_modified) tuple, see find_stale_keys
+    :return: dict with report_name, agency_name, date, file_name, status (STATUS_REFRESHED, STATUS_NOT_MODIFIED or
+        STATUS_ERROR) and error
+    """
+    report_name, agency_name, date, file_name, etag, last_modified = row
+    result = {'report_name': report_name, 'agency_name': agency_name, 'date': date, 'file_name': file_name,
+              'status': STATUS_ERROR, 'error': None}
+    try:
+        changed = NewData().refresh_date(report_name, agency_name, date, etag, last_modified)
+        result['status'] = STATUS_REFRESHED if changed else STATUS_NOT_MODIFIED
+    except (DalException, BusinessLogicException) as e:
+        logger.error("Refresh failed for %s/%s/%s", report_name, agency_name, date)
+        result['error'] = f"{e}" or type(e).__name__
+    except Exception as e:
+        logger.error("Unexpected error refreshing %s/%s/%s: %s", report_name, agency_name, date, e)
+        result['error'] = f"{e}"
+    return result
+
+
+def refresh_stale(since: str = None, until: str = None, report_names: list = None, agency_names: list = None,
+                  max_workers: int = None):
+    """
+    Refreshes every stale key concurrently (at most max_workers at once, all through the shared rate limiter),
+        yielding the result dict of each key as soon as it finishes
+    :param since: (optional) YYYY-MM-DD, only keys on or after this date
+    :param until: (optional) YYYY-MM-DD, only keys on or before this date
+    :param report_names: (optional) only keys of these reports
+    :param agency_names: (optional) only keys of these agencies
+    :param max_workers: max number of keys refreshed at the same time (defaults to BATCH_MAX_WORKERS)
+    :return: yields result dicts (see refresh_one)
+    """
+    if max_workers is None:
+        max_workers = config.BATCH_MAX_WORKERS
+    rows = find_stale_keys(since, until, report_names, agency_names)
+    logger.info("Refreshing %s stale keys with %s workers", len(rows), max_workers)
+    if not rows:
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(refresh_one, row) for row in rows]
+        for future in as_completed(futures):
+            yield future.result()
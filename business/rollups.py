@@ -0,0 +1,202 @@
+import json
+import config
+import dal
+import db_service
+from exceptions import DalException, BusinessLogicException
+from logging_config import get_logger, worker_logging, init_worker_logging
+from .derived_data import update_derived
+
+"""
+This module contains the rollups: precomputed aggregates of every cached key (record count, totals of every numeric
+field and the top values of every text field), stored in the rollup tables (see db_service/rollups.py). NewData updates
+a key's rollups as soon as it is written, so range queries over past dates, whose data never changes, are answered from
+a few rollup rows per key instead of the raw records. rebuild_rollups recomputes them from the cache files, reading the
+files in parallel worker processes.
+
+Methods:
+--------
+    compute_rollup(report_name: str, agency_name: str, date: str, records, top_k: int = None) -> tuple:
+        Computes the rollup rows of one key in a single pass over its records
+    rollup_file(source: tuple) -> tuple:
+        Computes the rollup rows of one cached key from its file (run in the rebuild's worker processes)
+    update_rollups(report_name: str, agency_name: str, file_names: dict):
+        Recomputes the rollups of keys that have just been written
+    rebuild_rollups(report_name: str = None, agency_name: str = None, missing_only: bool = False,
+                    max_workers: int = None) -> dict:
+        Recomputes the rollups of every cached key (or of one report / agency) from the cache files, in parallel
+    rollup_totals(report_name: str, start_date: str, end_date: str, agency_names: list = None, by=('agency', 'date'))
+            -> list:
+        Returns the record count and metric total of a report's date window, per agency and/or date
+    rollup_top(report_name: str, start_date: str, end_date: str, field: str = None, agency_names: list = None,
+               limit: int = 10) -> list:
+        Returns the top values of a text field over a report's date window
+
+Constants:
+----------
+    SKIPPED_FIELDS: record fields that are never rolled up (ids, and the fields every record of a key shares)
+    REBUILD_BATCH_SIZE: number of keys whose rollups a rebuild stores per transaction
+"""
+
+logger = get_logger(__name__)
+
+SKIPPED_FIELDS = frozenset(('id', 'date', 'report_name', 'report_agency'))
+REBUILD_BATCH_SIZE = 500
+
+
+def compute_rollup(report_name: str, agency_name: str, date: str, records, top_k: int = None) -> tuple:
+    """
+    Computes the rollup rows of one key in a single pass over its records: the record count, the total of every
+        numeric field, and for every text field the top_k values by the report's main metric
+    :param report_name: report name
+    :param agency_name: agency name
+    :param date: YYYY-MM-DD date
+    :param records: iterable of the key's records
+    :param top_k: number of top values kept per text field (defaults to ROLLUP_TOP_K)
+    :return: (daily row, top rows), see db_service.store_rollups
+    """
+    if top_k is None:
+        top_k = config.ROLLUP_TOP_K
+    metric_field = db_service.REPORT_METRICS.get(report_name, 'visits')
+    row_count = 0
+    totals = {}
+    text_totals = {}
+    for record in records:
+        row_count += 1
+        metric = record.get(metric_field)
+        metric = metric if isinstance(metric, (int, float)) and not isinstance(metric, bool) else 0
+        for field, value in record.items():
+            if field in SKIPPED_FIELDS or isinstance(value, bool):
+                continue
+            if isinstance(value, (int, float)):
+                totals[field] = totals.get(field, 0) + value
+            elif isinstance(value, str):
+                field_totals = text_totals.setdefault(field, {})
+                field_totals[value] = field_totals.get(value, 0) + metric
+    top_rows = []
+    for field, field_totals in text_totals.items():
+        ranked = sorted(field_totals.items(), key=lambda item: (-item[1], item[0]))[:top_k]
+        top_rows.extend((report_name, agency_name, date, field, rank, value, int(total))
+                        for rank, (value, total) in enumerate(ranked, start=1))
+    daily_row = (report_name, agency_name, date, row_count, int(totals.get(metric_field, 0)),
+                 json.dumps(totals, sort_keys=True))
+    return daily_row, top_rows
+
+
+def rollup_file(source: tuple) -> tuple:
+    """
+    Computes the rollup rows of one cached key from its file (run in the rebuild's worker processes, so it never raises)
+    :param source: (report_name, agency_name, date, file_name) tuple
+    :return: (source, (daily row, top rows)) or (source, None) if the file couldn't be read
+    """
+    report_name, agency_name, date, file_name = source
+    try:
+        return source, compute_rollup(report_name, agency_name, date, dal.iter_from_txt(file_name))
+    except DalException:
+        return source, None
+
+
+def update_rollups(report_name: str, agency_name: str, file_names: dict):
+    """
+    Recomputes the rollups of keys that have just been written, from their files. While rollups are disabled (or if
+        updating them fails) the keys' rollups are dropped instead (see update_derived); rebuild_rollups with
+        missing_only recomputes them.
+    :param report_name: report name that was written
+    :param agency_name: agency name that was written
+    :param file_names: dict of date -> the file that date was written to
+    :return: n/a
+    """
+    store = None
+    if config.ROLLUPS_ENABLED:
+        def store():
+            db_service.store_rollups([compute_rollup(report_name, agency_name, date, dal.iter_from_txt(file_name))
+                                      for date, file_name in file_names.items()])
+    update_derived('rollups', report_name, agency_name, file_names, store,
+                   lambda: db_service.forget_rollups([(report_name, agency_name, date) for date in file_names]))
+
+
+def rebuild_rollups(report_name: str = None, agency_name: str = None, missing_only: bool = False,
+                    max_workers: int = None) -> dict:
+    """
+    Recomputes the rollups of every cached key (or of one report / agency) from the cache files. The files are read
+        and aggregated in max_workers processes, while this process stores the results, REBUILD_BATCH_SIZE keys per
+        transaction (so there is a single db writer) and writes the workers' log records (see worker_logging).
+    :param report_name: (optional) only keys of this report
+    :param agency_name: (optional) only keys of this agency
+    :param missing_only: only keys without rollups yet
+    :param max_workers: number of worker processes (defaults to BATCH_MAX_WORKERS)
+    :return: dict of counts: 'rebuilt' and 'failed' (files that couldn't be read)
+    """
+    if max_workers is None:
+        max_workers = config.BATCH_MAX_WORKERS
+    from concurrent.futures import ProcessPoolExecutor  # multiprocessing is slow to import and only a rebuild needs it
+    try:
+        sources = db_service.find_rollup_sources(report_name, agency_name, missing_only)
+        logger.info("Rebuilding the rollups of %s keys with %s processes", len(sources), max_workers)
+        counts = {'rebuilt': 0, 'failed': 0}
+        batch = []
+        with worker_logging() as log_queue, \
+                ProcessPoolExecutor(max_workers, initializer=init_worker_logging, initargs=(log_queue,)) as executor:
+            for source, rollup in executor.map(rollup_file, sources, chunksize=32):
+                if rollup is None:
+                    logger.warning("Could not read %s, skipping its rollups", source[3])
+                    counts['failed'] += 1
+                    continue
+                batch.append(rollup)
+                if len(batch) >= REBUILD_BATCH_SIZE:
+                    counts['rebuilt'] += db_service.store_rollups(batch)
+                    batch = []
+        if batch:
+            counts['rebuilt'] += db_service.store_rollups(batch)
+        logger.info("Rollup rebuild finished: %s", dict(counts))
+        return counts
+    except DalException:
+        logger.error("Ran into exception (already logged)")
+        raise BusinessLogicException
+
+
+def rollup_totals(report_name: str, start_date: str, end_date: str, agency_names: list = None,
+                  by=('agency', 'date')) -> list:
+    """
+    Returns the record count and metric total of a report's date window, per agency and/or date, from the rollups
+    :param report_name: report name
+    :param start_date: first date of the window, YYYY-MM-DD
+    :param end_date: last date of the window (inclusive), YYYY-MM-DD
+    :param agency_names: (optional) only these agencies
+    :param by: axes to group by, any of 'agency' & 'date' (empty for one grand total)
+    :return: list of dicts of the group's agency_name / date, 'keys' (keys with rollups), 'rows' and the metric total
+    """
+    by = (by,) if isinstance(by, str) else tuple(by)
+    for axis in by:
+        if axis not in db_service.ROLLUP_GROUP_COLUMNS:
+            raise BusinessLogicException(f"Can't group rollups by {axis}, expected 'agency' and/or 'date'")
+    metric_field = db_service.REPORT_METRICS.get(report_name, 'visits')
+    names = [db_service.ROLLUP_GROUP_COLUMNS[axis] for axis in by] + ['keys', 'rows', metric_field]
+    try:
+        return [dict(zip(names, row)) for row in
+                db_service.sum_rollups(report_name, start_date, end_date, agency_names, by)]
+    except DalException:
+        logger.error("Ran into exception (already logged)")
+        raise BusinessLogicException
+
+
+def rollup_top(report_name: str, start_date: str, end_date: str, field: str = None, agency_names: list = None,
+               limit: int = 10) -> list:
+    """
+    Returns the top values of a text field over a report's date window, from the rollups (see
+        db_service.top_from_rollups for when this is approximate)
+    :param report_name: report name
+    :param start_date: first date of the window, YYYY-MM-DD
+    :param end_date: last date of the window (inclusive), YYYY-MM-DD
+    :param field: the text field, defaults to the report's main dimension (e.g. 'browser')
+    :param agency_names: (optional) only these agencies
+    :param limit: number of values
+    :return: list of dicts of the value, the metric total and 'keys' (number of keys it was in the top of)
+    """
+    field = field or db_service.REPORT_DIMENSIONS.get(report_name)
+    metric_field = db_service.REPORT_METRICS.get(report_name, 'visits')
+    try:
+        return [{field: value, metric_field: total, 'keys': keys} for value, total, keys in
+                db_service.top_from_rollups(report_name, field, start_date, end_date, agency_names, limit)]
+    except DalException:
+        logger.error("Ran into exception (already logged)")
+        raise BusinessLogicException
@@ -0,0 +1,81 @@
+import threading
+from logging_config import get_logger
+
+"""
+This module contains request coalescing ("single-flight"): while a call for a key is in flight, every other caller
+asking for the same key waits for that call and gets its result (or its exception), instead of repeating the work.
+Once the call finishes the key is forgotten, so later callers start a fresh call.
+
+Classes:
+--------
+    SingleFlight:
+        Coalesces concurrent calls per key, with counters of how many calls were made and how many were shared
+"""
+
+logger = get_logger(__name__)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    FIELDS = ('calls', 'shared')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = dict.fromkeys(self.FIELDS, 0)
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Calls function(*args, **kwargs), unless a call for key is already in flight, in which case waits for that call
+        :param key: identifies the work (any hashable)
+        :param function: the work to do
+        :return: the call's result (the in-flight call's exception is re-raised in every waiter)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._counters['calls'] += 1
+            else:
+                call.waiters += 1
+                self._counters['shared'] += 1
+        if leader:
+            try:
+                call.result = function(*args, **kwargs)
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            if call.waiters:
+                logger.info("%s concurrent callers shared the result for %s", call.waiters, key)
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def in_flight(self) -> int:
+        """
+        Returns the number of keys with a call in flight
+        :return: the count
+        """
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self) -> dict:
+        """
+        Returns a copy of the counters
+        :return: dict of 'calls' (calls made), 'shared' (callers that waited for another call) & 'in_flight'
+        """
+        with self._lock:
+            return dict(self._counters, in_flight=len(self._calls))
@@ -1 +1,20 @@
-from .config import DATABASE_PATH, API_KEY
+# config.ini is only read the first time a setting is used (see config.py), so importing a module that never needs one
+# doesn't parse it, nor fail when it is missing
+SETTINGS = frozenset((
+    'DATABASE_PATH', 'SQLITE_JOURNAL_MODE', 'SQLITE_SYNCHRONOUS', 'SQLITE_CACHE_KB', 'SQLITE_BUSY_TIMEOUT_MS',
+    'SQLITE_STATEMENT_CACHE', 'API_KEY', 'API_BASE_URL', 'API_PAGE_SIZE', 'API_STREAM_CHUNK_SIZE',
+    'HTTP_POOL_CONNECTIONS', 'HTTP_POOL_MAXSIZE', 'HTTP_POOL_BLOCK', 'HTTP_KEEP_ALIVE', 'HTTP_CONNECT_TIMEOUT',
+    'HTTP_READ_TIMEOUT', 'API_RATE_PER_SECOND', 'API_BURST', 'RETRY_MAX_ATTEMPTS', 'RETRY_BACKOFF_BASE',
+    'RETRY_BACKOFF_MAX', 'CACHE_FORMAT', 'CACHE_COMPRESSION', 'CACHE_COMPRESSION_LEVEL', 'BATCH_MAX_WORKERS',
+    'MEMORY_CACHE_MAX_BYTES', 'MEMORY_CACHE_MAX_KEYS', 'MEMORY_CACHE_TODAY_TTL', 'FRESHNESS_SETTLE_DAYS',
+    'SERVER_HOST', 'SERVER_PORT', 'PREFETCH_HOT_REPORTS', 'PREFETCH_HOT_AGENCIES', 'PREFETCH_MAX_REQUESTS',
+    'PREFETCH_STATE_PATH', 'ROW_STORE_ENABLED', 'ROLLUPS_ENABLED', 'ROLLUP_TOP_K',
+    'LOG_PATH', 'LOG_LEVEL', 'LOG_MAX_BYTES', 'LOG_ROTATE_WHEN', 'LOG_BACKUP_COUNT'))
+
+
+def __getattr__(name: str):
+    if name not in SETTINGS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from . import config as settings
+    value = globals()[name] = getattr(settings, name)
+    return value
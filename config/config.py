@@ -1,7 +1,8 @@
 import configparser as cp
 
 """
-This module is responsible for extracting configuration / environmental settings from the configuration file.
+This module is responsible for extracting configuration / environmental settings from the configuration file. It is
+imported by config/__init__.py the first time a setting is used, rather than when the config package is imported.
 
 Attributes:
 -----------
@@ -10,9 +11,112 @@ Attributes:
 
     DATABASE_PATH: holds the path of the database, from the config.ini file under the 'DATABASE' section.
     API_KEY: holds the api key
+    API_BASE_URL: base url of the DAP api (optional, 'APIKEY' section, lets us point at a local stub server)
+    HTTP_POOL_CONNECTIONS: number of per-host connection pools to cache (optional, 'HTTP' section)
+    HTTP_POOL_MAXSIZE: max number of keep-alive connections kept open per host (optional, 'HTTP' section)
+    HTTP_POOL_BLOCK: whether to block when the pool is exhausted instead of opening extra connections (optional)
+    HTTP_KEEP_ALIVE: whether connections are kept alive between requests (optional, 'HTTP' section)
+    HTTP_CONNECT_TIMEOUT: seconds to wait for a connection to be established (optional, 'HTTP' section)
+    HTTP_READ_TIMEOUT: seconds to wait for the server to send data (optional, 'HTTP' section)
+    API_RATE_PER_SECOND: sustained number of api requests allowed per second, 0 to disable (optional, 'RATELIMIT')
+    API_BURST: number of api requests allowed back to back before the rate applies (optional, 'RATELIMIT' section)
+    RETRY_MAX_ATTEMPTS: total attempts for a retryable api failure, including the first (optional, 'RETRY' section)
+    RETRY_BACKOFF_BASE: seconds to wait before the first retry, doubled each attempt (optional, 'RETRY' section)
+    RETRY_BACKOFF_MAX: upper bound on a single backoff / Retry-After wait, in seconds (optional, 'RETRY' section)
+    API_PAGE_SIZE: records requested per page (the api's 'limit'), 0 to fetch everything in one request (optional,
+        'APIKEY' section)
+    API_STREAM_CHUNK_SIZE: bytes read from the response at a time while streaming (optional, 'APIKEY' section)
+    SQLITE_JOURNAL_MODE: sqlite journal mode for the search db (optional, 'DATABASE' section, defaults to WAL)
+    SQLITE_SYNCHRONOUS: sqlite 'synchronous' pragma (optional, 'DATABASE' section, NORMAL is safe with WAL)
+    SQLITE_CACHE_KB: size of each connection's page cache in KiB (optional, 'DATABASE' section)
+    SQLITE_BUSY_TIMEOUT_MS: how long a connection waits on a locked database before failing (optional, 'DATABASE')
+    SQLITE_STATEMENT_CACHE: number of prepared statements each connection keeps (optional, 'DATABASE' section)
+    CACHE_FORMAT: file format new report caches are written in, 'jsonl', 'npz' or the legacy 'txt' (optional, 'CACHE'
+        section)
+    CACHE_COMPRESSION: codec new cache files are compressed with, 'none', 'gzip', 'bz2', 'lzma' or 'zstd' (optional,
+        'CACHE' section, zstd needs the zstandard package)
+    CACHE_COMPRESSION_LEVEL: compression level for CACHE_COMPRESSION, empty for the codec's default (optional, 'CACHE')
+    BATCH_MAX_WORKERS: max number of report/agency fetches a batch runs at once (optional, 'BATCH' section)
+    FRESHNESS_SETTLE_DAYS: days after a date before the api's data for it is considered complete, so dates fetched
+        sooner are refreshed later (optional, 'FRESHNESS' section)
+    ROW_STORE_ENABLED: also store every fetched record in the report_rows table, and answer cached lookups from it
+        (optional, 'ROW_STORE' section, defaults to False)
+    ROLLUPS_ENABLED: update the rollup tables as keys are fetched (optional, 'ROLLUPS' section, defaults to True)
+    ROLLUP_TOP_K: number of top values of each text field kept per key in the rollups (optional, 'ROLLUPS' section)
+    PREFETCH_HOT_REPORTS: comma separated reports to prefetch first, hottest first (optional, 'PREFETCH' section)
+    PREFETCH_HOT_AGENCIES: comma separated agencies to prefetch first, hottest first (optional, 'PREFETCH' section)
+    PREFETCH_MAX_REQUESTS: max api requests a prefetch run may make, 0 for no limit (optional, 'PREFETCH' section)
+    PREFETCH_STATE_PATH: file a prefetch run records its progress in, so a killed run can resume (optional)
+    SERVER_HOST: address the http query service listens on (optional, 'SERVER' section, localhost by default)
+    SERVER_PORT: port the http query service listens on (optional, 'SERVER' section)
+    MEMORY_CACHE_MAX_BYTES: approximate memory budget of the in-process record cache, 0 to disable it (optional,
+        'MEMORY_CACHE' section)
+    MEMORY_CACHE_MAX_KEYS: max number of report/agency/date -> file name entries kept in memory (optional)
+    MEMORY_CACHE_TODAY_TTL: seconds cached data for today's date is trusted, since it can still change (optional)
+    LOG_PATH: file the application log is written to, its directory is created if needed (optional, 'LOGGING' section)
+    LOG_LEVEL: minimum level that is logged, e.g. INFO or WARNING (optional, 'LOGGING' section)
+    LOG_MAX_BYTES: the log is rotated once it reaches this size, 0 to never rotate on size (optional, 'LOGGING')
+    LOG_ROTATE_WHEN: rotate the log on time instead of size, e.g. 'midnight' or 'h' (optional, 'LOGGING' section, see
+        logging.handlers.TimedRotatingFileHandler)
+    LOG_BACKUP_COUNT: number of rotated log files kept (optional, 'LOGGING' section)
 """
 
 config = cp.ConfigParser()
 config.read('config.ini')
 DATABASE_PATH = config.get('DATABASE', 'path')
+SQLITE_JOURNAL_MODE = config.get('DATABASE', 'journal_mode', fallback='WAL')
+SQLITE_SYNCHRONOUS = config.get('DATABASE', 'synchronous', fallback='NORMAL')
+SQLITE_CACHE_KB = config.getint('DATABASE', 'cache_kb', fallback=8192)
+SQLITE_BUSY_TIMEOUT_MS = config.getint('DATABASE', 'busy_timeout_ms', fallback=5000)
+SQLITE_STATEMENT_CACHE = config.getint('DATABASE', 'statement_cache', fallback=32)
 API_KEY = config.get('APIKEY', 'key')
+API_BASE_URL = config.get('APIKEY', 'base_url', fallback="https://api.gsa.gov/analytics/dap/v1.1")
+API_PAGE_SIZE = config.getint('APIKEY', 'page_size', fallback=1000)
+API_STREAM_CHUNK_SIZE = config.getint('APIKEY', 'stream_chunk_size', fallback=64 * 1024)
+
+HTTP_POOL_CONNECTIONS = config.getint('HTTP', 'pool_connections', fallback=4)
+HTTP_POOL_MAXSIZE = config.getint('HTTP', 'pool_maxsize', fallback=16)
+HTTP_POOL_BLOCK = config.getboolean('HTTP', 'pool_block', fallback=True)
+HTTP_KEEP_ALIVE = config.getboolean('HTTP', 'keep_alive', fallback=True)
+HTTP_CONNECT_TIMEOUT = config.getfloat('HTTP', 'connect_timeout', fallback=5.0)
+HTTP_READ_TIMEOUT = config.getfloat('HTTP', 'read_timeout', fallback=60.0)
+
+API_RATE_PER_SECOND = config.getfloat('RATELIMIT', 'requests_per_second', fallback=10.0)
+API_BURST = config.getint('RATELIMIT', 'burst', fallback=10)
+RETRY_MAX_ATTEMPTS = config.getint('RETRY', 'max_attempts', fallback=5)
+RETRY_BACKOFF_BASE = config.getfloat('RETRY', 'backoff_base', fallback=0.5)
+RETRY_BACKOFF_MAX = config.getfloat('RETRY', 'backoff_max', fallback=30.0)
+
+CACHE_FORMAT = config.get('CACHE', 'format', fallback='jsonl')
+CACHE_COMPRESSION = config.get('CACHE', 'compression', fallback='none')
+CACHE_COMPRESSION_LEVEL = config.getint('CACHE', 'compression_level', fallback=None) \
+    if config.get('CACHE', 'compression_level', fallback='') else None
+
+BATCH_MAX_WORKERS = config.getint('BATCH', 'max_workers', fallback=8)
+
+FRESHNESS_SETTLE_DAYS = config.getint('FRESHNESS', 'settle_days', fallback=2)
+
+ROW_STORE_ENABLED = config.getboolean('ROW_STORE', 'enabled', fallback=False)
+
+ROLLUPS_ENABLED = config.getboolean('ROLLUPS', 'enabled', fallback=True)
+ROLLUP_TOP_K = config.getint('ROLLUPS', 'top_k', fallback=10)
+
+PREFETCH_HOT_REPORTS = [name.strip() for name in config.get('PREFETCH', 'hot_reports', fallback='').split(',')
+                        if name.strip()]
+PREFETCH_HOT_AGENCIES = [name.strip() for name in config.get('PREFETCH', 'hot_agencies', fallback='').split(',')
+                         if name.strip()]
+PREFETCH_MAX_REQUESTS = config.getint('PREFETCH', 'max_requests', fallback=0)
+PREFETCH_STATE_PATH = config.get('PREFETCH', 'state_path', fallback='database/prefetch_state.json')
+
+SERVER_HOST = config.get('SERVER', 'host', fallback='127.0.0.1')
+SERVER_PORT = config.getint('SERVER', 'port', fallback=8080)
+
+MEMORY_CACHE_MAX_BYTES = config.getint('MEMORY_CACHE', 'max_bytes', fallback=64 * 1024 * 1024)
+MEMORY_CACHE_MAX_KEYS = config.getint('MEMORY_CACHE', 'max_keys', fallback=10_000)
+MEMORY_CACHE_TODAY_TTL = config.getfloat('MEMORY_CACHE', 'today_ttl', fallback=300.0)
+
+LOG_PATH = config.get('LOGGING', 'path', fallback='logs/app.log')
+LOG_LEVEL = config.get('LOGGING', 'level', fallback='INFO').upper()
+LOG_MAX_BYTES = config.getint('LOGGING', 'max_bytes', fallback=10 * 1024 * 1024)
+LOG_ROTATE_WHEN = config.get('LOGGING', 'rotate_when', fallback='')
+LOG_BACKUP_COUNT = config.getint('LOGGING', 'backup_count', fallback=5)
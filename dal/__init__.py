@@ -1,3 +1,28 @@
-from .api_dal import *
-from .sqlite_dal import execute
-from .txt_dal import save_json_to_txt, read_from_txt, build_file_name
\ No newline at end of file
+from .rate_limit import get_request_stats, track_requests
+from .sqlite_dal import execute, execute_iter, executemany, transaction, close_connections as close_db_connections
+from .txt_dal import save_json_by_date, iter_from_txt, read_fields, convert_cache_file, build_file_name, \
+    check_if_file_exists, is_temp_file, CACHE_DIRECTORY
+from .cache_formats import FORMATS, get_format, get_format_for_file
+from .compression import CODECS, get_codec, get_codec_for_file
+from .line_index import remove_line_index, INDEX_SUFFIX
+from .file_lock import report_lock, lock_path, prune_lock_files, claim_run_marker, LOCK_DIRECTORY, RUN_DIRECTORY
+
+# api_dal imports requests (most of the app's startup time), so it is only imported the first time one of its names is
+# used: runs answered from the cache never load the network stack
+API_NAMES = frozenset(('make_request', 'make_conditional_request', 'build_page_params', 'iter_pages',
+                       'close_connections', 'ConnectionFactory', 'RestAPIConnectionFactory', 'RestAPIConnection',
+                       'APIAdapter', 'OpenDataAPIAdapter', 'ConditionalResponse', 'GOOD_RESPONSE_CODE',
+                       'NOT_MODIFIED_RESPONSE_CODE'))
+# the shared rate limiter and retry policy are built from config.ini when first used
+RATE_LIMIT_NAMES = frozenset(('RATE_LIMITER', 'RETRY_POLICY'))
+
+
+def __getattr__(name: str):
+    if name in API_NAMES:
+        from . import api_dal as module
+    elif name in RATE_LIMIT_NAMES:
+        from . import rate_limit as module
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = globals()[name] = getattr(module, name)
+    return value
@@ -1,6 +1,12 @@
+import atexit
+import threading
+import time
 import requests
-from config import API_KEY
+from requests.adapters import HTTPAdapter
+import config
 from exceptions import DalException
+from .json_stream import iter_json_array
+from .rate_limit import RATE_LIMITER, RETRY_POLICY, REQUEST_STATS
 from logging_config import get_logger
 from abc import ABC, abstractmethod
 
@@ -11,29 +17,44 @@ may occur.
 
 Methods:
 --------
-    make_request(report_name: str, agency_name: str, params=None):
-            Instantiates the Factory & Adapter, returns the result of the API request or handles errors
+    make_request(report_name: str, agency_name: str, params=None, stream: bool = False, headers=None):
+            Instantiates the Factory & Adapter, returns the result of the API request (retrying transient failures
+            with backoff) or handles errors
+    make_conditional_request(report_name: str, agency_name: str, params=None, etag: str = None,
+                             last_modified: str = None, page_size: int = None) -> ConditionalResponse:
+            Requests a report page by page, but only if it changed since the given validators
+    build_page_params(params, page_size: int, page: int) -> dict:
+            Adds the paging params to a copy of the search params
+    iter_pages(report_name: str, agency_name: str, params, page_size: int, response):
+            Yields the records of response, then keeps requesting pages until a short page comes back
+    close_connections():
+            Closes every shared connection handed out by RestAPIConnectionFactory (registered with atexit)
 
 Classes:
 ---------
     ConnectionFactory(ABC):
         Abstract class that models a connection factory
     RestAPIConnectionFactory(ConnectionFactory):
-        Instantiates the RestAPIConnection class
+        Hands out a shared RestAPIConnection per base url
     RestAPIConnection:
-        Holds base url for our api connection
+        Holds base url for our api connection, and owns a pooled keep-alive requests.Session
     APIAdapter(ABC):
         Abstract class that models an API adapter
     OpenDataAPIAdapter(APIAdapter):
-    
+        Builds DAP api queries, and sends them through the shared rate limiter
+    ConditionalResponse:
+        The outcome of a conditional request: either "not modified", or the new records and (if they cover the whole
+        report) their validators
 
 Constants:
 -----------
     GOOD_RESPONSE_CODE: the response code we want from the api (200)
+    NOT_MODIFIED_RESPONSE_CODE: the response code to a conditional request whose data hasn't changed (304)
     
 """
 logger = get_logger(__name__)
 GOOD_RESPONSE_CODE = 200
+NOT_MODIFIED_RESPONSE_CODE = 304
 
 
 # Factory classes
@@ -44,24 +65,94 @@ class ConnectionFactory(ABC):
 
 
 class RestAPIConnectionFactory(ConnectionFactory):
+    _connections = {}
+    _lock = threading.Lock()
+
     def create_connection(self, base_url: str):
         """
-        Instantiates the RestAPIConnection class
+        Returns the shared RestAPIConnection for base_url, instantiating it on first use so every request to the same
+            host reuses one connection pool.
         :param base_url: base url for the API query
-        :return: an instance of the RestAPIConnection class.
+        :return: the shared instance of the RestAPIConnection class.
+        """
+        with self._lock:
+            connection = self._connections.get(base_url)
+            if connection is None or connection.closed:
+                connection = RestAPIConnection(base_url)
+                self._connections[base_url] = connection
+            return connection
+
+    @classmethod
+    def close_all(cls):
+        """
+        Closes every connection this factory has handed out.
+        :return: n/a
         """
-        return RestAPIConnection(base_url)
+        with cls._lock:
+            for connection in cls._connections.values():
+                connection.close()
+            cls._connections.clear()
 
 
 class RestAPIConnection:
-    def __init__(self, base_url: str):
+    def __init__(self, base_url: str, pool_connections: int = None, pool_maxsize: int = None, pool_block: bool = None,
+                 keep_alive: bool = None, connect_timeout: float = None, read_timeout: float = None):
+        """
+        Opens a pooled HTTP session. Every setting left as None defaults to its HTTP_* setting (see config).
+        :param base_url: the url every endpoint is relative to
+        :param pool_connections: number of connection pools to cache
+        :param pool_maxsize: max connections kept per pool
+        :param pool_block: wait for a free connection instead of opening an extra one
+        :param keep_alive: reuse connections between requests
+        :param connect_timeout: seconds to wait for a connection
+        :param read_timeout: seconds to wait between bytes of the response
+        """
         self.base_url = base_url
+        self.timeout = (config.HTTP_CONNECT_TIMEOUT if connect_timeout is None else connect_timeout,
+                        config.HTTP_READ_TIMEOUT if read_timeout is None else read_timeout)
+        self.closed = False
+        self.session = self.build_session(
+            config.HTTP_POOL_CONNECTIONS if pool_connections is None else pool_connections,
+            config.HTTP_POOL_MAXSIZE if pool_maxsize is None else pool_maxsize,
+            config.HTTP_POOL_BLOCK if pool_block is None else pool_block,
+            config.HTTP_KEEP_ALIVE if keep_alive is None else keep_alive)
+
+    def build_session(self, pool_connections: int, pool_maxsize: int, pool_block: bool,
+                      keep_alive: bool) -> requests.Session:
+        """
+        Builds a requests.Session backed by a bounded urllib3 connection pool.
+        :param pool_connections: number of per-host pools to cache
+        :param pool_maxsize: max number of connections kept open per host
+        :param pool_block: block when the pool is exhausted instead of opening throwaway connections
+        :param keep_alive: if false, every response closes its connection
+        :return: the configured session
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        logger.info("Opened HTTP session for %s (pool_maxsize=%s, timeout=%s)", self.base_url, pool_maxsize,
+                    self.timeout)
+        return session
+
+    def close(self):
+        """
+        Closes the session and every pooled connection it holds.
+        :return: n/a
+        """
+        if not self.closed:
+            self.session.close()
+            self.closed = True
+            logger.info("Closed HTTP session for %s", self.base_url)
 
 
 # Adapter Classes
 class APIAdapter(ABC):
-    def __init__(self, connection: RestAPIConnection):
+    def __init__(self, connection: RestAPIConnection, rate_limiter=RATE_LIMITER):
         self.connection = connection
+        self.rate_limiter = rate_limiter
 
     @abstractmethod
     def send_request(self, *args, **kwargs):
@@ -69,7 +160,7 @@ class APIAdapter(ABC):
 
 
 class OpenDataAPIAdapter(APIAdapter):
-    BASE_URL = "https://api.gsa.gov/analytics/dap/v1.1"
+    BASE_URL = None  # overrides API_BASE_URL (see config) when set
     AGENCIES_ENDPOINT = "/agencies/1/reports/2/data"  # /agencies/<agency name>/reports/<report name>/data
 
     def fix_endpoint(self, report_name: str, agency_name: str) -> str:
@@ -82,55 +173,187 @@ class OpenDataAPIAdapter(APIAdapter):
         endpoint = self.AGENCIES_ENDPOINT.replace('1', agency_name)
         return endpoint.replace('2', report_name)
 
-    def send_request(self, url: str, headers: dict, params=None):
+    def send_request(self, url: str, headers: dict, params=None, stream: bool = False):
         """
-        Performs the API request
+        Waits for the rate limiter, then performs the API request
         :param url: base url + endpoint
         :param headers: dict containing the api key
         :param params: dict containing search params
+        :param stream: if true, the body is left on the socket to be read incrementally
         :return: results for the api request
         """
-        return requests.get(url, headers=headers, params=params)
+        self.rate_limiter.acquire()
+        REQUEST_STATS.increment('requests')
+        return self.connection.session.get(url, headers=headers, params=params, timeout=self.connection.timeout,
+                                           stream=stream)
 
-    def get_data(self, report_name: str, agency_name: str, header: dict, params=None):
+    def get_data(self, report_name: str, agency_name: str, header: dict, params=None, stream: bool = False):
         """
         Builds the API query and calls self.send_request() to perform the get request.
         :param report_name: report name the user is searching for
         :param agency_name: agency name the user is searching for
         :param header: header containing API key
         :param params: params for the API query
+        :param stream: if true, the response body is streamed instead of read up front
         :return: calls send_request
         """
         url = f"{self.connection.base_url}{self.fix_endpoint(report_name, agency_name)}"
-        return self.send_request(url, headers=header, params=params)
+        return self.send_request(url, headers=header, params=params, stream=stream)
 
 
-def make_request(report_name: str, agency_name: str, params=None):
+def make_request(report_name: str, agency_name: str, params=None, stream: bool = False, headers=None):
     """
-    Instantiates the Factory & Adapter, returns the result of the API request or handles errors
+    Instantiates the Factory & Adapter, returns the result of the API request or handles errors. Throttled responses
+        (429), transient server errors (5xx), timeouts and dropped connections are retried with exponential backoff,
+        honoring the Retry-After header, up to RETRY_POLICY.max_attempts attempts.
     :param report_name: report name the user is searching for
     :param agency_name: agency name the user is searching for
     :param params: dict of search parameters.
+    :param stream: if true, the response body is left unread so it can be streamed (caller must close the response)
+    :param headers: (optional) extra request headers, e.g. If-None-Match (a 304 is then returned, not raised)
     :return: response from api
     """
     factory = RestAPIConnectionFactory()
-    connection = factory.create_connection(OpenDataAPIAdapter.BASE_URL)
+    connection = factory.create_connection(OpenDataAPIAdapter.BASE_URL or config.API_BASE_URL)
     adapter = OpenDataAPIAdapter(connection)
-    headers = {'x-api-key': API_KEY}
-    try:
-        response = adapter.get_data(report_name, agency_name, headers, params)
-        if response.status_code == GOOD_RESPONSE_CODE:
-            return response
-        else:
-            logger.error("Bad response code from API")
+    conditional = bool(headers) and ('If-None-Match' in headers or 'If-Modified-Since' in headers)
+    headers = dict(headers or {}, **{'x-api-key': config.API_KEY})
+    for attempt in range(1, RETRY_POLICY.max_attempts + 1):
+        retry_after = None
+        try:
+            response = adapter.get_data(report_name, agency_name, headers, params, stream)
+            if response.status_code == GOOD_RESPONSE_CODE or \
+                    (conditional and response.status_code == NOT_MODIFIED_RESPONSE_CODE):
+                return response
+            response.close()
+            if not RETRY_POLICY.is_retryable_status(response.status_code):
+                logger.error("Bad response code from API: %s", response.status_code)
+                raise DalException(f"Bad response code from API: {response.status_code}")
+            retry_after = response.headers.get('Retry-After')
+            failure = f"response code {response.status_code}"
+        except requests.Timeout as time_out:
+            failure = f"timeout: {time_out}"
+        except requests.ConnectionError as connection_error:
+            failure = f"connection error: {connection_error}"
+        except requests.RequestException as e:
+            logger.error("Request failed: %s", e)
             raise DalException
-    except requests.Timeout as time_out:
-        logger.error(f"Request timed out: {time_out}")
-        raise DalException
-    except requests.ConnectionError as connection_error:
-        logger.error(f"Connection failed: {connection_error}")
-        raise DalException
-    except requests.RequestException as e:
-        logger.error(f"Request failed: {e}")
-        raise DalException
+        if attempt == RETRY_POLICY.max_attempts:
+            break
+        delay = RETRY_POLICY.get_delay(attempt, retry_after)
+        logger.warning("Attempt %s for %s/%s failed (%s), retrying in %.2fs",
+                       attempt, report_name, agency_name, failure, delay)
+        REQUEST_STATS.increment('retries')
+        if retry_after is not None:
+            # the server asked everyone to slow down, not just this request
+            adapter.rate_limiter.pause(delay)
+        else:
+            time.sleep(delay)
+    REQUEST_STATS.increment('give_ups')
+    logger.error("Giving up on %s/%s after %s attempts (%s)",
+                 report_name, agency_name, RETRY_POLICY.max_attempts, failure)
+    raise DalException(f"Request failed after {RETRY_POLICY.max_attempts} attempts ({failure})")
+
+
+class ConditionalResponse:
+    def __init__(self, not_modified: bool, etag: str = None, last_modified: str = None, records=()):
+        self.not_modified = not_modified
+        self.etag = etag
+        self.last_modified = last_modified
+        self.records = records
+
+
+def make_conditional_request(report_name: str, agency_name: str, params=None, etag: str = None,
+                             last_modified: str = None, page_size: int = None) -> ConditionalResponse:
+    """
+    Requests a report page by page (the api's 'limit' & 'page' params), decoding each page as it streams, so memory is
+        bounded by a single page rather than the whole report. The first page is requested straight away so a bad
+        request fails here, before the caller starts writing anything.
+        The validators of an earlier response are sent along (If-None-Match / If-Modified-Since), so data that hasn't
+        changed costs a 304 instead of a download. A response's validators only vouch for that response, not for the
+        pages after it, so a request with validators is sent unpaged, and the validators of a paged response are
+        dropped (None): only validators that cover the whole report are returned. Servers that ignore the validators
+        just answer 200, and the report is downloaded as usual.
+    :param report_name: report name the user is searching for
+    :param agency_name: agency name the user is searching for
+    :param params: dict of search parameters (limit & page are added to it)
+    :param etag: the ETag of the earlier response (or None)
+    :param last_modified: the Last-Modified of the earlier response (or None)
+    :param page_size: records per page (defaults to API_PAGE_SIZE), 0 fetches everything in a single (still streamed)
+        request; ignored (0) when validators are given
+    :return: a ConditionalResponse (records is a generator, unless not_modified)
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    if headers:
+        page_size = 0
+    elif page_size is None:
+        page_size = config.API_PAGE_SIZE
+    first_page = make_request(report_name, agency_name, build_page_params(params, page_size, 1), stream=True,
+                              headers=headers)
+    if first_page.status_code == NOT_MODIFIED_RESPONSE_CODE:
+        first_page.close()
+        logger.info("%s/%s %s has not changed (304)", report_name, agency_name, params)
+        return ConditionalResponse(True, first_page.headers.get('ETag', etag),
+                                   first_page.headers.get('Last-Modified', last_modified))
+    records = iter_pages(report_name, agency_name, params, page_size, first_page)
+    if page_size > 0:  # the validators of the first page don't cover the pages after it
+        return ConditionalResponse(False, records=records)
+    return ConditionalResponse(False, first_page.headers.get('ETag'), first_page.headers.get('Last-Modified'), records)
+
+
+def build_page_params(params, page_size: int, page: int) -> dict:
+    """
+    Adds the paging params to a copy of the search params
+    :param params: dict of search parameters (or None)
+    :param page_size: records per page, 0 for no paging
+    :param page: page number, starting at 1
+    :return: the params dict for that page
+    """
+    page_params = dict(params or {})
+    if page_size > 0:
+        page_params.update(limit=page_size, page=page)
+    return page_params
+
+
+def iter_pages(report_name: str, agency_name: str, params, page_size: int, response):
+    """
+    Yields the records of response, then keeps requesting the next page until a short (or empty) page comes back
+    :param report_name: report name the user is searching for
+    :param agency_name: agency name the user is searching for
+    :param params: dict of search parameters
+    :param page_size: records per page, 0 for no paging
+    :param response: the already requested (streamed) first page
+    :return: yields one record (dict) at a time
+    """
+    page = 1
+    while True:
+        count = 0
+        try:
+            for record in iter_json_array(response.iter_content(config.API_STREAM_CHUNK_SIZE)):
+                count += 1
+                yield record
+        except requests.RequestException as e:
+            logger.error("Lost connection while streaming page %s of %s/%s: %s", page, report_name, agency_name, e)
+            raise DalException(f"Lost connection while streaming the response: {e}")
+        finally:
+            response.close()
+        logger.info("Read %s records from page %s of %s/%s", count, page, report_name, agency_name)
+        if page_size <= 0 or count < page_size:
+            return
+        page += 1
+        response = make_request(report_name, agency_name, build_page_params(params, page_size, page), stream=True)
+
+
+def close_connections():
+    """
+    Closes every shared connection handed out by RestAPIConnectionFactory (registered with atexit)
+    :return: n/a
+    """
+    RestAPIConnectionFactory.close_all()
+
 
+atexit.register(close_connections)
@@ -0,0 +1,346 @@
+import ast
+import json
+from abc import ABC, abstractmethod
+from itertools import islice
+from exceptions import DalException
+from .compression import get_codec_for_file, strip_codec_suffix
+from .line_index import iter_lines
+
+"""
+This module contains the file formats the report cache can be stored in. Each format knows its file extension, how to
+write records to a file one at a time and how to read them back as dicts, lazily and optionally as an offset/limit
+slice. Line based formats can also be compressed (see compression.py), which is decided by the file name's suffix.
+
+Methods:
+--------
+    get_format(format_name: str) -> CacheFormat:
+        Returns the CacheFormat registered under format_name
+    get_format_for_file(file_name: str) -> CacheFormat:
+        Returns the CacheFormat a cache file was written in, based on its extension (ignoring any compression suffix)
+
+Classes:
+--------
+    CacheWriter(ABC):
+        Abstract class representing an open cache file that records are written to one at a time
+    CacheFormat(ABC):
+        Abstract class representing a cache file format
+    LineWriter(CacheWriter):
+        Writes one encoded record per line
+    LineFormat(CacheFormat):
+        Base class for formats that store one record per line (read lazily through mmap + a sidecar line index)
+    TxtFormat(LineFormat):
+        The original format: one python dict repr per line (read back with ast.literal_eval, never eval)
+    JsonLinesFormat(LineFormat):
+        JSON Lines: one JSON object per line
+    ColumnarWriter(CacheWriter):
+        Buffers records, then saves them as typed numpy columns on close
+    ColumnarFormat(CacheFormat):
+        Compact columnar format: one typed numpy array per report field, saved in a compressed .npz file
+
+Constants:
+----------
+    FORMATS: dict of format name -> CacheFormat instance
+    NULL_SUFFIX: suffix of the boolean column marking missing values of a column, in the columnar format
+"""
+
+NULL_SUFFIX = '__null'
+
+
+class CacheWriter(ABC):
+    @abstractmethod
+    def write(self, record: dict):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CacheFormat(ABC):
+    name = None
+    extension = None
+    compressible = True
+
+    @abstractmethod
+    def open_writer(self, file_path: str, level=None) -> CacheWriter:
+        pass
+
+    @abstractmethod
+    def iter_records(self, file_path: str):
+        pass
+
+    def iter_slice(self, file_path: str, offset: int = 0, limit: int = None):
+        """
+        Yields the records of a cache file from record number offset, at most limit records
+        :param file_path: the file to read
+        :param offset: number of records to skip
+        :param limit: max number of records to yield (None for all)
+        :return: yields records (dicts)
+        """
+        stop = None if limit is None else offset + limit
+        return islice(self.iter_records(file_path), offset, stop)
+
+    def read(self, file_path: str) -> list:
+        """
+        Reads every record of a cache file
+        :param file_path: the file to read
+        :return: list of records (dicts)
+        """
+        return list(self.iter_records(file_path))
+
+    def read_fields(self, file_path: str, field_names: list) -> dict:
+        """
+        Reads some fields of every record of a cache file, as columns
+        :param file_path: the file to read
+        :param field_names: the fields to read
+        :return: dict of field name -> sequence of values, one per record (None where a record lacks the field)
+        """
+        columns = {name: [] for name in field_names}
+        for record in self.iter_records(file_path):
+            for name, column in columns.items():
+                column.append(record.get(name))
+        return columns
+
+
+class LineWriter(CacheWriter):
+    def __init__(self, file_path: str, cache_format, level=None):
+        self.file = get_codec_for_file(file_path).open(file_path, 'wt', level)
+        self.cache_format = cache_format
+
+    def write(self, record: dict):
+        """
+        Writes one record as a line
+        :param record: the record to write
+        :return: n/a
+        """
+        self.file.write(self.cache_format.encode_line(record))
+        self.file.write('\n')
+
+    def close(self):
+        """
+        Closes the file
+        :return: n/a
+        """
+        self.file.close()
+
+
+class LineFormat(CacheFormat):
+    @abstractmethod
+    def encode_line(self, record: dict) -> str:
+        pass
+
+    @abstractmethod
+    def decode_line(self, line: str) -> dict:
+        pass
+
+    def open_writer(self, file_path: str, level=None) -> CacheWriter:
+        """
+        Opens a cache file for writing, compressed with the codec its suffix names (if any)
+        :param file_path: the file to write
+        :param level: compression level (None for the codec's default)
+        :return: a LineWriter
+        """
+        return LineWriter(file_path, self, level)
+
+    def iter_records(self, file_path: str):
+        """
+        Yields the records of a cache file one line at a time
+        :param file_path: the file to read
+        :return: yields records (dicts)
+        """
+        return self.iter_slice(file_path)
+
+    def iter_slice(self, file_path: str, offset: int = 0, limit: int = None):
+        """
+        Yields the records of a cache file from line number offset, at most limit records. Blank lines are skipped
+            (pycharm likes to add a blank line at the end of files...), and a slice that doesn't start at the top seeks
+            straight to its first line through the file's line index. Compressed files can't be mmapped or seeked into,
+            so they are decompressed as a stream and the slice skips lines on the way.
+        :param file_path: the file to read
+        :param offset: number of records to skip
+        :param limit: max number of records to yield (None for all)
+        :return: yields records (dicts)
+        """
+        codec = get_codec_for_file(file_path)
+        if not codec.suffix:
+            for line in iter_lines(file_path, offset, limit):
+                yield self.decode_line(line)
+            return
+        stop = None if limit is None else offset + limit
+        with codec.open(file_path, 'rt') as file:
+            lines = (line.rstrip('\r\n') for line in file)
+            for line in islice((line for line in lines if line), offset, stop):
+                yield self.decode_line(line)
+
+
+class TxtFormat(LineFormat):
+    name = 'txt'
+    extension = '.txt'
+
+    def encode_line(self, record: dict) -> str:
+        return f"{record}"
+
+    def decode_line(self, line: str) -> dict:
+        return ast.literal_eval(line)
+
+
+class JsonLinesFormat(LineFormat):
+    name = 'jsonl'
+    extension = '.jsonl'
+
+    def __init__(self):
+        self.encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+        self.decoder = json.JSONDecoder()
+
+    def encode_line(self, record: dict) -> str:
+        return self.encoder.encode(record)
+
+    def decode_line(self, line: str) -> dict:
+        return self.decoder.decode(line)
+
+
+class ColumnarWriter(CacheWriter):
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.records = []
+
+    def write(self, record: dict):
+        """
+        Buffers a record (columns can only be typed once every value is known)
+        :param record: the record to write
+        :return: n/a
+        """
+        self.records.append(record)
+
+    def close(self):
+        """
+        Saves the buffered records as one typed numpy array per field
+        :return: n/a
+        """
+        np = ColumnarFormat.import_numpy()
+        field_names = []
+        for record in self.records:
+            for field_name in record:
+                if field_name not in field_names:
+                    field_names.append(field_name)
+        columns = {}
+        for field_name in field_names:
+            values = [record.get(field_name) for record in self.records]
+            nulls = [value is None for value in values]
+            present = [value for value in values if value is not None]
+            if present and all(type(value) is int for value in present):
+                columns[field_name] = np.array([0 if value is None else value for value in values], dtype=np.int64)
+            elif present and all(type(value) in (int, float) for value in present):
+                columns[field_name] = np.array([float('nan') if value is None else value for value in values],
+                                               dtype=np.float64)
+            elif present and all(type(value) is bool for value in present):
+                columns[field_name] = np.array([bool(value) for value in values], dtype=np.bool_)
+            else:
+                columns[field_name] = np.array(['' if value is None else f"{value}" for value in values], dtype=np.str_)
+            if any(nulls):
+                columns[field_name + NULL_SUFFIX] = np.array(nulls, dtype=np.bool_)
+        columns['__fields__'] = np.array(field_names, dtype=np.str_)
+        with open(self.file_path, 'wb') as file:
+            np.savez_compressed(file, **columns)
+        self.records = []
+
+
+class ColumnarFormat(CacheFormat):
+    name = 'npz'
+    extension = '.npz'
+    compressible = False  # columns are already compressed inside the .npz
+
+    @staticmethod
+    def import_numpy():
+        """
+        Imports numpy, which is only needed for this format
+        :return: the numpy module
+        """
+        try:
+            import numpy
+            return numpy
+        except ImportError:
+            raise DalException("The 'npz' cache format requires numpy (pip install numpy)")
+
+    def open_writer(self, file_path: str, level=None) -> CacheWriter:
+        """
+        Opens a cache file for writing
+        :param file_path: the file to write
+        :param level: ignored, the columns are always zip compressed
+        :return: a ColumnarWriter
+        """
+        return ColumnarWriter(file_path)
+
+    def read_columns(self, file_path: str) -> dict:
+        """
+        Reads a cache file as typed columns, without building per-record dicts
+        :param file_path: the file to read
+        :return: dict of field name -> numpy array (missing values are flagged in the field's NULL_SUFFIX column, and
+            '__fields__' holds the field names in their original order)
+        """
+        np = self.import_numpy()
+        with np.load(file_path, allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}
+
+    def read_fields(self, file_path: str, field_names: list) -> dict:
+        """
+        Reads some fields of every record of a cache file straight from its typed columns, without rebuilding records
+        :param file_path: the file to read
+        :param field_names: the fields to read
+        :return: dict of field name -> numpy array (a list of None for fields the file doesn't have; missing values of
+            a field that is there read as its column's filler, 0 or '')
+        """
+        np = self.import_numpy()
+        with np.load(file_path, allow_pickle=False) as data:  # only the wanted columns are decompressed
+            stored = data['__fields__'].tolist()
+            row_count = len(data[stored[0]]) if stored else 0
+            return {name: data[name] if name in stored else [None] * row_count for name in field_names}
+
+    def iter_records(self, file_path: str):
+        """
+        Yields the records of a cache file, rebuilt from its columns
+        :param file_path: the file to read
+        :return: yields records (dicts)
+        """
+        columns = self.read_columns(file_path)
+        field_names = columns['__fields__'].tolist()
+        values = {name: columns[name].tolist() for name in field_names}
+        nulls = {name: columns[name + NULL_SUFFIX].tolist() for name in field_names
+                 if name + NULL_SUFFIX in columns}
+        row_count = len(values[field_names[0]]) if field_names else 0
+        for row in range(row_count):
+            yield {name: values[name][row] for name in field_names if not (name in nulls and nulls[name][row])}
+
+
+FORMATS = {cache_format.name: cache_format for cache_format in (TxtFormat(), JsonLinesFormat(), ColumnarFormat())}
+
+
+def get_format(format_name: str) -> CacheFormat:
+    """
+    Returns the CacheFormat registered under format_name
+    :param format_name: 'txt', 'jsonl' or 'npz'
+    :return: the CacheFormat
+    """
+    try:
+        return FORMATS[format_name]
+    except KeyError:
+        raise DalException(f"Unknown cache format '{format_name}', expected one of {list(FORMATS)}")
+
+
+def get_format_for_file(file_name: str) -> CacheFormat:
+    """
+    Returns the CacheFormat a cache file was written in, based on its extension (ignoring any compression suffix)
+    :param file_name: the cache file's name
+    :return: the CacheFormat
+    """
+    base_name = strip_codec_suffix(file_name)
+    for cache_format in FORMATS.values():
+        if base_name.endswith(cache_format.extension):
+            return cache_format
+    raise DalException(f"Don't know which cache format {file_name} is in")
@@ -0,0 +1,200 @@
+import bz2
+import gzip
+import lzma
+from abc import ABC, abstractmethod
+from exceptions import DalException
+
+"""
+This module contains the compression codecs cache files can be written with. A codec adds a suffix to the file name
+(e.g. ".jsonl.gz"), which is how a file's codec is recognised again when it is read.
+
+Methods:
+--------
+    get_codec(codec_name: str) -> Codec:
+        Returns the Codec registered under codec_name
+    get_codec_for_file(file_name: str) -> Codec:
+        Returns the Codec a cache file was written with, based on its suffix
+    strip_codec_suffix(file_name: str) -> str:
+        Returns file_name without its compression suffix
+
+Classes:
+--------
+    Codec(ABC):
+        Abstract class representing a compression codec
+    NoCompression(Codec):
+        Plain, uncompressed files
+    GzipCodec(Codec):
+        gzip (.gz), levels 1-9
+    Bz2Codec(Codec):
+        bzip2 (.bz2), levels 1-9
+    LzmaCodec(Codec):
+        xz / lzma (.xz), presets 0-9
+    ZstdCodec(Codec):
+        zstandard (.zst), levels 1-22, only available when the optional zstandard package is installed
+
+Constants:
+----------
+    CODECS: dict of codec name -> Codec instance
+"""
+
+
+class Codec(ABC):
+    name = None
+    suffix = ''
+
+    @abstractmethod
+    def open(self, file_path: str, mode: str, level=None):
+        pass
+
+    def is_available(self) -> bool:
+        """
+        Checks if the codec can be used in this environment
+        :return: true if available
+        """
+        return True
+
+    @staticmethod
+    def text_mode_kwargs(mode: str) -> dict:
+        """
+        Returns the extra open() arguments for text mode (utf-8, newlines written as-is)
+        :param mode: the open mode
+        :return: dict of keyword arguments
+        """
+        return {'encoding': 'utf-8', 'newline': ''} if 't' in mode else {}
+
+
+class NoCompression(Codec):
+    name = 'none'
+
+    def open(self, file_path: str, mode: str, level=None):
+        """
+        Opens an uncompressed file
+        :param file_path: the file to open
+        :param mode: 'rt', 'wt', 'rb' or 'wb'
+        :param level: ignored
+        :return: the file object
+        """
+        return open(file_path, mode, **self.text_mode_kwargs(mode))
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    suffix = '.gz'
+
+    def open(self, file_path: str, mode: str, level=None):
+        """
+        Opens a gzip compressed file
+        :param file_path: the file to open
+        :param mode: 'rt', 'wt', 'rb' or 'wb'
+        :param level: compression level 1-9 (None for the default, 6)
+        :return: the file object
+        """
+        return gzip.open(file_path, mode, compresslevel=6 if level is None else level, **self.text_mode_kwargs(mode))
+
+
+class Bz2Codec(Codec):
+    name = 'bz2'
+    suffix = '.bz2'
+
+    def open(self, file_path: str, mode: str, level=None):
+        """
+        Opens a bzip2 compressed file
+        :param file_path: the file to open
+        :param mode: 'rt', 'wt', 'rb' or 'wb'
+        :param level: compression level 1-9 (None for the default, 9)
+        :return: the file object
+        """
+        return bz2.open(file_path, mode, compresslevel=9 if level is None else level, **self.text_mode_kwargs(mode))
+
+
+class LzmaCodec(Codec):
+    name = 'lzma'
+    suffix = '.xz'
+
+    def open(self, file_path: str, mode: str, level=None):
+        """
+        Opens an xz / lzma compressed file
+        :param file_path: the file to open
+        :param mode: 'rt', 'wt', 'rb' or 'wb'
+        :param level: preset 0-9 (None for the default, 6)
+        :return: the file object
+        """
+        preset = level if 'w' in mode else None
+        return lzma.open(file_path, mode, preset=preset, **self.text_mode_kwargs(mode))
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    suffix = '.zst'
+
+    @staticmethod
+    def import_zstandard():
+        """
+        Imports zstandard, which is an optional dependency
+        :return: the zstandard module
+        """
+        try:
+            import zstandard
+            return zstandard
+        except ImportError:
+            raise DalException("The 'zstd' codec requires the zstandard package (pip install zstandard)")
+
+    def is_available(self) -> bool:
+        """
+        Checks if the zstandard package is installed
+        :return: true if available
+        """
+        try:
+            self.import_zstandard()
+            return True
+        except DalException:
+            return False
+
+    def open(self, file_path: str, mode: str, level=None):
+        """
+        Opens a zstandard compressed file
+        :param file_path: the file to open
+        :param mode: 'rt', 'wt', 'rb' or 'wb'
+        :param level: compression level 1-22 (None for the default, 3)
+        :return: the file object
+        """
+        zstandard = self.import_zstandard()
+        cctx = zstandard.ZstdCompressor(level=3 if level is None else level) if 'w' in mode else None
+        return zstandard.open(file_path, mode, cctx=cctx, **self.text_mode_kwargs(mode))
+
+
+CODECS = {codec.name: codec for codec in (NoCompression(), GzipCodec(), Bz2Codec(), LzmaCodec(), ZstdCodec())}
+
+
+def get_codec(codec_name: str) -> Codec:
+    """
+    Returns the Codec registered under codec_name
+    :param codec_name: 'none', 'gzip', 'bz2', 'lzma' or 'zstd'
+    :return: the Codec
+    """
+    try:
+        return CODECS[codec_name]
+    except KeyError:
+        raise DalException(f"Unknown compression codec '{codec_name}', expected one of {list(CODECS)}")
+
+
+def get_codec_for_file(file_name: str) -> Codec:
+    """
+    Returns the Codec a cache file was written with, based on its suffix
+    :param file_name: the cache file's name
+    :return: the Codec (NoCompression if there is no compression suffix)
+    """
+    for codec in CODECS.values():
+        if codec.suffix and file_name.endswith(codec.suffix):
+            return codec
+    return CODECS['none']
+
+
+def strip_codec_suffix(file_name: str) -> str:
+    """
+    Returns file_name without its compression suffix
+    :param file_name: the cache file's name
+    :return: the file name as it would be uncompressed
+    """
+    suffix = get_codec_for_file(file_name).suffix
+    return file_name[:-len(suffix)] if suffix else file_name
@@ -0,0 +1,178 @@
+import atexit
+import os
+import re
+import threading
+from contextlib import contextmanager
+from logging_config import get_logger
+from .txt_dal import CACHE_DIRECTORY
+
+try:
+    import fcntl
+except ImportError:  # windows, where only the in-process locks below are available
+    fcntl = None
+
+"""
+This module contains advisory locks around the fetch-and-persist of cache keys, so two processes (or threads) missing
+on the same report/agency/date never both fetch and write it. Each report/agency has one lock file under
+LOCK_DIRECTORY, so there are at most as many as there are report/agency pairs, however many dates are cached; batch
+jobs are already merged per report/agency, so jobs for different pairs never wait for each other. The lock files are
+locked with fcntl.flock; flock locks belong to the open file, so they also exclude other threads of the same process.
+Lock files are never deleted (deleting a lock file someone is waiting on would let a third process in), except the
+lock files of older versions (one per key), which prune_lock_files removes.
+
+It also contains the run markers, which tell whether an earlier process exited cleanly: every process keeps a marker
+file under RUN_DIRECTORY locked while it runs and removes it when it exits. A marker nobody holds was left by a process
+that crashed or was killed (see db_service.fsck_after_crash).
+
+Methods:
+--------
+    lock_path(report_name: str, agency_name: str) -> str:
+        Returns the lock file of a report/agency
+    report_lock(report_name: str, agency_name: str):
+        Context manager holding the lock of a report/agency
+    prune_lock_files() -> int:
+        Removes the lock files left by older versions, which had one per key
+    claim_run_marker() -> bool:
+        Creates this process's run marker, and reports whether an earlier process left a stale one behind
+
+Constants:
+----------
+    LOCK_DIRECTORY: directory the lock files live in
+    OLD_LOCK_FILE: pattern of the (per-key) lock file names of older versions
+    RUN_DIRECTORY: directory the run markers live in
+"""
+
+logger = get_logger(__name__)
+
+LOCK_DIRECTORY = os.path.join(CACHE_DIRECTORY, '.locks')
+OLD_LOCK_FILE = re.compile(r'(.+_\d{4}-\d{2}-\d{2}|\d{3})\.lock')
+RUN_DIRECTORY = os.path.join(CACHE_DIRECTORY, '.running')
+
+_thread_locks = {}  # fallback when fcntl isn't available: lock file path -> threading.Lock
+_thread_locks_lock = threading.Lock()
+_run_marker = None  # this process's run marker, open (and locked) until exit
+
+
+def lock_path(report_name: str, agency_name: str) -> str:
+    """
+    Returns the lock file of a report/agency
+    :param report_name: report name
+    :param agency_name: agency name
+    :return: the lock file's path
+    """
+    return os.path.join(LOCK_DIRECTORY, f"{report_name}_{agency_name}.lock")
+
+
+@contextmanager
+def report_lock(report_name: str, agency_name: str):
+    """
+    Holds the exclusive lock of a report/agency (covering every date of it) for the duration of the with block,
+        waiting for whoever holds it now. Holders must not nest report_lock for the same report/agency: the inner one
+        would wait for the outer one.
+    :param report_name: report name
+    :param agency_name: agency name
+    :return: n/a
+    """
+    os.makedirs(LOCK_DIRECTORY, exist_ok=True)
+    lock = _acquire(lock_path(report_name, agency_name))
+    try:
+        yield
+    finally:
+        _release(lock)
+
+
+def prune_lock_files() -> int:
+    """
+    Removes the lock files left by older versions (see OLD_LOCK_FILE), which had one per key (or per hash of it). No
+        current process locks them.
+    :return: the number of lock files removed
+    """
+    try:
+        names = os.listdir(LOCK_DIRECTORY)
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    for name in names:
+        if OLD_LOCK_FILE.fullmatch(name):
+            try:
+                os.remove(os.path.join(LOCK_DIRECTORY, name))
+                removed += 1
+            except FileNotFoundError:
+                pass  # removed by another process in the meantime
+    if removed:
+        logger.info("Removed %s old lock files", removed)
+    return removed
+
+
+def _acquire(path: str):
+    if fcntl is None:
+        with _thread_locks_lock:
+            lock = _thread_locks.setdefault(path, threading.Lock())
+        lock.acquire()
+        return lock
+    file = open(path, 'a')
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+    except BaseException:
+        file.close()
+        raise
+    return file
+
+
+def _release(lock):
+    if fcntl is None:
+        lock.release()
+        return
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+    finally:
+        lock.close()
+
+
+def claim_run_marker() -> bool:
+    """
+    Creates this process's run marker, kept locked (open, on windows) until the process exits and removed at a clean
+        exit, after removing the markers nobody holds anymore: each of those was left by a process that crashed or was
+        killed. Calling it again does nothing.
+    :return: true if a stale marker was found, i.e. an earlier process didn't exit cleanly
+    """
+    global _run_marker
+    if _run_marker is not None:
+        return False
+    os.makedirs(RUN_DIRECTORY, exist_ok=True)
+    unclean = False
+    for name in os.listdir(RUN_DIRECTORY):
+        path = os.path.join(RUN_DIRECTORY, name)
+        try:
+            _remove_stale_marker(path)
+        except OSError:
+            continue  # held by a running process, or already removed by another one
+        logger.warning("Found the run marker %s of a process that didn't exit cleanly", path)
+        unclean = True
+    _run_marker = open(os.path.join(RUN_DIRECTORY, f"{os.getpid()}.run"), 'w')
+    if fcntl is not None:
+        fcntl.flock(_run_marker.fileno(), fcntl.LOCK_EX)
+    atexit.register(_release_run_marker)
+    return unclean
+
+
+def _remove_stale_marker(path: str):
+    if fcntl is None:  # windows refuses to remove a file another process has open
+        os.remove(path)
+        return
+    with open(path) as marker:
+        fcntl.flock(marker.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)  # raises if its process is still running
+        os.remove(path)
+
+
+def _release_run_marker():
+    global _run_marker
+    if _run_marker is None:
+        return
+    path = _run_marker.name
+    _run_marker.close()
+    _run_marker = None
+    try:
+        os.remove(path)
+    except OSError:
+        pass
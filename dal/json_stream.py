@@ -0,0 +1,82 @@
+import codecs
+import json
+import re
+from exceptions import DalException
+
+"""
+This module contains a small incremental JSON decoder, so a large API response can be turned into records as it is
+downloaded instead of after the whole body has been read into memory.
+
+Methods:
+--------
+    iter_json_array(chunks):
+        Yields the items of a top level JSON array, decoding them from an iterable of byte chunks
+
+Constants:
+----------
+    WHITESPACE: regex matching JSON whitespace
+    VALUE_END: regex matching the end of a scalar value (used to avoid decoding a number split across chunks)
+"""
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+VALUE_END = re.compile(r'[,\]\s]')
+
+
+def iter_json_array(chunks):
+    """
+    Yields the items of a top level JSON array, decoding them from an iterable of byte chunks. Only the current chunk
+        and the item being decoded are ever held in memory.
+    :param chunks: iterable of bytes (e.g. response.iter_content())
+    :return: yields one decoded item at a time
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    pending = []
+    pending_size = 0
+    retry_at = 0  # after a failed decode, wait until the pending text doubles so big items stay linear to decode
+    in_array = False
+    for chunk in _with_end_marker(chunks):
+        final = chunk is None
+        text = text_decoder.decode(b'' if final else chunk, final=final)
+        pending.append(text)
+        pending_size += len(text)
+        if len(buffer) - pos + pending_size < retry_at and not final:
+            continue
+        buffer = buffer[pos:] + ''.join(pending)
+        pending = []
+        pending_size = 0
+        pos = 0
+        while True:
+            pos = WHITESPACE.match(buffer, pos).end()
+            if pos >= len(buffer):
+                break
+            char = buffer[pos]
+            if not in_array:
+                if char != '[':
+                    raise DalException(f"Expected a JSON array from the API, got {buffer[pos:pos + 80]!r}")
+                in_array = True
+                pos += 1
+                continue
+            if char == ']':
+                return
+            if char == ',':
+                pos += 1
+                continue
+            if char not in '{["' and not final and not VALUE_END.search(buffer, pos):
+                break  # a bare number / literal might continue in the next chunk
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                if final:
+                    raise DalException(f"Could not decode API response: {e}")
+                retry_at = 2 * (len(buffer) - pos)
+                break  # item is incomplete, wait for more chunks
+            yield item
+    raise DalException("API response ended before the JSON array was closed")
+
+
+def _with_end_marker(chunks):
+    yield from chunks
+    yield None
@@ -0,0 +1,153 @@
+import mmap
+import os
+from array import array
+from itertools import islice
+from logging_config import get_logger
+
+"""
+This module contains methods to read line based cache files lazily through mmap, with a sidecar index of line offsets
+so a slice like "rows 50,000 - 50,100" is a single seek instead of a scan from the top of the file.
+
+Methods:
+--------
+    index_path(file_path: str) -> str:
+        Returns the path of the sidecar index for a cache file
+    build_line_index(file_path: str) -> array:
+        Scans a file and returns the byte offset of every non-blank line
+    load_line_index(file_path: str) -> array:
+        Returns the line index of a file, from its sidecar if that is up to date, otherwise rebuilding (and saving) it
+    get_line_offset(file_path: str, line_number: int):
+        Returns the byte offset of a line, read straight from the sidecar index (a single 8 byte read)
+    iter_lines(file_path: str, offset: int = 0, limit: int = None):
+        Yields the non-blank lines of a file, starting at line number offset, at most limit lines
+    remove_line_index(file_path: str):
+        Deletes the sidecar index of a file, if there is one
+
+Constants:
+----------
+    INDEX_SUFFIX: appended to a cache file's name to get its sidecar index
+"""
+
+logger = get_logger(__name__)
+
+INDEX_SUFFIX = '.idx'
+
+
+def index_path(file_path: str) -> str:
+    """
+    Returns the path of the sidecar index for a cache file
+    :param file_path: the cache file
+    :return: the index file path
+    """
+    return f"{file_path}{INDEX_SUFFIX}"
+
+
+def build_line_index(file_path: str) -> array:
+    """
+    Scans a file and returns the byte offset of every non-blank line
+    :param file_path: the file to index
+    :return: array of unsigned 64 bit offsets
+    """
+    offsets = array('Q')
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return offsets
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        position = 0
+        while position < size:
+            line_end = data.find(b'\n', position)
+            if line_end == -1:
+                line_end = size
+            if line_end > position:
+                offsets.append(position)
+            position = line_end + 1
+    return offsets
+
+
+def load_line_index(file_path: str) -> array:
+    """
+    Returns the line index of a file, from its sidecar if that is up to date, otherwise rebuilding it and saving the
+        sidecar for next time (saving is best effort, a read only cache still works).
+    :param file_path: the cache file
+    :return: array of line offsets
+    """
+    sidecar = index_path(file_path)
+    offsets = array('Q')
+    try:
+        if os.path.getmtime(sidecar) >= os.path.getmtime(file_path):
+            with open(sidecar, 'rb') as file:
+                offsets.frombytes(file.read())
+            return offsets
+    except OSError:
+        pass  # no sidecar yet
+    offsets = build_line_index(file_path)
+    try:
+        with open(f"{sidecar}.tmp", 'wb') as file:
+            offsets.tofile(file)
+        os.replace(f"{sidecar}.tmp", sidecar)  # never leave a half written index where readers will trust it
+    except OSError as e:
+        logger.warning("Could not save line index %s: %s", sidecar, e)
+    return offsets
+
+
+def get_line_offset(file_path: str, line_number: int):
+    """
+    Returns the byte offset of a line, read straight from the sidecar index (a single 8 byte read), rebuilding the
+        sidecar first if it is missing or older than the file.
+    :param file_path: the cache file
+    :param line_number: the (non-blank) line to look up, starting at 0
+    :return: the byte offset, or None if the file has fewer lines
+    """
+    sidecar = index_path(file_path)
+    try:
+        fresh = os.path.getmtime(sidecar) >= os.path.getmtime(file_path)
+    except OSError:
+        fresh = False
+    if not fresh:
+        offsets = load_line_index(file_path)
+        return offsets[line_number] if line_number < len(offsets) else None
+    entry = array('Q')
+    with open(sidecar, 'rb') as file:
+        file.seek(line_number * entry.itemsize)
+        raw = file.read(entry.itemsize)
+    if len(raw) < entry.itemsize:
+        return None
+    entry.frombytes(raw)
+    return entry[0]
+
+
+def iter_lines(file_path: str, offset: int = 0, limit: int = None):
+    """
+    Yields the non-blank lines of a file through mmap, starting at line number offset, at most limit lines. Only
+        slices that don't start at the top of the file need the line index.
+    :param file_path: the file to read
+    :param offset: number of lines to skip
+    :param limit: max number of lines to yield (None for all)
+    :return: yields lines (str, without the newline)
+    """
+    if limit is not None and limit <= 0:
+        return
+    if os.path.getsize(file_path) == 0:
+        return
+    start = 0
+    if offset > 0:
+        start = get_line_offset(file_path, offset)
+        if start is None:
+            return
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        data.seek(start)
+        lines = (line.rstrip(b'\r\n') for line in iter(data.readline, b''))
+        for line in islice((line for line in lines if line), limit):
+            yield line.decode('utf-8')
+
+
+def remove_line_index(file_path: str):
+    """
+    Deletes the sidecar index of a file, if there is one
+    :param file_path: the cache file
+    :return: n/a
+    """
+    try:
+        os.remove(index_path(file_path))
+    except FileNotFoundError:
+        pass
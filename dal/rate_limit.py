@@ -0,0 +1,228 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import config
+from logging_config import get_logger
+
+"""
+This module contains classes to throttle and retry requests to the API, so concurrent fetches stay under the API's rate
+limit and transient errors don't fail a whole batch.
+
+Methods:
+--------
+    parse_retry_after(value) -> float:
+        Converts a Retry-After header (seconds or HTTP date) into a number of seconds to wait
+    get_request_stats() -> dict:
+        Returns a snapshot of the shared request counters
+    track_requests(counters: dict):
+        Context manager that also adds what the current thread counts during the block to counters
+
+Classes:
+--------
+    RequestStats:
+        Thread safe counters for requests, retries, throttle waits and give-ups
+    TokenBucket:
+        Token bucket rate limiter (requests per second + burst), shared by every thread
+    RetryPolicy:
+        Decides which failures are retryable and how long to back off before the next attempt
+
+Constants:
+----------
+    RETRYABLE_STATUS_CODES: response codes worth retrying (throttling and transient server errors)
+    REQUEST_STATS: the shared RequestStats instance
+    RATE_LIMITER: the shared TokenBucket instance (built from its settings when first used)
+    RETRY_POLICY: the shared RetryPolicy instance (built from its settings when first used)
+"""
+
+logger = get_logger(__name__)
+
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+
+def parse_retry_after(value) -> float:
+    """
+    Converts a Retry-After header (seconds or HTTP date) into a number of seconds to wait
+    :param value: the raw header value (or None)
+    :return: seconds to wait, or None if the header is missing / unreadable
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime  # only needed for HTTP dates, which are rare (and slow to import)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RequestStats:
+    FIELDS = ('requests', 'retries', 'throttle_waits', 'throttle_wait_seconds', 'give_ups')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(self.FIELDS, 0)
+        self._local = threading.local()  # .tracked: the dict track() adds this thread's counts to
+
+    def increment(self, name: str, amount=1):
+        """
+        Adds amount to the named counter
+        :param name: one of RequestStats.FIELDS
+        :param amount: how much to add
+        :return: n/a
+        """
+        with self._lock:
+            self._counters[name] += amount
+            tracked = getattr(self._local, 'tracked', None)
+            if tracked is not None:
+                tracked[name] = tracked.get(name, 0) + amount
+
+    @contextmanager
+    def track(self, counters: dict):
+        """
+        Also adds what the current thread counts during the with block to counters, which other threads can read
+            while the block runs (e.g. to see how many requests a job in flight has made so far)
+        :param counters: dict of counter name -> value, updated in place
+        :return: n/a
+        """
+        previous = getattr(self._local, 'tracked', None)
+        self._local.tracked = counters
+        try:
+            yield
+        finally:
+            self._local.tracked = previous
+
+    def snapshot(self) -> dict:
+        """
+        Returns a copy of the counters
+        :return: dict of counter name -> value
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        """
+        Sets every counter back to zero
+        :return: n/a
+        """
+        with self._lock:
+            self._counters = dict.fromkeys(self.FIELDS, 0)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int, stats: RequestStats):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.stats = stats
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        Blocks until a request is allowed, either because a token is available or a Retry-After pause has ended.
+        :return: the number of seconds spent waiting
+        """
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            self.stats.increment('throttle_waits')
+            self.stats.increment('throttle_wait_seconds', waited)
+        return waited
+
+    def pause(self, seconds: float):
+        """
+        Stops every thread from sending requests for the given number of seconds (used for Retry-After)
+        :param seconds: how long to pause
+        :return: n/a
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int, backoff_base: float, backoff_max: float):
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def is_retryable_status(self, status_code: int) -> bool:
+        """
+        Checks if a response code is worth retrying
+        :param status_code: the response code from the api
+        :return: true if the request should be retried
+        """
+        return status_code in RETRYABLE_STATUS_CODES
+
+    def get_delay(self, attempt: int, retry_after=None) -> float:
+        """
+        Works out how long to wait before the next attempt: the server's Retry-After if it sent one, otherwise
+            exponential backoff with full jitter.
+        :param attempt: the attempt that just failed (starting at 1)
+        :param retry_after: (optional) the response's Retry-After header
+        :return: seconds to wait
+        """
+        server_delay = parse_retry_after(retry_after)
+        if server_delay is not None:
+            return min(server_delay, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+
+REQUEST_STATS = RequestStats()
+
+
+def __getattr__(name: str):
+    # only api_dal uses the shared instances, so their settings are only read when it is imported
+    if name == 'RATE_LIMITER':
+        value = TokenBucket(config.API_RATE_PER_SECOND, config.API_BURST, REQUEST_STATS)
+    elif name == 'RETRY_POLICY':
+        value = RetryPolicy(config.RETRY_MAX_ATTEMPTS, config.RETRY_BACKOFF_BASE, config.RETRY_BACKOFF_MAX)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def get_request_stats() -> dict:
+    """
+    Returns a snapshot of the shared request counters
+    :return: dict of counter name -> value
+    """
+    return REQUEST_STATS.snapshot()
+
+
+def track_requests(counters: dict):
+    """
+    Context manager that also adds what the current thread counts during the with block to counters (see
+        RequestStats.track)
+    :param counters: dict of counter name -> value, updated in place
+    :return: the context manager
+    """
+    return REQUEST_STATS.track(counters)
@@ -1,44 +1,106 @@
+import atexit
 import sqlite3
+import threading
+import weakref
 from contextlib import contextmanager
-from config import DATABASE_PATH
+import config
 from logging_config import get_logger
 from exceptions.custom_exceptions import DalException
 
 """
-This module contains functions built to establish a connection with a database, query that database, and return the 
-results of that query. 
+This module contains functions built to establish a connection with a database, query that database, and return the
+results of that query. Each thread keeps one long-lived connection (WAL journal, tuned pragmas, prepared statement
+cache), which is reused by every query instead of connecting and closing per statement.
+
+Classes:
+--------
+    ManagedConnection(sqlite3.Connection):
+        sqlite3.Connection subclass, only so connections can be tracked with weak references
 
 Methods:
 --------
     get_connection():
-        attempts to establish a connection with the database located at DATABASE_PATH (imported from config)
+        yields this thread's connection to the database located at DATABASE_PATH (see config), opening it
+        on first use
+    open_connection():
+        opens a new connection to the database and applies our pragmas
     get_cursor(connection):
         creates a cursor for the connection from get_connection()
+    transaction():
+        groups several statements into a single transaction, committed once at the end (or rolled back on error)
     execute(query, params=None):
         attempts to execute a query, with optional params, using get_connection() and get_cursor().
+    execute_iter(query, params=None, batch_size: int = ITER_BATCH_SIZE):
+        executes a query and yields its rows as they are read, batch_size rows at a time
+    executemany(query, params_list) -> int:
+        executes a query once per set of params, all inside a single transaction
+    close_connections():
+        closes every connection opened by this module (registered with atexit)
+
+Constants:
+----------
+    ITER_BATCH_SIZE: default number of rows execute_iter() fetches per step
 """
 
 logger = get_logger(__name__)
 
+ITER_BATCH_SIZE = 1000
+
+
+class ManagedConnection(sqlite3.Connection):
+    """
+    sqlite3.Connection subclass, only so connections can be tracked with weak references
+    """
+    pass
+
+
+_local = threading.local()
+_connections = weakref.WeakSet()  # a thread's connection is closed & dropped when the thread exits
+_connections_lock = threading.Lock()
+_generation = 0  # bumped by close_connections(), so every thread notices its connection was closed
+
+
+def open_connection():
+    """
+    opens a new connection to the database at DATABASE_PATH and applies our pragmas. The connection is in autocommit
+    mode, so a single statement commits by itself and transaction() is used to group statements.
+    :return: the new connection
+    """
+    connection = sqlite3.connect(config.DATABASE_PATH, factory=ManagedConnection, isolation_level=None,
+                                 check_same_thread=False, cached_statements=config.SQLITE_STATEMENT_CACHE,
+                                 timeout=config.SQLITE_BUSY_TIMEOUT_MS / 1000)
+    try:
+        connection.execute(f"PRAGMA journal_mode = {config.SQLITE_JOURNAL_MODE}")
+        connection.execute(f"PRAGMA synchronous = {config.SQLITE_SYNCHRONOUS}")
+        connection.execute(f"PRAGMA cache_size = -{config.SQLITE_CACHE_KB}")
+        connection.execute("PRAGMA temp_store = MEMORY")
+    except sqlite3.Error:
+        connection.close()
+        raise
+    with _connections_lock:
+        _connections.add(connection)
+    logger.info("Connected to database at %s", config.DATABASE_PATH)
+    return connection
+
 
 @contextmanager
 def get_connection():
     """
-    attempts to open a connection with the database at DATABASE_PATH, if successful, it yields that connection,
-    if not, it returns an error & logs that error.
+    yields this thread's connection to the database at DATABASE_PATH, opening it on first use. If it can't be opened,
+    it logs & re-raises the error. The connection stays open for the next query.
     :return: yields the connection (if successful)
     """
-    connection = None
-    try:
-        connection = sqlite3.connect(DATABASE_PATH)
-        logger.info(f"Connected to database at {DATABASE_PATH}")
-        yield connection
-    except sqlite3.Error as e:
-        logger.error(f"Failed to get a connection, Error: {e}")
-        raise
-    finally:
-        if connection:
-            connection.close()
+    connection = getattr(_local, 'connection', None)
+    if connection is None or _local.generation != _generation:
+        try:
+            connection = open_connection()
+        except sqlite3.Error as e:
+            logger.error("Failed to get a connection, Error: %s", e)
+            raise
+        _local.connection = connection
+        _local.generation = _generation
+        _local.depth = 0
+    yield connection
 
 
 @contextmanager
@@ -55,6 +117,33 @@ def get_cursor(connection):
         cursor.close()
 
 
+@contextmanager
+def transaction():
+    """
+    groups several statements into a single transaction, committed once at the end (or rolled back on error). Nested
+    calls join the outermost transaction.
+    :return: yields the connection
+    """
+    try:
+        with get_connection() as connection:
+            if _local.depth == 0:
+                connection.execute("BEGIN IMMEDIATE")
+            _local.depth += 1
+            try:
+                yield connection
+            except BaseException:
+                _local.depth -= 1
+                if _local.depth == 0:
+                    connection.rollback()
+                raise
+            _local.depth -= 1
+            if _local.depth == 0:
+                connection.commit()
+    except sqlite3.Error as e:
+        logger.error("Database error %s in transaction", e)
+        raise DalException(f"Transaction failed: {e}")
+
+
 def execute(query, params=None):
     """
     attempts to execute a query, with optional params, using get_connection() and get_cursor().
@@ -63,16 +152,72 @@ def execute(query, params=None):
     :return: returns cursor.fetchall(), a.k.a. all the results of the successful query.
     """
     try:
-        logger.info(f"Query of {query} params {params}")
         with get_connection() as connection:
             with get_cursor(connection) as cursor:
                 if params is not None:
                     cursor.execute(query, params)
                 else:
                     cursor.execute(query)
-                connection.commit()
-                logger.info(f"Query was successful {query}")
-                return cursor.fetchall()
+                results = cursor.fetchall()
+                logger.debug("Query was successful %s params %s", query, params)
+                return results
+    except sqlite3.Error as e:
+        logger.error("Database error %s with query %s params %s", e, query, params)
+        raise DalException(f"Error with query {query} caused by {e}")
+
+
+def execute_iter(query, params=None, batch_size: int = ITER_BATCH_SIZE):
+    """
+    executes a query and yields its rows as they are read (fetching batch_size rows at a time), so large results are
+    never held in memory at once. The rows come from a consistent snapshot of the database, taken at the first fetch.
+    :param query: the query you would like to execute
+    :param params: optional parameters for said query.
+    :param batch_size: number of rows fetched per step
+    :return: yields the rows
+    """
+    try:
+        with get_connection() as connection:
+            with get_cursor(connection) as cursor:
+                cursor.execute(query, params if params is not None else ())
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield from rows
+    except sqlite3.Error as e:
+        logger.error("Database error %s with query %s params %s", e, query, params)
+        raise DalException(f"Error with query {query} caused by {e}")
+
+
+def executemany(query, params_list) -> int:
+    """
+    executes a query once per set of params, all inside a single transaction (one commit / fsync for the whole batch).
+    :param query: the query you would like to execute
+    :param params_list: iterable of parameter tuples, one per execution
+    :return: the number of rows the statements changed
+    """
+    try:
+        with transaction() as connection:
+            with get_cursor(connection) as cursor:
+                cursor.executemany(query, params_list)
+                logger.debug("Bulk query was successful %s (%s rows)", query, cursor.rowcount)
+                return cursor.rowcount
     except sqlite3.Error as e:
-        logger.error(f"Database error {e} with query {query} params {params}")
-        raise DalException(f"Error with query {query} caused by {e}")
\ No newline at end of file
+        logger.error("Database error %s with bulk query %s", e, query)
+        raise DalException(f"Error with bulk query {query} caused by {e}")
+
+
+def close_connections():
+    """
+    closes every connection opened by this module (registered with atexit)
+    :return: n/a
+    """
+    global _generation
+    with _connections_lock:
+        for connection in list(_connections):
+            connection.close()
+        _connections.clear()
+        _generation += 1
+
+
+atexit.register(close_connections)
@@ -1,85 +1,192 @@
+import logging
+import config
 from exceptions import DalException
 from logging_config import get_logger
+from .cache_formats import get_format, get_format_for_file
+from .compression import get_codec, strip_codec_suffix
+from .line_index import remove_line_index
 import os
+import threading
 
 """
-This module contains methods to read/write data to text files.
+This module contains methods to read/write report data to cache files. Files are written in the configured
+CACHE_FORMAT (JSON Lines by default, see cache_formats.py), compressed with CACHE_COMPRESSION at CACHE_COMPRESSION_LEVEL
+(uncompressed by default, see compression.py), and read back in whichever format and codec their file name says.
+
+Every write goes to a temp file next to the target, which is fsynced and then atomically renamed over it, so a cache
+file is either complete or not there at all (a crash leaves at most a TEMP_PREFIX file behind, see db_service.fsck).
 
 Methods:
 --------
-    save_json_to_txt(report_name: str, agency_name: str, date: str, json_data):
-        Saves data in JSON format to a txt file
-    read_from_txt(file_name) -> list:
-        Reads data from a txt file
-    build_file_name(report_name: str, agency_name: str, date: str):
-        Builds file name in format: "database/reportname_agencyname_YYYY-MM-DD.txt"
+    save_json_by_date(report_name: str, agency_name: str, dates: list, json_data) -> dict:
+        Splits data covering several dates into one cache file per date, in a single pass
+    iter_from_txt(file_name, offset: int = 0, limit: int = None):
+        Lazily yields the records of a cache file, optionally only an offset/limit slice of them
+    read_fields(file_name, field_names: list) -> dict:
+        Reads some fields of every record of a cache file, as columns
+    convert_cache_file(file_name: str, format_name: str, codec_name: str = None) -> str:
+        Rewrites a cache file in another format and/or compression codec
+    build_file_name(report_name: str, agency_name: str, date: str, format_name: str = None, codec_name: str = None):
+        Builds file name in format: "database/reportname_agencyname_YYYY-MM-DD.<format extension>[.<codec suffix>]"
     check_if_file_exists(file_path: str) -> bool:
             Checks if a given file name exists
+    temp_file_name(file_name: str) -> str:
+        Returns the temp file a write to file_name goes to before it is renamed into place
+    is_temp_file(file_name: str) -> bool:
+        Checks if a file is a (possibly abandoned) temp file
+    commit_file(temp_name: str, file_name: str):
+        Makes a finished temp file durable and atomically renames it to file_name
+
+Constants:
+----------
+    CACHE_DIRECTORY: the directory cache files are written to
+    TEMP_PREFIX: prefix of the temp files writes go to (the rest of the name keeps the target's suffixes, so the temp
+        file is written in the same format and codec)
 
 """
 
 logger = get_logger(__name__)
 
+CACHE_DIRECTORY = 'database'
+TEMP_PREFIX = '.tmp-'
+
 
-def save_json_to_txt(report_name: str, agency_name: str, date: str, json_data):
+def save_json_by_date(report_name: str, agency_name: str, dates: list, json_data) -> dict:
     """
-    Saves data in JSON format to a txt file
+    Splits data covering several dates into one cache file per date, in a single pass over json_data. Lines whose
+        'date' is not in dates are skipped. No file is renamed into place until the whole response has been written.
     :param report_name: report name the user was searching for
     :param agency_name: agency name the user was searching for
-    :param date: date the user was searching for
-    :param json_data: data to write to the txt file
-    :return: returns the name of the file the data has been saved to
+    :param dates: the dates to write a file for
+    :param json_data: iterable of lines (dicts with a 'date' key) to write
+    :return: dict of date -> the name of the file that date's data has been saved to
     """
-    file_name = build_file_name(report_name, agency_name, date)
-    if not check_if_file_exists(file_name):
-        try:
-            logger.info(f"Attempting to write data to a new file: {file_name}")
-            with open(file_name, 'w', newline='') as file:
-                for line in json_data:
-                    file.write(f"{line}\n")
-            logger.info(f"It seems data has been successfully written to database/{file_name}")
-            return file_name
-        except Exception as e:
-            logger.error(f"Ran into some exception: {e}")
-            raise DalException
-    else:
-        logger.error(f"{file_name} somehow already exists!")
+    file_names = {date: build_file_name(report_name, agency_name, date) for date in dates}
+    temp_names = {date: temp_file_name(file_name) for date, file_name in file_names.items()}
+    cache_format = get_format(config.CACHE_FORMAT)
+    writers = {}
+    try:
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Attempting to write data to %s", list(file_names.values()))
+        for date, temp_name in temp_names.items():
+            writers[date] = cache_format.open_writer(temp_name, config.CACHE_COMPRESSION_LEVEL)
+        for line in json_data:
+            writer = writers.get(line['date'])
+            if writer is not None:
+                writer.write(line)
+        while writers:
+            writers.popitem()[1].close()
+        for date, file_name in file_names.items():
+            commit_file(temp_names[date], file_name)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("It seems data has been successfully written to %s", list(file_names.values()))
+        return file_names
+    except Exception as e:
+        logger.error("Ran into some exception: %s", e)
+        for writer in writers.values():
+            try:
+                writer.close()
+            except Exception:
+                pass
+        for temp_name in temp_names.values():
+            _remove_quietly(temp_name)
         raise DalException
 
 
-def read_from_txt(file_name) -> list:
+def iter_from_txt(file_name, offset: int = 0, limit: int = None):
     """
-    Reads data from a txt file
+    Lazily yields the records of a cache file, optionally only an offset/limit slice of them, so callers never hold
+        the whole file in memory. The file is checked for up front, so a missing file fails here and not mid-iteration.
     :param file_name: name of file to read from
-    :return: list of data (1 list item = 1 line of data)
-    """
-    if check_if_file_exists(file_name):
-        try:
-            data_list = []
-            logger.info(f"Reading data from {file_name}")
-            with open(file_name, 'r') as file:
-                for line in file:
-                    if line != '':  # pycharm likes to add a blank line at the end of files...
-                        data_list.append(line.rstrip('\n'))
-            logger.info(f'successfully read data from {file_name}')
-            return data_list
-        except Exception as e:
-            logger.error(f"Ran into some exception: {e}")
-            raise DalException
-    else:
-        logger.error(f"{file_name} somehow does not exist!")
-        raise DalException
+    :param offset: number of records to skip
+    :param limit: max number of records to yield (None for all)
+    :return: a generator of records (dicts)
+    """
+    if not check_if_file_exists(file_name):
+        logger.error("%s somehow does not exist!", file_name)
+        raise DalException(f"{file_name} does not exist")
+    try:
+        cache_format = get_format_for_file(file_name)
+    except DalException:
+        logger.error("Unknown cache format for %s", file_name)
+        raise
+    return _iter_records(cache_format, file_name, offset, limit)
 
 
-def build_file_name(report_name: str, agency_name: str, date: str):
+def _iter_records(cache_format, file_name: str, offset: int, limit):
+    logger.info("Reading data from %s (offset %s, limit %s)", file_name, offset, limit)
+    try:
+        yield from cache_format.iter_slice(file_name, offset, limit)
+    except Exception as e:
+        logger.error("Ran into some exception reading %s: %s", file_name, e)
+        raise DalException(f"Could not read {file_name}: {e}")
+
+
+def read_fields(file_name, field_names: list) -> dict:
+    """
+    Reads some fields of every record of a cache file, as columns (columnar files are read without building records)
+    :param file_name: name of file to read from
+    :param field_names: the fields to read
+    :return: dict of field name -> sequence of values, one per record (None where a record lacks the field)
+    """
+    if not check_if_file_exists(file_name):
+        logger.error("%s somehow does not exist!", file_name)
+        raise DalException(f"{file_name} does not exist")
+    try:
+        return get_format_for_file(file_name).read_fields(file_name, field_names)
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into some exception reading %s: %s", file_name, e)
+        raise DalException(f"Could not read {file_name}: {e}")
+
+
+def convert_cache_file(file_name: str, format_name: str, codec_name: str = None) -> str:
+    """
+    Rewrites a cache file in another format and/or compression codec (e.g. a legacy .txt cache as .jsonl.gz). The
+        original file is left in place, so the caller can remove it once nothing points at it any more.
+    :param file_name: the cache file to convert
+    :param format_name: the format to convert it to
+    :param codec_name: the codec to compress it with (defaults to CACHE_COMPRESSION)
+    :return: the name of the converted file
     """
-    Builds file name in format: "database/reportname_agencyname_YYYY-MM-DD.txt"
+    source_format = get_format_for_file(file_name)
+    target_format = get_format(format_name)
+    codec_name = codec_name or config.CACHE_COMPRESSION
+    base_name = strip_codec_suffix(file_name)
+    new_file_name = base_name[:-len(source_format.extension)] + target_format.extension
+    if target_format.compressible:
+        new_file_name += get_codec(codec_name).suffix
+    if new_file_name == file_name:
+        return file_name
+    temp_name = temp_file_name(new_file_name)
+    try:
+        logger.info("Converting %s to %s", file_name, new_file_name)
+        with target_format.open_writer(temp_name, config.CACHE_COMPRESSION_LEVEL) as writer:
+            for record in source_format.iter_records(file_name):
+                writer.write(record)
+        commit_file(temp_name, new_file_name)
+        return new_file_name
+    except Exception as e:
+        logger.error("Ran into some exception converting %s: %s", file_name, e)
+        _remove_quietly(temp_name)
+        raise DalException(f"Could not convert {file_name}: {e}")
+
+
+def build_file_name(report_name: str, agency_name: str, date: str, format_name: str = None, codec_name: str = None):
+    """
+    Builds file name in format: "database/reportname_agencyname_YYYY-MM-DD.<format extension>[.<codec suffix>]"
     :param report_name: the report name the user is searching for
     :param agency_name: the agency name the user is searching for
     :param date: the date the user is searching for
+    :param format_name: the cache format the file is written in (defaults to CACHE_FORMAT)
+    :param codec_name: the codec the file is compressed with (defaults to CACHE_COMPRESSION, ignored for formats that
+        are compressed already)
     :return: the built file name (as a string)
     """
-    return f"database/{report_name}_{agency_name}_{date}.txt"
+    cache_format = get_format(format_name or config.CACHE_FORMAT)
+    suffix = get_codec(codec_name or config.CACHE_COMPRESSION).suffix if cache_format.compressible else ''
+    return f"{CACHE_DIRECTORY}/{report_name}_{agency_name}_{date}{cache_format.extension}{suffix}"
 
 
 def check_if_file_exists(file_path: str) -> bool:
@@ -91,4 +198,56 @@ def check_if_file_exists(file_path: str) -> bool:
     if not os.path.exists(file_path):
         return False
     else:
-        return True
\ No newline at end of file
+        return True
+
+
+def temp_file_name(file_name: str) -> str:
+    """
+    Returns the temp file a write to file_name goes to before it is renamed into place. The name is unique per process
+        and thread, so concurrent writers of the same file never share a temp file.
+    :param file_name: the file being written
+    :return: the temp file's path, in the same directory (so the rename is atomic)
+    """
+    directory, base_name = os.path.split(file_name)
+    return os.path.join(directory, f"{TEMP_PREFIX}{os.getpid()}-{threading.get_ident()}-{base_name}")
+
+
+def is_temp_file(file_name: str) -> bool:
+    """
+    Checks if a file is a (possibly abandoned) temp file
+    :param file_name: the file's name or path
+    :return: true if it is a temp file
+    """
+    return os.path.basename(file_name).startswith(TEMP_PREFIX)
+
+
+def commit_file(temp_name: str, file_name: str):
+    """
+    Makes a finished temp file durable and atomically renames it to file_name: the file's data is fsynced before the
+        rename and the directory after it, so after a crash file_name is either the old file or the complete new one.
+    :param temp_name: the closed temp file
+    :param file_name: the file to replace
+    :return: n/a
+    """
+    with open(temp_name, 'rb') as file:
+        os.fsync(file.fileno())
+    os.replace(temp_name, file_name)
+    remove_line_index(file_name)  # the sidecar described the previous file
+    directory = os.path.dirname(file_name) or '.'
+    try:
+        directory_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # directories can't be opened on some platforms (windows), the rename is still atomic there
+    try:
+        os.fsync(directory_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_fd)
+
+
+def _remove_quietly(file_name: str):
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
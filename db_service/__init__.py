@@ -1 +1,8 @@
-from .db_queries import insert_search_data, search_for_match
+from .db_queries import insert_search_data_many, search_for_match, convert_cached_files, mark_fetched, find_stale, \
+    find_keys_between, find_files_between
+from .schema import init_schema, ensure_schema, reset_schema_state, migrate_schema, get_schema_version, SCHEMA_VERSION
+from .fsck import fsck, fsck_after_crash
+from .row_store import store_rows, forget_rows, stored_row_count, query_rows, backfill_row_store, \
+    REPORT_DIMENSIONS, REPORT_METRICS
+from .rollups import store_rollups, forget_rollups, sum_rollups, top_from_rollups, find_rollup_sources, \
+    GROUP_COLUMNS as ROLLUP_GROUP_COLUMNS
@@ -1,47 +1,57 @@
-from config import DATABASE_PATH
-from dal import execute
+import os
+import config
+from dal import execute, executemany, transaction
 from exceptions import DalException
 from logging_config import get_logger
-import os
-from dal import build_file_name
+from dal import build_file_name, convert_cache_file, remove_line_index
+from .schema import CREATE_TABLE, ensure_schema
 
 """
-This module contains methods to query my sqlite database. 
+This module contains methods to query my sqlite database. The schema is set up once per process (see
+schema.init_schema), so each query here is a single indexed statement on an already open connection.
 
 Methods:
 --------
-    insert_search_data(report_name: str, agency_name: str, date: str):
-        Creates a new entry in the search_history table containing the details for a recently executed search (report name,
-        agency name, date & file name)
+    insert_search_data_many(rows) -> tuple:
+        Creates search_history entries for many (report name, agency name, date[, file name]) rows in a single
+        transaction, skipping rows that are already present
     search_for_match(report_name: str, agency_name: str, date: str):
         Searches for a report in the search_log.db
-    check_if_file_exists(file_path: str) -> bool:
-        Checks if a given file at file_path exists
-    check_if_table_exists(table_name):
-        Checks if a given table exists in my sqlite3 database.
+    convert_cached_files(format_name: str, codec_name: str = None) -> int:
+        Converts every cached file that isn't already in format_name / codec_name, and points search_history at the
+        new files
+    mark_fetched(rows) -> int:
+        Records when keys were fetched, whether their data was complete and the response's validators
+    find_stale(unknown_since: str, since: str = None, until: str = None, report_names: list = None,
+               agency_names: list = None) -> list:
+        Returns the search_history rows whose data may still change
+    find_keys_between(start_date: str, end_date: str) -> set:
+        Returns the (report name, agency name, date) keys in search_history within a date window
+    find_files_between(report_name: str, start_date: str, end_date: str) -> list:
+        Returns the cached (agency name, date, file name) rows of a report within a date window
 
 Constants:
 ----------
-    CREATE_TABLE: creates a table called search_history with the listed fields.
-    INSERT_DATA: inserts a new row into the search_history table
+    CREATE_TABLE: creates a table called search_history with the listed fields (see schema.py).
+    INSERT_DATA: inserts a new row into the search_history table, or updates the file name of an existing row with the
+        same report_name, agency_name & date
     SEARCH_DB: searches for a file name in the search_history table given a report_name, agency_name & date
+    SELECT_FILES: selects the id & file name of every search_history row
+    UPDATE_FILE_NAME: points a search_history row (by id) at a different file
+    MARK_FETCHED: records the fetch time, completeness and validators of a search_history row (by key)
+    SELECT_KEYS_BETWEEN: selects the keys of every row within a date window
+    SELECT_FILES_BETWEEN: selects the agency, date & file name of a report's rows within a date window
+    SELECT_STALE: selects the rows that are incomplete, or of unknown completeness (fetched before schema version 3)
+        and on or after a given date (find_stale adds its filters and the order)
 
 """
 
 logger = get_logger(__name__)
 
-CREATE_TABLE = """
-    CREATE TABLE IF NOT EXISTS search_history (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    report_name TEXT,
-    agency_name TEXT,
-    date TEXT,
-    file_name TEXT)
-"""
-
 INSERT_DATA = """
     INSERT INTO search_history (report_name, agency_name, date, file_name)
     VALUES (?, ?, ?, ?)
+    ON CONFLICT (report_name, agency_name, date) DO UPDATE SET file_name = excluded.file_name
 """
 
 SEARCH_DB = """
@@ -49,30 +59,67 @@ SEARCH_DB = """
     WHERE report_name = ? AND agency_name = ? AND date = ?
 """
 
-def insert_search_data(report_name: str, agency_name: str, date: str):
+SELECT_FILES = """
+    SELECT id, file_name FROM search_history
+"""
+
+UPDATE_FILE_NAME = """
+    UPDATE search_history SET file_name = ? WHERE id = ?
+"""
+
+MARK_FETCHED = """
+    UPDATE search_history SET fetched_at = ?, complete = ?, etag = ?, last_modified = ?
+    WHERE report_name = ? AND agency_name = ? AND date = ?
+"""
+
+SELECT_KEYS_BETWEEN = """
+    SELECT report_name, agency_name, date FROM search_history WHERE date BETWEEN ? AND ?
+"""
+
+SELECT_FILES_BETWEEN = """
+    SELECT agency_name, date, file_name FROM search_history
+    WHERE report_name = ? AND date BETWEEN ? AND ?
+    ORDER BY date, agency_name
+"""
+
+SELECT_STALE = """
+    SELECT report_name, agency_name, date, file_name, etag, last_modified FROM search_history
+    WHERE (complete = 0 OR (complete IS NULL AND date >= ?))
+"""
+
+
+def insert_search_data_many(rows) -> tuple:
     """
-    Creates a new entry in the search_history table containing the details for a recently executed search (report name,
-        agency name, date & file name)
-    :param report_name: the name of the report the user is searching for
-    :param agency_name: the name of the agency the user is searching for
-    :param date: the date the user is searching for
-    :return: n/a
+    Creates search_history entries for many (report name, agency name, date[, file name]) rows in a single transaction,
+        skipping rows that are already present (in the table or earlier in rows). The file name defaults to
+        build_file_name(); a present row that points at a different file is re-pointed at the given one.
+    :param rows: iterable of (report_name, agency_name, date) or (report_name, agency_name, date, file_name) tuples
+    :return: tuple of (number of rows inserted, number of rows that were already present)
     """
     try:
-        # need to build the file name:
-        file_name = build_file_name(report_name, agency_name, date)
-        # first, test if the database has been created (this function will create the file if not)
-        check_if_file_exists(DATABASE_PATH)
-        # then check if the table exists
-        if not check_if_table_exists('search_history'):
-            # if it doesn't exist, create it
-            execute(CREATE_TABLE)
-        # otherwise (and always), insert the data...
-        execute(INSERT_DATA, (report_name, agency_name, date, file_name))
+        ensure_schema()
+        with transaction():
+            new_rows = {}
+            inserted = already_present = 0
+            for row in rows:
+                key = tuple(row[:3])
+                file_name = row[3] if len(row) > 3 else build_file_name(*key)
+                current = False if key in new_rows else execute(SEARCH_DB, key)
+                if key in new_rows or current:
+                    already_present += 1
+                    if not current or current[0][0] == file_name:
+                        continue
+                else:
+                    inserted += 1
+                new_rows[key] = key + (file_name,)
+            if new_rows:
+                executemany(INSERT_DATA, new_rows.values())
+        logger.info("Inserted %s search_history rows, %s were already present", inserted, already_present)
+        return inserted, already_present
     except DalException:
         raise
     except Exception as e:
-        logger.error(f"Ran into an unexpected error, {e}")
+        logger.error("Ran into an unexpected error, %s", e)
         raise DalException
 
 
@@ -85,61 +132,136 @@ def search_for_match(report_name: str, agency_name: str, date: str):
     :return: returns False if no match, returns file name of previous search if match is found.
     """
     try:
-        if not check_if_file_exists(DATABASE_PATH):
-            logger.info("Determined no database file exists.")
-            # if there is no db file, then no searches have been made...
-            return False
-        if not check_if_table_exists('search_history'):
-            logger.info("Determined no table 'search_history' exists w/in db.")
-            # same here, if not table, no searches, return false
-            return False
+        ensure_schema()
         file_name = execute(SEARCH_DB, (report_name, agency_name, date))
         if file_name == []:
-            logger.info("File name does not exist in db")
+            logger.debug("File name does not exist in db")
             return False
         else:  # file name was found... I hope!
-            logger.info(f"Successfully found file name: {file_name}")
+            logger.debug("Successfully found file name: %s", file_name[0][0])
             return file_name[0][0]
     except DalException:
         raise
     except Exception as e:
-        logger.error(f"Ran into an unexpected error, {e}")
+        logger.error("Ran into an unexpected error, %s", e)
         raise DalException
 
 
-def check_if_file_exists(file_path: str) -> bool:
+def convert_cached_files(format_name: str, codec_name: str = None) -> int:
     """
-    Checks if a given file at file_path exists
-    :param file_path: the path where the file *should* exist
-    :return: false if file does not exist, true if it does
+    Converts every cached file that isn't already in format_name / codec_name (e.g. legacy .txt caches to .jsonl.gz),
+        points its search_history row at the new file, then removes the old file.
+    :param format_name: the cache format to convert to
+    :param codec_name: the compression codec to convert to (defaults to CACHE_COMPRESSION)
+    :return: the number of files converted
     """
+    codec_name = codec_name or config.CACHE_COMPRESSION
     try:
-        if not os.path.exists(file_path):
-            with open(file_path, 'w') as f:
-                logger.info(f"Created new db file at {file_path}")
-                pass
-            return False
-        else:
-            return True
+        ensure_schema()
+        converted = 0
+        for row_id, file_name in execute(SELECT_FILES):
+            if not os.path.exists(file_name):
+                logger.warning("Skipping conversion of %s, it does not exist", file_name)
+                continue
+            new_file_name = convert_cache_file(file_name, format_name, codec_name)
+            if new_file_name != file_name:
+                execute(UPDATE_FILE_NAME, (new_file_name, row_id))
+                os.remove(file_name)
+                remove_line_index(file_name)
+                converted += 1
+        logger.info("Converted %s cached files to %s (%s)", converted, format_name, codec_name)
+        return converted
+    except DalException:
+        raise
     except Exception as e:
-        logger.error(f"Ran into an error trying to create db file: {e}")
+        logger.error("Ran into an unexpected error, %s", e)
         raise DalException
 
 
-def check_if_table_exists(table_name) -> bool:
+def mark_fetched(rows) -> int:
     """
-    Checks if a given table exists in my sqlite3 database.
-    :param table_name: table name to check
-    :return: true if table exists, false if not
+    Records when keys were fetched, whether their data was complete by then, and the ETag / Last-Modified validators of
+        the response (so a refresh can ask the api whether anything changed), in a single transaction
+    :param rows: iterable of (report_name, agency_name, date, fetched_at, complete, etag, last_modified) tuples
+    :return: the number of rows updated
     """
     try:
-        count = execute(f"SELECT COUNT(*) FROM {table_name};")
-        if len(count) > 0:
-            logger.info(f'Table "{table_name}" exists')
-            return True
-        else:  # this is essentially unreachable code, should I leave it here anyway?
-            logger.info(f"Table '{table_name}' did not exist")
-            return False
+        ensure_schema()
+        params = [(fetched_at, int(complete), etag, last_modified, report_name, agency_name, date)
+                  for report_name, agency_name, date, fetched_at, complete, etag, last_modified in rows]
+        return executemany(MARK_FETCHED, params) if params else 0
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
+
+
+def find_stale(unknown_since: str, since: str = None, until: str = None, report_names: list = None,
+               agency_names: list = None) -> list:
+    """
+    Returns the search_history rows whose data may still change: rows fetched before their data was complete, and rows
+        of unknown completeness (fetched before freshness was recorded) dated unknown_since or later
+    :param unknown_since: YYYY-MM-DD, rows of unknown completeness before this date are trusted
+    :param since: (optional) YYYY-MM-DD, only rows on or after this date
+    :param until: (optional) YYYY-MM-DD, only rows on or before this date
+    :param report_names: (optional) only rows of these reports
+    :param agency_names: (optional) only rows of these agencies
+    :return: list of (report_name, agency_name, date, file_name, etag, last_modified) tuples
+    """
+    conditions = []
+    params = [unknown_since]
+    if since:
+        conditions.append('date >= ?')
+        params.append(since)
+    if until:
+        conditions.append('date <= ?')
+        params.append(until)
+    for column, values in (('report_name', report_names), ('agency_name', agency_names)):
+        if values:
+            conditions.append(f"{column} IN ({', '.join('?' for _ in values)})")
+            params.extend(values)
+    try:
+        ensure_schema()
+        query = SELECT_STALE + ''.join(f"    AND {condition}\n" for condition in conditions)
+        return execute(query + '    ORDER BY report_name, agency_name, date', params)
+    except DalException:
+        raise
     except Exception as e:
-        logger.error(f"Ran into an error trying to check if table {table_name} exists: {e}")
-        return False  # this functionality didn't work how I wanted, so I had to return false on error too...
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
+
+
+def find_keys_between(start_date: str, end_date: str) -> set:
+    """
+    Returns the (report name, agency name, date) keys in search_history within a date window
+    :param start_date: first date of the window, YYYY-MM-DD
+    :param end_date: last date of the window (inclusive), YYYY-MM-DD
+    :return: set of key tuples
+    """
+    try:
+        ensure_schema()
+        return {tuple(row) for row in execute(SELECT_KEYS_BETWEEN, (start_date, end_date))}
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
+
+
+def find_files_between(report_name: str, start_date: str, end_date: str) -> list:
+    """
+    Returns the cached (agency name, date, file name) rows of a report within a date window
+    :param report_name: report name
+    :param start_date: first date of the window, YYYY-MM-DD
+    :param end_date: last date of the window (inclusive), YYYY-MM-DD
+    :return: list of row tuples, in date then agency order
+    """
+    try:
+        ensure_schema()
+        return execute(SELECT_FILES_BETWEEN, (report_name, start_date, end_date))
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
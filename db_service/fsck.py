@@ -0,0 +1,180 @@
+import os
+import time
+from datetime import datetime
+from dal import execute, executemany, transaction, claim_run_marker, prune_lock_files, build_file_name, \
+    get_format_for_file, get_codec_for_file, is_temp_file, remove_line_index, CACHE_DIRECTORY, INDEX_SUFFIX
+from exceptions import DalException
+from logging_config import get_logger
+from .db_queries import SEARCH_DB
+from .row_store import DELETE_ORPHAN_ROWS, DELETE_ORPHAN_ROW_KEYS
+from .rollups import DELETE_ORPHAN_DAILY, DELETE_ORPHAN_TOP
+from .schema import ensure_schema
+
+"""
+This module contains the consistency check of the report cache. It reconciles the search_history table with the
+cache files on disk, so a crash or a failed write never leaves the cache needing manual cleanup:
+
+    - rows whose file is gone are deleted (the next search for them fetches the data again)
+    - cache files no row points at (e.g. written just before a crash, before their row was recorded) are adopted by
+      recording a row for them, if their name is one build_file_name() would give (other files are left alone)
+    - temp files abandoned by interrupted writes, and line index sidecars of missing files, are removed
+    - row store rows (see row_store.py) and rollups (see rollups.py) of keys that no longer have a search_history row
+      are removed
+    - lock files of older versions, which had one per key (see dal.prune_lock_files), are removed
+
+It reads every search_history row and lists the cache directory, so it doesn't run on every start: the commands that
+use the db run it through fsck_after_crash (see business.prepare_database), which only checks the cache when an earlier
+process didn't exit cleanly (see dal.claim_run_marker), and `python main.py fsck` runs it on demand.
+
+Methods:
+--------
+    fsck(temp_max_age: float = TEMP_MAX_AGE) -> dict:
+        Reconciles search_history with the cache directory and returns counts of what was repaired
+    fsck_after_crash() -> dict:
+        Runs fsck if an earlier process crashed or was killed, returns its counts (None if it didn't run)
+
+Constants:
+----------
+    SELECT_ROWS: selects the id, key & file name of every search_history row
+    DELETE_ROW: deletes a search_history row by id
+    ADOPT_FILE: records a row for a cache file, unless its key already has one
+    TEMP_MAX_AGE: temp files older than this many seconds are considered abandoned (younger ones may belong to a write
+        that is still running in another process)
+"""
+
+logger = get_logger(__name__)
+
+SELECT_ROWS = """
+    SELECT id, report_name, agency_name, date, file_name FROM search_history
+"""
+
+DELETE_ROW = """
+    DELETE FROM search_history WHERE id = ?
+"""
+
+ADOPT_FILE = """
+    INSERT INTO search_history (report_name, agency_name, date, file_name)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (report_name, agency_name, date) DO NOTHING
+"""
+
+TEMP_MAX_AGE = 3600
+
+
+def fsck(temp_max_age: float = TEMP_MAX_AGE) -> dict:
+    """
+    Reconciles search_history with the cache directory: deletes rows whose file is missing, adopts (or removes) cache
+        files without a row, and removes abandoned temp files, orphaned line indexes and old lock files.
+    :param temp_max_age: temp files older than this many seconds are removed
+    :return: dict of counts: 'rows_removed', 'files_adopted', 'files_removed', 'temp_files_removed',
+        'indexes_removed', 'lock_files_removed'
+    """
+    try:
+        ensure_schema()
+        counts = dict.fromkeys(('rows_removed', 'files_adopted', 'files_removed', 'temp_files_removed',
+                                'indexes_removed', 'lock_files_removed'), 0)
+        try:
+            on_disk = {os.path.join(CACHE_DIRECTORY, name) for name in os.listdir(CACHE_DIRECTORY)}
+        except FileNotFoundError:
+            on_disk = set()
+        with transaction():
+            known_files = set()
+            missing_rows = []
+            for row_id, report_name, agency_name, date, file_name in execute(SELECT_ROWS):
+                if os.path.exists(file_name):
+                    known_files.add(os.path.normpath(file_name))
+                else:
+                    logger.warning("search_history row for %s/%s/%s points at missing file %s, removing it",
+                                   report_name, agency_name, date, file_name)
+                    missing_rows.append((row_id,))
+            if missing_rows:
+                counts['rows_removed'] = executemany(DELETE_ROW, missing_rows)
+                execute(DELETE_ORPHAN_ROWS)
+                execute(DELETE_ORPHAN_ROW_KEYS)
+                execute(DELETE_ORPHAN_DAILY)
+                execute(DELETE_ORPHAN_TOP)
+            for path in sorted(on_disk):
+                if is_temp_file(path) or path.endswith(INDEX_SUFFIX) or os.path.normpath(path) in known_files:
+                    continue
+                key = _parse_file_name(path)
+                if key is None:
+                    continue  # not a cache file (e.g. the search db itself)
+                if key is False:
+                    logger.warning("Leaving %s alone, it isn't named like a cache file", path)
+                    continue
+                logger.warning("Adopting cache file %s, which had no search_history row", path)
+                execute(ADOPT_FILE, key + (path,))
+                if _row_points_at(key, path):
+                    counts['files_adopted'] += 1
+                else:  # its key already points at another (existing) file, this one is a leftover
+                    _remove(path)
+                    counts['files_removed'] += 1
+        cutoff = time.time() - temp_max_age
+        for path in on_disk:
+            try:
+                if is_temp_file(path) and os.path.getmtime(path) < cutoff:
+                    logger.warning("Removing abandoned temp file %s", path)
+                    _remove(path)
+                    counts['temp_files_removed'] += 1
+                elif path.endswith(INDEX_SUFFIX) and not os.path.exists(path[:-len(INDEX_SUFFIX)]):
+                    _remove(path)
+                    counts['indexes_removed'] += 1
+            except FileNotFoundError:
+                pass  # removed by someone else in the meantime
+        counts['lock_files_removed'] = prune_lock_files()
+        logger.info("Cache fsck finished: %s", counts)
+        return counts
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
+
+
+def fsck_after_crash() -> dict:
+    """
+    Claims this process's run marker (see dal.claim_run_marker) and runs fsck if an earlier process crashed or was
+        killed, since only then can the cache be left inconsistent
+    :return: fsck's counts, or None if it didn't run
+    """
+    try:
+        unclean = claim_run_marker()
+    except OSError as e:
+        logger.error("Could not check the run markers, checking the cache to be safe: %s", e)
+        unclean = True
+    return fsck() if unclean else None
+
+
+def _parse_file_name(path: str):
+    """
+    Works out the (report name, agency name, date) key of a cache file from its name
+    :param path: the file's path
+    :return: the key, None if the file isn't a cache file at all, or False if it looks like one but its name isn't one
+        build_file_name() would give
+    """
+    try:
+        format_name = get_format_for_file(path).name
+    except DalException:
+        return None
+    codec_name = get_codec_for_file(path).name
+    base_name = os.path.basename(path).split('.', 1)[0]
+    report_agency, _, date = base_name.rpartition('_')
+    report_name, _, agency_name = report_agency.partition('_')
+    key = (report_name, agency_name, date)
+    try:
+        datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        return False
+    if not all(key) or os.path.normpath(build_file_name(*key, format_name, codec_name)) != os.path.normpath(path):
+        return False
+    return key
+
+
+def _row_points_at(key: tuple, path: str) -> bool:
+    rows = execute(SEARCH_DB, key)
+    return bool(rows) and os.path.normpath(rows[0][0]) == os.path.normpath(path)
+
+
+def _remove(path: str):
+    os.remove(path)
+    remove_line_index(path)
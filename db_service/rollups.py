@@ -0,0 +1,206 @@
+from dal import execute, executemany, transaction
+from exceptions import DalException
+from logging_config import get_logger
+from .schema import ensure_schema
+
+"""
+This module contains the queries of the rollup tables: precomputed aggregates of every cached key (see
+business/rollups.py, which computes them as keys are fetched). A past date's data never changes, so range questions
+like "visits per agency per day for a month" are answered by summing a few rollup rows per key instead of reading the
+raw records.
+
+    rollup_daily: one row per key with its record count, main metric total (the 'visits' column, total_events for the
+        download report) and a JSON object of the totals of every numeric field
+    rollup_top: the top values (by main metric) of every text field of a key, ROLLUP_TOP_K per field
+
+Methods:
+--------
+    store_rollups(rollups: list) -> int:
+        Replaces the rollups of several keys, in one transaction
+    forget_rollups(keys: list) -> int:
+        Removes the rollups of several keys
+    sum_rollups(report_name: str, start_date: str, end_date: str, agency_names: list = None, by=('agency', 'date'))
+            -> list:
+        Sums the daily rollups of a report's date window per agency and/or date
+    top_from_rollups(report_name: str, field: str, start_date: str, end_date: str, agency_names: list = None,
+                     limit: int = 10) -> list:
+        Returns the values of a text field with the largest totals over a date window, from the per-key top values
+    find_rollup_sources(report_name: str = None, agency_name: str = None, missing_only: bool = False) -> list:
+        Returns the search_history rows whose rollups should be (re)computed
+
+Constants:
+----------
+    INSERT_DAILY: inserts (or replaces) the rollup_daily row of a key
+    INSERT_TOP: inserts a rollup_top row
+    DELETE_DAILY: deletes the rollup_daily row of a key
+    DELETE_TOP: deletes the rollup_top rows of a key
+    SELECT_SOURCES: selects the search_history rows of a report and/or agency (all when NULL)
+    SELECT_MISSING_SOURCES: like SELECT_SOURCES, but only rows without a rollup_daily row
+    DELETE_ORPHAN_DAILY: deletes the rollup_daily rows of keys without a search_history row
+    DELETE_ORPHAN_TOP: deletes the rollup_top rows of keys without a search_history row
+    GROUP_COLUMNS: dict of axis name ('agency' / 'date') -> rollup column
+"""
+
+logger = get_logger(__name__)
+
+INSERT_DAILY = """
+    INSERT OR REPLACE INTO rollup_daily (report_name, agency_name, date, row_count, visits, totals)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_TOP = """
+    INSERT INTO rollup_top (report_name, agency_name, date, field, rank, value, visits) VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+DELETE_DAILY = """
+    DELETE FROM rollup_daily WHERE report_name = ? AND agency_name = ? AND date = ?
+"""
+
+DELETE_TOP = """
+    DELETE FROM rollup_top WHERE report_name = ? AND agency_name = ? AND date = ?
+"""
+
+SELECT_SOURCES = """
+    SELECT report_name, agency_name, date, file_name FROM search_history
+    WHERE (? IS NULL OR report_name = ?) AND (? IS NULL OR agency_name = ?)
+"""
+
+SELECT_MISSING_SOURCES = SELECT_SOURCES + """
+    AND NOT EXISTS (SELECT 1 FROM rollup_daily r WHERE r.report_name = search_history.report_name
+                    AND r.agency_name = search_history.agency_name AND r.date = search_history.date)
+"""
+
+DELETE_ORPHAN_DAILY = """
+    DELETE FROM rollup_daily WHERE NOT EXISTS (
+        SELECT 1 FROM search_history s WHERE s.report_name = rollup_daily.report_name
+        AND s.agency_name = rollup_daily.agency_name AND s.date = rollup_daily.date)
+"""
+
+DELETE_ORPHAN_TOP = """
+    DELETE FROM rollup_top WHERE NOT EXISTS (
+        SELECT 1 FROM search_history s WHERE s.report_name = rollup_top.report_name
+        AND s.agency_name = rollup_top.agency_name AND s.date = rollup_top.date)
+"""
+
+GROUP_COLUMNS = {'agency': 'agency_name', 'date': 'date'}
+
+
+def store_rollups(rollups: list) -> int:
+    """
+    Replaces the rollups of several keys, in one transaction
+    :param rollups: list of (daily row, top rows) pairs: daily row is an INSERT_DAILY params tuple (report name, agency
+        name, date, row count, visits, totals JSON) and top rows a list of INSERT_TOP params tuples
+    :return: the number of keys stored
+    """
+    try:
+        ensure_schema()
+        with transaction():
+            executemany(DELETE_TOP, [daily[:3] for daily, top in rollups])
+            executemany(INSERT_DAILY, [daily for daily, top in rollups])
+            executemany(INSERT_TOP, [row for daily, top in rollups for row in top])
+        return len(rollups)
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
+
+
+def forget_rollups(keys: list) -> int:
+    """
+    Removes the rollups of several keys (e.g. when they couldn't be recomputed after the key was re-fetched)
+    :param keys: list of (report name, agency name, date) tuples
+    :return: the number of keys whose rollups were removed
+    """
+    try:
+        ensure_schema()
+        with transaction():
+            executemany(DELETE_TOP, keys)
+            return max(executemany(DELETE_DAILY, keys), 0)
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
+
+
+def _window_conditions(report_name: str, start_date: str, end_date: str, agency_names: list) -> tuple:
+    conditions = ['report_name = ?', 'date BETWEEN ? AND ?']
+    params = [report_name, start_date, end_date]
+    if agency_names:
+        conditions.append(f"agency_name IN ({', '.join('?' for _ in agency_names)})")
+        params.extend(agency_names)
+    return ' AND '.join(conditions), params
+
+
+def sum_rollups(report_name: str, start_date: str, end_date: str, agency_names: list = None, by=('agency', 'date')) \
+        -> list:
+    """
+    Sums the daily rollups of a report's date window per agency and/or date
+    :param report_name: report name
+    :param start_date: first date of the window, YYYY-MM-DD
+    :param end_date: last date of the window (inclusive), YYYY-MM-DD
+    :param agency_names: (optional) only these agencies
+    :param by: axes to group by, any of 'agency' & 'date' (empty for one grand total)
+    :return: list of (group columns..., keys, row count, visits) tuples, in group order
+    """
+    columns = [GROUP_COLUMNS[axis] for axis in by]
+    where, params = _window_conditions(report_name, start_date, end_date, agency_names)
+    query = f"SELECT {''.join(column + ', ' for column in columns)}COUNT(*), SUM(row_count), SUM(visits) " \
+            f"FROM rollup_daily WHERE {where}"
+    if columns:
+        query += f" GROUP BY {', '.join(columns)} ORDER BY {', '.join(columns)}"
+    try:
+        ensure_schema()
+        return execute(query, params)
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
+
+
+def top_from_rollups(report_name: str, field: str, start_date: str, end_date: str, agency_names: list = None,
+                     limit: int = 10) -> list:
+    """
+    Returns the values of a text field with the largest totals over a date window, summed from the per-key top values.
+        Exact as long as every value that matters made its keys' top ROLLUP_TOP_K; values just outside a key's top are
+        missing from that key's share.
+    :param report_name: report name
+    :param field: the text field (e.g. 'browser')
+    :param start_date: first date of the window, YYYY-MM-DD
+    :param end_date: last date of the window (inclusive), YYYY-MM-DD
+    :param agency_names: (optional) only these agencies
+    :param limit: number of values
+    :return: list of (value, visits, number of keys it was in the top of) tuples, largest first
+    """
+    where, params = _window_conditions(report_name, start_date, end_date, agency_names)
+    query = f"SELECT value, SUM(visits), COUNT(*) FROM rollup_top WHERE field = ? AND {where} " \
+            f"GROUP BY value ORDER BY SUM(visits) DESC, value LIMIT ?"
+    try:
+        ensure_schema()
+        return execute(query, [field] + params + [limit])
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
+
+
+def find_rollup_sources(report_name: str = None, agency_name: str = None, missing_only: bool = False) -> list:
+    """
+    Returns the search_history rows whose rollups should be (re)computed
+    :param report_name: (optional) only rows of this report
+    :param agency_name: (optional) only rows of this agency
+    :param missing_only: only rows without rollups yet
+    :return: list of (report_name, agency_name, date, file_name) tuples
+    """
+    try:
+        ensure_schema()
+        return execute(SELECT_MISSING_SOURCES if missing_only else SELECT_SOURCES,
+                       (report_name, report_name, agency_name, agency_name))
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
@@ -0,0 +1,251 @@
+import json
+from dal import execute, execute_iter, executemany, transaction, iter_from_txt
+from exceptions import DalException
+from logging_config import get_logger
+from .schema import ensure_schema
+
+"""
+This module contains the optional row store: every record of a cached key is also stored as a row of the report_rows
+table, with the report's main dimension (domain, browser, os...) and its visits as typed, indexed columns next to the
+full record (as JSON). Questions spanning many keys ("every agency's os report for last week") then become one indexed
+query instead of opening a file per key, and filters and projections run inside sqlite. The cache files stay the
+source of truth: report_row_keys records which keys are in the row store, and keys that aren't are read from their
+files as before.
+
+Methods:
+--------
+    row_values(report_name: str, agency_name: str, date: str, record: dict) -> tuple:
+        Returns the report_rows values of a record
+    store_rows(report_name: str, agency_name: str, records_by_date: dict) -> int:
+        Replaces the stored rows of several dates of a report/agency, in one transaction
+    forget_rows(report_name: str, agency_name: str, dates) -> int:
+        Removes the stored rows of several dates of a report/agency
+    stored_row_count(report_name: str, agency_name: str, date: str):
+        Returns the number of stored records of a key, or None if the key isn't in the row store
+    query_rows(report_name: str, agency_names: list = None, start_date: str = None, end_date: str = None,
+               dimension: str = None, min_visits: int = None, fields: list = None, order_by_visits: bool = False,
+               offset: int = 0, limit: int = None):
+        Yields the stored records matching the filters, projected to fields
+    backfill_row_store() -> int:
+        Stores the records of every cached key that isn't in the row store yet
+
+Constants:
+----------
+    REPORT_DIMENSIONS: dict of report name -> the record field stored in the dimension column
+    REPORT_METRICS: dict of report name -> the record field stored in the visits column, for reports that don't count
+        'visits'
+    INSERT_ROW: inserts a report_rows row
+    DELETE_ROWS: deletes the report_rows rows of a key
+    INSERT_ROW_KEY: records that a key is in the row store, with its record count
+    DELETE_ROW_KEY: forgets that a key is in the row store
+    SELECT_ROW_COUNT: selects the record count of a stored key
+    SELECT_UNSTORED: selects the search_history rows of keys that aren't in the row store
+    DELETE_ORPHAN_ROWS: deletes the report_rows rows of keys without a search_history row
+    DELETE_ORPHAN_ROW_KEYS: deletes the report_row_keys rows of keys without a search_history row
+"""
+
+logger = get_logger(__name__)
+
+REPORT_DIMENSIONS = {
+    'download': 'page',
+    'traffic-source': 'source',
+    'device-model': 'mobile_device',
+    'domain': 'domain',
+    'site': 'domain',
+    'second-level-domain': 'domain',
+    'language': 'language',
+    'os-browser': 'browser',
+    'windows-browser': 'browser',
+    'browser': 'browser',
+    'windows-ie': 'browser_version',
+    'os': 'os',
+    'windows': 'os_version',
+    'ie': 'browser_version',
+    'device': 'device',
+}
+
+REPORT_METRICS = {'download': 'total_events'}
+
+INSERT_ROW = """
+    INSERT INTO report_rows (report_name, agency_name, date, dimension, visits, record) VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+DELETE_ROWS = """
+    DELETE FROM report_rows WHERE report_name = ? AND agency_name = ? AND date = ?
+"""
+
+INSERT_ROW_KEY = """
+    INSERT OR REPLACE INTO report_row_keys (report_name, agency_name, date, row_count) VALUES (?, ?, ?, ?)
+"""
+
+DELETE_ROW_KEY = """
+    DELETE FROM report_row_keys WHERE report_name = ? AND agency_name = ? AND date = ?
+"""
+
+SELECT_ROW_COUNT = """
+    SELECT row_count FROM report_row_keys WHERE report_name = ? AND agency_name = ? AND date = ?
+"""
+
+SELECT_UNSTORED = """
+    SELECT s.report_name, s.agency_name, s.date, s.file_name FROM search_history s
+    WHERE NOT EXISTS (SELECT 1 FROM report_row_keys k
+                      WHERE k.report_name = s.report_name AND k.agency_name = s.agency_name AND k.date = s.date)
+"""
+
+DELETE_ORPHAN_ROWS = """
+    DELETE FROM report_rows WHERE NOT EXISTS (
+        SELECT 1 FROM search_history s WHERE s.report_name = report_rows.report_name
+        AND s.agency_name = report_rows.agency_name AND s.date = report_rows.date)
+"""
+
+DELETE_ORPHAN_ROW_KEYS = """
+    DELETE FROM report_row_keys WHERE NOT EXISTS (
+        SELECT 1 FROM search_history s WHERE s.report_name = report_row_keys.report_name
+        AND s.agency_name = report_row_keys.agency_name AND s.date = report_row_keys.date)
+"""
+
+
+def row_values(report_name: str, agency_name: str, date: str, record: dict) -> tuple:
+    """
+    Returns the report_rows values of a record
+    :param report_name: report the record belongs to
+    :param agency_name: agency the record belongs to
+    :param date: date the record belongs to
+    :param record: the record
+    :return: tuple of INSERT_ROW params
+    """
+    dimension = record.get(REPORT_DIMENSIONS.get(report_name, ''))
+    visits = record.get(REPORT_METRICS.get(report_name, 'visits'))
+    return (report_name, agency_name, date, None if dimension is None else f"{dimension}",
+            visits if isinstance(visits, int) else None, json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+
+
+def store_rows(report_name: str, agency_name: str, records_by_date: dict) -> int:
+    """
+    Replaces the stored rows of several dates of a report/agency (and their report_row_keys entries) in one transaction.
+        Records are streamed into sqlite, never collected in memory.
+    :param report_name: report name
+    :param agency_name: agency name
+    :param records_by_date: dict of date -> iterable of that date's records
+    :return: the number of rows stored
+    """
+    try:
+        ensure_schema()
+        stored = 0
+        with transaction():
+            for date, records in records_by_date.items():
+                execute(DELETE_ROWS, (report_name, agency_name, date))
+                count = max(executemany(INSERT_ROW, (row_values(report_name, agency_name, date, record)
+                                                     for record in records)), 0)
+                execute(INSERT_ROW_KEY, (report_name, agency_name, date, count))
+                stored += count
+        return stored
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
+
+
+def forget_rows(report_name: str, agency_name: str, dates) -> int:
+    """
+    Removes the stored rows of several dates of a report/agency, so they are read from their files again
+    :param report_name: report name
+    :param agency_name: agency name
+    :param dates: the dates to forget
+    :return: the number of keys forgotten
+    """
+    try:
+        ensure_schema()
+        keys = [(report_name, agency_name, date) for date in dates]
+        with transaction():
+            executemany(DELETE_ROWS, keys)
+            return max(executemany(DELETE_ROW_KEY, keys), 0)
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
+
+
+def stored_row_count(report_name: str, agency_name: str, date: str):
+    """
+    Returns the number of stored records of a key
+    :param report_name: report name
+    :param agency_name: agency name
+    :param date: YYYY-MM-DD date
+    :return: the record count, or None if the key isn't in the row store
+    """
+    try:
+        ensure_schema()
+        rows = execute(SELECT_ROW_COUNT, (report_name, agency_name, date))
+        return rows[0][0] if rows else None
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
+
+
+def query_rows(report_name: str, agency_names: list = None, start_date: str = None, end_date: str = None,
+               dimension: str = None, min_visits: int = None, fields: list = None, order_by_visits: bool = False,
+               offset: int = 0, limit: int = None):
+    """
+    Yields the stored records of a report matching the filters. Filtering, projection, ordering and paging all run in
+        sqlite, on the report_rows indexes. Only keys in the row store are searched (see stored_row_count).
+    :param report_name: report name
+    :param agency_names: (optional) only these agencies
+    :param start_date: (optional) YYYY-MM-DD, only records on or after this date
+    :param end_date: (optional) YYYY-MM-DD, only records on or before this date
+    :param dimension: (optional) only records whose main dimension (see REPORT_DIMENSIONS) has this value
+    :param min_visits: (optional) only records with at least this many visits
+    :param fields: (optional) record fields to return, the whole record if None
+    :param order_by_visits: most visits first, instead of date, agency and file order
+    :param offset: number of matching records to skip
+    :param limit: max number of records to yield (None for all)
+    :return: yields record dicts
+    """
+    columns = ', '.join('json_extract(record, ?)' for _ in fields) if fields else 'record'
+    params = [f'$."{field}"' for field in fields or ()]
+    conditions = ['report_name = ?']
+    params.append(report_name)
+    if agency_names:
+        conditions.append(f"agency_name IN ({', '.join('?' for _ in agency_names)})")
+        params.extend(agency_names)
+    for condition, value in (('date >= ?', start_date), ('date <= ?', end_date), ('dimension = ?', dimension),
+                             ('visits >= ?', min_visits)):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    order = 'visits DESC, date, agency_name, rowid' if order_by_visits else 'date, agency_name, rowid'
+    query = f"SELECT {columns} FROM report_rows WHERE {' AND '.join(conditions)} ORDER BY {order}"
+    if limit is not None or offset:
+        query += " LIMIT ? OFFSET ?"
+        params.extend((-1 if limit is None else limit, offset))
+    ensure_schema()
+    for row in execute_iter(query, params):
+        yield dict(zip(fields, row)) if fields else json.loads(row[0])
+
+
+def backfill_row_store() -> int:
+    """
+    Stores the records of every cached key that isn't in the row store yet (e.g. keys cached before it was enabled),
+        one transaction per key. Keys whose file can't be read are skipped, and stay readable from their files.
+    :return: the number of keys stored
+    """
+    try:
+        ensure_schema()
+        stored = 0
+        for report_name, agency_name, date, file_name in execute(SELECT_UNSTORED):
+            try:
+                store_rows(report_name, agency_name, {date: iter_from_txt(file_name)})
+                stored += 1
+            except DalException:
+                logger.warning("Could not store the rows of %s, leaving it out of the row store", file_name)
+        logger.info("Backfilled %s keys into the row store", stored)
+        return stored
+    except DalException:
+        raise
+    except Exception as e:
+        logger.error("Ran into an unexpected error, %s", e)
+        raise DalException
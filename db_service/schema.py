@@ -0,0 +1,212 @@
+import os
+import threading
+import config
+from dal import execute, transaction
+from exceptions import DalException
+from logging_config import get_logger
+
+"""
+This module contains the versioned schema of my sqlite database. The schema version lives in PRAGMA user_version, and
+every migration past that version is applied (in order, in a single transaction) by migrate_schema(). init_schema() is
+run once by every command that uses the db (see business.prepare_database) and remembers that the schema is ready, so
+queries don't have to probe for the db file or table.
+
+Methods:
+--------
+    get_schema_version() -> int:
+        Returns the schema version recorded in the database (0 for a brand new database)
+    migrate_schema() -> int:
+        Applies every migration newer than the database's schema version
+    init_schema() -> int:
+        Creates the db directory and migrates the schema, once per process
+    ensure_schema():
+        Calls init_schema() unless the schema is already known to be ready (cheap enough for every query)
+    reset_schema_state():
+        Forgets that the schema is ready, so the next query re-runs init_schema()
+
+Constants:
+----------
+    CREATE_TABLE: creates a table called search_history with the listed fields.
+    DEDUPE_SEARCH_HISTORY: deletes duplicate search_history rows, keeping the oldest row for each key
+    CREATE_SEARCH_INDEX: creates a unique index on search_history (report_name, agency_name, date)
+    ADD_FRESHNESS_COLUMNS: adds when each row was fetched, whether its data was complete by then, and the response's
+        ETag / Last-Modified validators (all NULL for rows fetched before version 3)
+    CREATE_ROW_STORE: creates the report_rows table (one row per record of a cached key, with its main dimension and
+        metric as typed columns next to the full record), its indexes, and report_row_keys (which keys are stored, and
+        their record counts)
+    CREATE_ROLLUPS: creates the rollup tables maintained on ingest: rollup_daily (record count, main metric and the
+        totals of every numeric field, per key) and rollup_top (the top values of each text field, per key)
+    MIGRATIONS: list of migrations, MIGRATIONS[n - 1] upgrades the schema from version n - 1 to n
+    SCHEMA_VERSION: the schema version this code expects
+"""
+
+logger = get_logger(__name__)
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS search_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    report_name TEXT,
+    agency_name TEXT,
+    date TEXT,
+    file_name TEXT)
+"""
+
+DEDUPE_SEARCH_HISTORY = """
+    DELETE FROM search_history
+    WHERE id NOT IN (SELECT MIN(id) FROM search_history GROUP BY report_name, agency_name, date)
+"""
+
+CREATE_SEARCH_INDEX = """
+    CREATE UNIQUE INDEX IF NOT EXISTS search_history_key
+    ON search_history (report_name, agency_name, date)
+"""
+
+ADD_FRESHNESS_COLUMNS = [
+    "ALTER TABLE search_history ADD COLUMN fetched_at TEXT",
+    "ALTER TABLE search_history ADD COLUMN complete INTEGER",
+    "ALTER TABLE search_history ADD COLUMN etag TEXT",
+    "ALTER TABLE search_history ADD COLUMN last_modified TEXT",
+]
+
+CREATE_ROW_STORE = [
+    """
+    CREATE TABLE IF NOT EXISTS report_rows (
+    report_name TEXT NOT NULL,
+    agency_name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    dimension TEXT,
+    visits INTEGER,
+    record TEXT NOT NULL)
+    """,
+    "CREATE INDEX IF NOT EXISTS report_rows_key ON report_rows (report_name, agency_name, date)",
+    "CREATE INDEX IF NOT EXISTS report_rows_date ON report_rows (report_name, date)",
+    "CREATE INDEX IF NOT EXISTS report_rows_agency ON report_rows (agency_name, date)",
+    "CREATE INDEX IF NOT EXISTS report_rows_dimension ON report_rows (report_name, dimension, date)",
+    """
+    CREATE TABLE IF NOT EXISTS report_row_keys (
+    report_name TEXT NOT NULL,
+    agency_name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    row_count INTEGER NOT NULL,
+    PRIMARY KEY (report_name, agency_name, date))
+    """,
+]
+
+CREATE_ROLLUPS = [
+    """
+    CREATE TABLE IF NOT EXISTS rollup_daily (
+    report_name TEXT NOT NULL,
+    agency_name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    row_count INTEGER NOT NULL,
+    visits INTEGER NOT NULL,
+    totals TEXT NOT NULL,
+    PRIMARY KEY (report_name, agency_name, date)) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS rollup_daily_date ON rollup_daily (report_name, date)",
+    """
+    CREATE TABLE IF NOT EXISTS rollup_top (
+    report_name TEXT NOT NULL,
+    agency_name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    field TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    value TEXT,
+    visits INTEGER NOT NULL,
+    PRIMARY KEY (report_name, agency_name, date, field, rank)) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS rollup_top_field ON rollup_top (report_name, field, date)",
+]
+
+MIGRATIONS = [
+    # 1: original table
+    [CREATE_TABLE],
+    # 2: one row per report/agency/date, enforced (and searched) through a unique index
+    [DEDUPE_SEARCH_HISTORY, CREATE_SEARCH_INDEX],
+    # 3: freshness, so dates fetched before the api had all their data can be refreshed
+    ADD_FRESHNESS_COLUMNS,
+    # 4: optional row store, so questions spanning many keys can be answered with sql instead of reading files
+    CREATE_ROW_STORE,
+    # 5: precomputed per-key aggregates, so range queries don't have to read the raw data
+    CREATE_ROLLUPS,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version() -> int:
+    """
+    Returns the schema version recorded in the database (0 for a brand new database)
+    :return: the schema version
+    """
+    return execute("PRAGMA user_version")[0][0]
+
+
+def migrate_schema() -> int:
+    """
+    Applies every migration newer than the database's schema version, in a single transaction, then records the new
+        version. Databases created before versioning (user_version 0 but with a search_history table) are migrated too:
+        the table and index migrations are idempotent, and such a database can't have the columns that the later
+        ALTER TABLE migrations add. Those are not safe to re-run, so never lower user_version by hand.
+    :return: the schema version of the database
+    """
+    try:
+        if get_schema_version() >= SCHEMA_VERSION:
+            return SCHEMA_VERSION
+        with transaction():
+            version = get_schema_version()  # re-read under the write lock, another process may have migrated
+            if version >= SCHEMA_VERSION:
+                return version
+            for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                logger.info("Migrating search db schema to version %s", number)
+                for statement in statements:
+                    execute(statement)
+            execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        logger.info("Search db schema is now at version %s", SCHEMA_VERSION)
+        return SCHEMA_VERSION
+    except DalException:
+        logger.error("Failed to migrate the search db schema")
+        raise
+
+
+def init_schema() -> int:
+    """
+    Creates the db directory and migrates the schema, once per process. Later calls return straight away.
+    :return: the schema version of the database
+    """
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return SCHEMA_VERSION
+        db_directory = os.path.dirname(config.DATABASE_PATH)
+        try:
+            if db_directory:
+                os.makedirs(db_directory, exist_ok=True)
+        except OSError as e:
+            logger.error("Could not create db directory %s: %s", db_directory, e)
+            raise DalException
+        version = migrate_schema()
+        _schema_ready = True
+        return version
+
+
+def ensure_schema():
+    """
+    Calls init_schema() unless the schema is already known to be ready (cheap enough for every query)
+    :return: n/a
+    """
+    if not _schema_ready:
+        init_schema()
+
+
+def reset_schema_state():
+    """
+    Forgets that the schema is ready, so the next query re-runs init_schema() (e.g. after the db file was replaced)
+    :return: n/a
+    """
+    global _schema_ready
+    with _schema_lock:
+        _schema_ready = False
@@ -1,15 +1,196 @@
+import atexit
 import logging as l
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+import config
 
 """
-This module configures our logging options for the application.
+This module configures our logging options for the application. Log calls never touch the disk: the root logger's only
+handler puts records on an in-memory queue, and a background thread (a QueueListener) formats them and writes them to
+LOG_PATH, which is rotated by size (LOG_MAX_BYTES) or by time (LOG_ROTATE_WHEN). Messages are formatted by the writer
+thread too, so log with %-style arguments (logger.info("Read %s records", count)), never with f-strings, and only pass
+values that won't change after the call.
+
+Nothing is set up when this module is imported: until the first record is logged, the root logger's handler is a
+StartOnFirstRecord, which configures logging (reading the [LOGGING] settings, building the file handler and starting
+the writer thread) and passes the record on. A run that never logs never pays for any of it.
+
+Worker processes (e.g. a ProcessPoolExecutor's) don't write the log file themselves: init_worker_logging, the pool's
+initializer, sends their records over a multiprocessing queue to a writer thread of this process (see worker_logging).
+
+Methods:
+--------
+    build_file_handler() -> logging.Handler:
+        Builds the rotating handler that writes the log file, creating its directory if needed
+    configure_logging():
+        Routes every log record through the queue to the log file, once per process (called by the first record)
+    stop_logging():
+        Writes out every queued record and stops the writer thread (registered with atexit at import, so it runs after
+        the exit handlers of the modules that log)
+    worker_logging():
+        Context manager that writes the log records of worker processes to the log file, yielding their queue
+    init_worker_logging(log_queue):
+        Sends every log record of a worker process to the queue of worker_logging (a process pool's initializer)
+    get_logger(module_name: str):
+        Returns the logger of a module
+
+Classes:
+--------
+    DeferredQueueHandler(QueueHandler):
+        Queues records as they are, leaving the message formatting to the writer thread
+    StartOnFirstRecord(logging.Handler):
+        The root logger's handler until the first record, which configures logging
+
+Constants:
+----------
+    LOG_FORMAT: format of a log line
+    DATE_FORMAT: format of a log line's timestamp
 """
 
-l.basicConfig(
-              filename='logs/app.log',
-              level=l.INFO,
-              format='[%(asctime)s - %(filename)s:%(lineno)d - %(levelname)s - %(message)s',
-              datefmt='%Y-%m-%d %H:%M:%S')
+LOG_FORMAT = '[%(asctime)s - %(filename)s:%(lineno)d - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_file_handler = None
+_listener = None
+_configure_lock = threading.Lock()
+
+
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        """
+        Prepares a record for the queue without formatting its message (QueueHandler's default formats it in the
+            calling thread). Only a traceback is rendered here, while it is still current.
+        :param record: the log record
+        :return: the record to queue
+        """
+        if record.exc_info:
+            record.exc_text = l.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class StartOnFirstRecord(l.Handler):
+    def handle(self, record):
+        """
+        Configures logging (which replaces this handler), then hands the record to the configured handlers if it is at
+            or above the configured level
+        :param record: the first log record (or one logged while another thread was configuring)
+        :return: True
+        """
+        configure_logging()
+        root = l.getLogger()
+        if record.levelno >= root.getEffectiveLevel():
+            root.callHandlers(record)
+        return True
+
+
+def build_file_handler() -> l.Handler:
+    """
+    Builds the handler that writes the log file: rotated on time if LOG_ROTATE_WHEN is set, otherwise on size. The log
+        directory is created if it doesn't exist yet.
+    :return: the handler
+    """
+    directory = os.path.dirname(config.LOG_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if config.LOG_ROTATE_WHEN:
+        handler = TimedRotatingFileHandler(config.LOG_PATH, when=config.LOG_ROTATE_WHEN,
+                                           backupCount=config.LOG_BACKUP_COUNT, encoding='utf-8', delay=True)
+    else:
+        handler = RotatingFileHandler(config.LOG_PATH, maxBytes=config.LOG_MAX_BYTES,
+                                      backupCount=config.LOG_BACKUP_COUNT, encoding='utf-8', delay=True)
+    handler.setFormatter(l.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT))
+    return handler
+
+
+def _start_listener():
+    global _listener
+    log_queue = queue.SimpleQueue()
+    root = l.getLogger()
+    for handler in [handler for handler in root.handlers
+                    if isinstance(handler, (DeferredQueueHandler, StartOnFirstRecord))]:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    _listener = QueueListener(log_queue, _file_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def configure_logging():
+    """
+    Routes every log record through the queue to the log file, once per process (later calls do nothing). Called by
+        StartOnFirstRecord, so it happens on the first log record.
+    :return: n/a
+    """
+    global _file_handler
+    with _configure_lock:
+        if _file_handler is not None:
+            return
+        _file_handler = build_file_handler()
+        l.getLogger().setLevel(config.LOG_LEVEL)
+        _start_listener()
+
+
+def stop_logging():
+    """
+    Writes out every queued record and stops the writer thread (registered with atexit)
+    :return: n/a
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        _file_handler.flush()
+
+
+@contextmanager
+def worker_logging():
+    """
+    Writes the log records of worker processes to the log file while the block runs, through a writer thread of this
+        process. Pass the yielded queue to init_worker_logging as the pool's initializer, and shut the pool down before
+        the block ends so the workers' last records are written:
+
+            with worker_logging() as log_queue, ProcessPoolExecutor(initializer=init_worker_logging,
+                                                                     initargs=(log_queue,)) as executor:
+    :return: (yields) the multiprocessing queue of the workers' records
+    """
+    import multiprocessing  # slow to import, and only the process pools need it
+    configure_logging()
+    log_queue = multiprocessing.Queue()
+    listener = QueueListener(log_queue, _file_handler, respect_handler_level=True)
+    listener.start()
+    try:
+        yield log_queue
+    finally:
+        listener.stop()
+        log_queue.close()
+        log_queue.join_thread()
+
+
+def init_worker_logging(log_queue):
+    """
+    Sends every log record of a worker process to the queue of worker_logging instead of configuring logging (or, if
+        the process was forked, using the parent's writer thread, which didn't survive the fork). Records are
+        formatted here, as they must be pickled. Meant as a process pool's initializer.
+    :param log_queue: the queue yielded by worker_logging
+    :return: n/a
+    """
+    global _listener
+    _listener = None
+    root = l.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(config.LOG_LEVEL)
 
 
 def get_logger(module_name: str):
     return l.getLogger(module_name)
+
+
+# every level reaches StartOnFirstRecord, configure_logging then sets the configured level
+l.getLogger().setLevel(l.NOTSET)
+l.getLogger().addHandler(StartOnFirstRecord())
+atexit.register(stop_logging)
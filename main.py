@@ -1,8 +1,32 @@
 # Charles Grace
 # Programming Logic 3 - HW7 ("Open Data")
 
-from presentation_layer import run
+import sys
+import business
+from db_service import init_schema, fsck
+from exceptions import BusinessLogicException
+import presentation_layer
 
 
 if __name__ == '__main__':
-    run()
+    # each command readies the db itself once its arguments are parsed (see business.prepare_database)
+    if sys.argv[1:2] == ['fsck']:  # on demand cache consistency check, see db_service/fsck.py
+        init_schema()
+        print(', '.join(f"{name}: {count}" for name, count in fsck().items()))
+        sys.exit(0)
+    if sys.argv[1:2] == ['serve']:  # http query service, see presentation_layer/http_server.py
+        sys.exit(presentation_layer.serve_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['prefetch']:  # cache warm-up, see presentation_layer/prefetch_cli.py
+        sys.exit(presentation_layer.prefetch_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['analyze']:  # aggregates over cached reports, see presentation_layer/analytics_cli.py
+        sys.exit(presentation_layer.analyze_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['rollup']:  # precomputed aggregates, see presentation_layer/rollup_cli.py
+        sys.exit(presentation_layer.rollup_main(sys.argv[2:]))
+    if len(sys.argv) > 1:  # arguments mean a non-interactive batch run, see presentation_layer/batch_cli.py
+        sys.exit(presentation_layer.batch_main(sys.argv[1:]))
+    try:
+        business.prepare_database()
+    except BusinessLogicException as e:
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(1)
+    presentation_layer.run()
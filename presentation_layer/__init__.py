@@ -1 +1,14 @@
+from importlib import import_module
 from .command_line import run, on_new_data, on_old_data, display_results, on_error
+from .batch_cli import main as batch_main
+
+# the other commands are only imported when main.py dispatches to them (the http service alone pulls in http.server)
+COMMANDS = {'serve_main': 'http_server', 'prefetch_main': 'prefetch_cli', 'analyze_main': 'analytics_cli',
+            'rollup_main': 'rollup_cli'}
+
+
+def __getattr__(name: str):
+    if name not in COMMANDS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = globals()[name] = import_module(f".{COMMANDS[name]}", __name__).main
+    return value
@@ -0,0 +1,115 @@
+import argparse
+import sys
+import business
+from exceptions import BusinessLogicException
+import validation
+from .batch_cli import parse_date, resolve_names, resolve_end_date, write_rows, positive_int, ROW_WRITERS, EXIT_OK, \
+    EXIT_FAILURES, EXIT_USAGE
+
+"""
+This module contains the analyze command, which answers aggregate questions over a report's cached data across agencies
+and dates (see business/analytics.py) instead of printing raw records:
+
+    python main.py analyze --report browser --date 2024-01-01 --end-date 2024-01-31 --top 10
+    python main.py analyze --report os --agency all --date yesterday --group-by agency
+    python main.py analyze --report domain --date 2024-01-01 --end-date 2024-01-07 --deltas --limit 5
+    python main.py analyze --report browser --date 2024-01-01 --end-date 2024-01-31 --rollup
+
+Methods:
+--------
+    build_parser() -> argparse.ArgumentParser:
+        Builds the argument parser of the analyze command
+    analyze(args, frame) -> list:
+        Runs the requested analysis on a loaded frame
+    main(argv=None) -> int:
+        Runs the analyze command and returns its exit code
+"""
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Builds the argument parser of the analyze command
+    :return: the parser
+    """
+    parser = argparse.ArgumentParser(prog='main.py analyze', description="Aggregate a report's cached data across "
+                                     "agencies and dates.")
+    parser.add_argument('-r', '--report', required=True, help="report name")
+    parser.add_argument('-a', '--agency', nargs='+', default=['all'], metavar='AGENCY',
+                        help="agency name(s), or 'all' (default)")
+    parser.add_argument('-d', '--date', required=True, type=parse_date,
+                        help="first date of the window (YYYY-MM-DD, 'today' or 'yesterday')")
+    parser.add_argument('-e', '--end-date', type=parse_date, help="last date of the window (default: --date)")
+    analysis = parser.add_mutually_exclusive_group()
+    analysis.add_argument('--top', type=positive_int, default=10, metavar='N',
+                          help="the N largest values of --by (the default, N=10)")
+    analysis.add_argument('--group-by', nargs='+', choices=business.AXES, metavar='AXIS',
+                          help=f"totals per group of one or more of {', '.join(business.AXES)}")
+    analysis.add_argument('--deltas', action='store_true', help="daily totals of --by with day over day changes")
+    analysis.add_argument('--rollup', action='store_true', help="each dimension value rolled up across agencies")
+    parser.add_argument('--by', choices=business.AXES, default='dimension',
+                        help="axis for --top and --deltas (default: dimension, e.g. the browser of a browser report)")
+    parser.add_argument('--limit', type=positive_int, help="only the top LIMIT groups for --deltas / --rollup")
+    parser.add_argument('--fetch', action='store_true', help="fetch the window's missing keys first")
+    parser.add_argument('-f', '--format', choices=list(ROW_WRITERS), default='csv', help="output format (default: csv)")
+    parser.add_argument('-o', '--output', default='-', help="output file (default: - for stdout)")
+    return parser
+
+
+def analyze(args, frame) -> list:
+    """
+    Runs the requested analysis on a loaded frame
+    :param args: the parsed arguments
+    :param frame: the business.ReportFrame
+    :return: list of result rows (dicts)
+    """
+    if args.group_by:
+        return business.group_totals(frame, args.group_by)
+    if args.deltas:
+        return business.daily_deltas(frame, args.by, args.limit)
+    if args.rollup:
+        return business.agency_rollup(frame, args.limit)
+    return business.top_n(frame, args.top, args.by)
+
+
+def main(argv=None) -> int:
+    """
+    Runs the analyze command and returns its exit code: EXIT_OK, EXIT_FAILURES if the data couldn't be loaded (or some
+        cache files couldn't be read), EXIT_USAGE for invalid arguments
+    :param argv: the arguments after 'analyze'
+    :return: the exit code
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        report_name = resolve_names([args.report], validation.REPORTS_LIST, 'report')[0]
+        agency_names = resolve_names(args.agency, validation.AGENCY_LIST, 'agency')
+        end_date = resolve_end_date(args.date, args.end_date)
+    except argparse.ArgumentTypeError as e:
+        parser.print_usage(sys.stderr)
+        print(f"{parser.prog}: error: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    if args.deltas and args.by == 'date':
+        parser.print_usage(sys.stderr)
+        print(f"{parser.prog}: error: --deltas needs --by dimension or agency", file=sys.stderr)
+        return EXIT_USAGE
+
+    try:
+        business.prepare_database()
+        if args.fetch:
+            jobs = business.build_jobs([report_name], agency_names, args.date, end_date)
+            for result in business.fetch_many(jobs):
+                if result['status'] == business.STATUS_ERROR:
+                    print(f"fetch failed: {result.get('agency_name')}/{result.get('date')}: {result['error']}",
+                          file=sys.stderr)
+        frame = business.load_frame(report_name, agency_names, args.date, end_date)
+        rows = analyze(args, frame)
+    except BusinessLogicException as e:
+        print(f"error: {e}", file=sys.stderr)
+        return EXIT_FAILURES
+
+    if not write_rows(rows, args.format, args.output):
+        return EXIT_FAILURES
+    print(f"{len(frame)} rows of {report_name} analyzed", file=sys.stderr)
+    for file_name in frame.skipped:
+        print(f"could not read {file_name}", file=sys.stderr)
+    return EXIT_FAILURES if frame.skipped else EXIT_OK
@@ -0,0 +1,376 @@
+import argparse
+import csv
+import json
+import os
+import sys
+from abc import ABC, abstractmethod
+from datetime import date as date_type, datetime, timedelta
+import business
+from exceptions import BusinessLogicException, DalException
+import validation
+
+"""
+This module contains the non-interactive command line, for cron jobs and pipelines: every lookup is described by the
+arguments, nothing is asked, and the exit code says whether everything worked. All lookups run in one process, through
+the same batch fetch (shared HTTP session, db connections and caches) as any other batch.
+
+    python main.py --report domain site --agency all --date yesterday --format csv --output out.csv
+
+Methods:
+--------
+    build_parser() -> argparse.ArgumentParser:
+        Builds the argument parser of the batch command
+    parse_date(value: str) -> str:
+        Converts a date argument ('today', 'yesterday' or YYYY-MM-DD) into a YYYY-MM-DD string
+    resolve_names(values: list, options: list, kind: str) -> list:
+        Maps report / agency arguments (case insensitive, 'all' for every option) to their canonical names
+    positive_int(value: str) -> int:
+        Converts an argument that must be at least 1 (e.g. --workers) into an int
+    non_negative_int(value: str) -> int:
+        Converts an argument that must be at least 0 (e.g. --budget) into an int
+    resolve_end_date(date: str, end_date: str = None) -> str:
+        Returns the last date of a --date / --end-date window, checking it isn't before the first
+    write_rows(rows, format_name: str, output: str) -> bool:
+        Writes result rows (e.g. aggregates) to an output file or stdout, in one of the ROW_WRITERS formats
+    discard_stdout():
+        Points stdout at the null device once its reader has gone away (e.g. piped into head)
+    write_results(results: list, writer) -> int:
+        Writes the records of every successful lookup, returns the number of lookups that failed
+    main(argv=None) -> int:
+        Runs the batch command and returns its exit code
+
+Classes:
+--------
+    RecordWriter(ABC):
+        Abstract class representing an output format
+    JsonLinesWriter(RecordWriter):
+        One JSON object per record, per line
+    JsonWriter(RecordWriter):
+        A single JSON array of every record
+    CsvWriter(RecordWriter):
+        CSV with a header row (the columns of the first record)
+    SummaryWriter(RecordWriter):
+        One tab separated line per lookup (status, key, file name, error) instead of the records
+
+Constants:
+----------
+    EXIT_OK: exit code when every lookup succeeded
+    EXIT_FAILURES: exit code when at least one lookup failed
+    EXIT_USAGE: exit code for invalid arguments (argparse's own)
+    WRITERS: dict of output format name -> RecordWriter class
+    ROW_WRITERS: the WRITERS that can write plain result rows (the commands that print aggregates use these)
+"""
+
+EXIT_OK = 0
+EXIT_FAILURES = 1
+EXIT_USAGE = 2
+
+
+class RecordWriter(ABC):
+    writes_records = True
+
+    def __init__(self, out):
+        self.out = out
+
+    @abstractmethod
+    def write(self, result: dict, record: dict):
+        pass
+
+    def write_result(self, result: dict):
+        """
+        Called once per lookup, after its records (if any) have been written
+        :param result: the lookup's result dict (see business.fetch_job)
+        :return: n/a
+        """
+        pass
+
+    def close(self):
+        """
+        Finishes the output
+        :return: n/a
+        """
+        pass
+
+
+class JsonLinesWriter(RecordWriter):
+    def write(self, result: dict, record: dict):
+        self.out.write(json.dumps(record, ensure_ascii=False))
+        self.out.write('\n')
+
+
+class JsonWriter(RecordWriter):
+    def __init__(self, out):
+        super().__init__(out)
+        self.first = True
+        self.out.write('[')
+
+    def write(self, result: dict, record: dict):
+        self.out.write('\n' if self.first else ',\n')
+        self.out.write(json.dumps(record, ensure_ascii=False))
+        self.first = False
+
+    def close(self):
+        self.out.write('\n]\n' if not self.first else ']\n')
+
+
+class CsvWriter(RecordWriter):
+    def __init__(self, out):
+        super().__init__(out)
+        self.writer = None
+
+    def write(self, result: dict, record: dict):
+        if self.writer is None:  # the first record decides the columns, fields other reports add are dropped
+            self.writer = csv.DictWriter(self.out, fieldnames=list(record), extrasaction='ignore', restval='')
+            self.writer.writeheader()
+        self.writer.writerow(record)
+
+
+class SummaryWriter(RecordWriter):
+    writes_records = False
+
+    def write(self, result: dict, record: dict):
+        pass
+
+    def write_result(self, result: dict):
+        self.out.write('\t'.join(f"{result.get(field) or ''}" for field in
+                                 ('status', 'report_name', 'agency_name', 'date', 'file_name', 'error')))
+        self.out.write('\n')
+
+
+WRITERS = {'jsonl': JsonLinesWriter, 'json': JsonWriter, 'csv': CsvWriter, 'summary': SummaryWriter}
+ROW_WRITERS = {'csv': CsvWriter, 'jsonl': JsonLinesWriter, 'json': JsonWriter}
+
+
+def parse_date(value: str) -> str:
+    """
+    Converts a date argument into a YYYY-MM-DD string
+    :param value: 'today', 'yesterday' or a YYYY-MM-DD date (not in the future)
+    :return: the date as YYYY-MM-DD
+    """
+    if value.lower() == 'today':
+        return f"{date_type.today()}"
+    if value.lower() == 'yesterday':
+        return f"{date_type.today() - timedelta(days=1)}"
+    try:
+        day = datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a date in YYYY-MM-DD format")
+    if day > date_type.today():
+        raise argparse.ArgumentTypeError(f"{value} is in the future")
+    return f"{day}"
+
+
+def resolve_names(values: list, options: list, kind: str) -> list:
+    """
+    Maps report / agency arguments to their canonical names: matching is case insensitive, spaces may be used instead of
+        hyphens (like the interactive prompts), and 'all' stands for every option
+    :param values: the names given on the command line
+    :param options: the valid names (validation.REPORTS_LIST or validation.AGENCY_LIST)
+    :param kind: 'report' or 'agency', for error messages
+    :return: list of canonical names, without duplicates
+    """
+    by_key = {option.upper().replace('-', ' '): option for option in options}
+    names = []
+    for value in values:
+        if value.lower() == 'all':
+            matches = options
+        elif value.upper().replace('-', ' ') in by_key:
+            matches = [by_key[value.upper().replace('-', ' ')]]
+        else:
+            raise argparse.ArgumentTypeError(f"{value} is not a valid {kind} name")
+        names.extend(name for name in matches if name not in names)
+    return names
+
+
+def positive_int(value: str) -> int:
+    """
+    Converts an argument that must be at least 1 (e.g. --workers) into an int
+    :param value: the argument
+    :return: the int
+    """
+    return _bounded_int(value, 1)
+
+
+def non_negative_int(value: str) -> int:
+    """
+    Converts an argument that must be at least 0 (e.g. --budget, where 0 means no limit) into an int
+    :param value: the argument
+    :return: the int
+    """
+    return _bounded_int(value, 0)
+
+
+def _bounded_int(value: str, minimum: int) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a whole number")
+    if number < minimum:
+        raise argparse.ArgumentTypeError(f"{value} is less than {minimum}")
+    return number
+
+
+def resolve_end_date(date: str, end_date: str = None) -> str:
+    """
+    Returns the last date of a --date / --end-date window
+    :param date: the first date, YYYY-MM-DD
+    :param end_date: (optional) the last date, YYYY-MM-DD, defaults to date
+    :return: the last date
+    """
+    end_date = end_date or date
+    if end_date < date:
+        raise argparse.ArgumentTypeError("--end-date is before --date")
+    return end_date
+
+
+def write_rows(rows, format_name: str, output: str) -> bool:
+    """
+    Writes result rows (e.g. aggregates) to an output file or stdout, printing an error if it can't be written. A
+        reader of stdout that stops reading (e.g. piped into head) isn't an error: the rest of the rows are dropped.
+    :param rows: iterable of dicts
+    :param format_name: one of ROW_WRITERS
+    :param output: the output file, '-' for stdout
+    :return: true if every row was written (or the reader of stdout stopped reading)
+    """
+    out = None
+    try:
+        out = sys.stdout if output == '-' else open(output, 'w', newline='', encoding='utf-8')
+        writer = ROW_WRITERS[format_name](out)
+        for row in rows:
+            writer.write(None, row)
+        writer.close()
+        return True
+    except BrokenPipeError:
+        if out is not sys.stdout:
+            print(f"error: could not write output: {output} was closed", file=sys.stderr)
+            return False
+        discard_stdout()
+        return True
+    except OSError as e:
+        print(f"error: could not write output: {e}", file=sys.stderr)
+        return False
+    finally:
+        if out is not None and out is not sys.stdout:
+            out.close()
+
+
+def discard_stdout():
+    """
+    Points stdout at the null device once its reader has gone away (e.g. piped into head), so nothing written to it
+        afterwards, not even the interpreter's flush at exit, fails with a broken pipe
+    :return: n/a
+    """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Builds the argument parser of the batch command
+    :return: the parser
+    """
+    parser = argparse.ArgumentParser(prog='main.py', description="Fetch (or read from the cache) DAP reports without "
+                                     "any prompts. Run without arguments for the interactive program.")
+    parser.add_argument('-r', '--report', nargs='+', required=True, metavar='REPORT',
+                        help="report name(s), or 'all'")
+    parser.add_argument('-a', '--agency', nargs='+', required=True, metavar='AGENCY',
+                        help="agency name(s), or 'all'")
+    parser.add_argument('-d', '--date', required=True, type=parse_date,
+                        help="date (YYYY-MM-DD, 'today' or 'yesterday'), the first date of the range with --end-date")
+    parser.add_argument('-e', '--end-date', type=parse_date, help="last date of the range (inclusive)")
+    parser.add_argument('-f', '--format', choices=list(WRITERS), default='jsonl',
+                        help="output format (default: jsonl), 'summary' prints one status line per lookup")
+    parser.add_argument('-o', '--output', default='-', help="output file (default: - for stdout)")
+    parser.add_argument('--refresh', action='store_true',
+                        help="first re-fetch the requested dates that were cached before their data was complete")
+    parser.add_argument('--workers', type=positive_int,
+                        help="max concurrent fetches (default: [BATCH] max_workers in config.ini, or 8)")
+    return parser
+
+
+def write_results(results: list, writer: RecordWriter) -> int:
+    """
+    Writes the records of every successful lookup (in report, agency, date order), then its result
+    :param results: result dicts of the lookups (see business.fetch_job)
+    :param writer: the RecordWriter to write to
+    :return: the number of lookups that failed (including ones whose file could not be read)
+    """
+    failures = 0
+    for result in sorted(results, key=lambda r: (r.get('report_name') or '', r.get('agency_name') or '',
+                                                 r.get('date') or '')):
+        if result['status'] == business.STATUS_ERROR:
+            failures += 1
+        elif writer.writes_records:
+            try:
+                for record in business.read_records(result['file_name'], result['date']):
+                    writer.write(result, record)
+            except DalException as dal_err:
+                result.update(status=business.STATUS_ERROR, error=f"{dal_err}")
+                failures += 1
+        writer.write_result(result)
+    return failures
+
+
+def main(argv=None) -> int:
+    """
+    Runs the batch command and returns its exit code: EXIT_OK if every lookup succeeded, EXIT_FAILURES if any failed
+        (the others are still written), EXIT_USAGE for invalid arguments
+    :param argv: the arguments (defaults to sys.argv[1:])
+    :return: the exit code
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        report_names = resolve_names(args.report, validation.REPORTS_LIST, 'report')
+        agency_names = resolve_names(args.agency, validation.AGENCY_LIST, 'agency')
+        end_date = resolve_end_date(args.date, args.end_date)
+    except argparse.ArgumentTypeError as e:
+        parser.print_usage(sys.stderr)
+        print(f"{parser.prog}: error: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    failures = 0
+    try:
+        business.prepare_database()
+        if args.refresh:
+            for result in business.refresh_stale(args.date, end_date, report_names, agency_names, args.workers):
+                if result['status'] == business.STATUS_ERROR:
+                    failures += 1
+                    print(f"refresh failed: {result['report_name']}/{result['agency_name']}/{result['date']}: "
+                          f"{result['error']}", file=sys.stderr)
+        jobs = business.build_jobs(report_names, agency_names, args.date, end_date)
+        results = list(business.fetch_many(jobs, max_workers=args.workers))
+    except BusinessLogicException as e:
+        print(f"error: {e}", file=sys.stderr)
+        return EXIT_FAILURES
+
+    out = None
+    try:
+        out = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+        writer = WRITERS[args.format](out)
+        failures += write_results(results, writer)
+        writer.close()
+    except BrokenPipeError:
+        if out is not sys.stdout:
+            print(f"error: could not write output: {args.output} was closed", file=sys.stderr)
+            return EXIT_FAILURES
+        discard_stdout()  # the reader stopped reading, e.g. piped into head: the rest of the records are dropped
+        failures += sum(1 for result in results if result['status'] == business.STATUS_ERROR)
+    except OSError as e:
+        print(f"error: could not write output: {e}", file=sys.stderr)
+        return EXIT_FAILURES
+    finally:
+        if out is not None and out is not sys.stdout:
+            out.close()
+
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    print(f"{len(results)} lookups: " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())),
+          file=sys.stderr)
+    for result in results:
+        if result['status'] == business.STATUS_ERROR and args.format != 'summary':
+            print(f"failed: {result.get('report_name')}/{result.get('agency_name')}/{result.get('date')}: "
+                  f"{result['error']}", file=sys.stderr)
+    return EXIT_FAILURES if failures else EXIT_OK
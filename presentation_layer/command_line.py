@@ -1,9 +1,12 @@
 import business
-from exceptions import BusinessLogicException
+from exceptions import BusinessLogicException, DalException
 import validation
 
 """
 This module contains methods to retrieve input from the user and display data to the user via the command line. 
+The interactive session is a loop over a small state machine (query -> restart check -> query ... -> exit), so each
+result is released before the next query and a long session never grows the stack; the process (and its db
+connection, HTTP session and caches) stays warm the whole time.
 
 Methods:
 --------
@@ -21,18 +24,35 @@ Methods:
     on_error(error_message=None):
         Prints a message to the console upon encountering an error.
     display_results(data_list):
-        Takes a list (data_list), and prints that list line-by-line to the console.
-    restart_program_check():
+        Takes a list or other iterable (data_list), and prints it line-by-line to the console.
+    restart_program_check() -> bool:
         Checks if the user would like to restart the program
     list_options(which_option):
         Displays a list of either all the report options, or all the agency options, so the user knows what they can search
     print_by_four(list):
         Takes a list and prints it four items at a time
+    run_query() -> str:
+        Asks for one report/agency/date and shows its data, returns the next session state
     run():
         This is the function to call in main to start the program.
 
+Classes:
+--------
+    ConsolePresenter(business.Presenter):
+        Shows the results of business.check_current_files with on_new_data / on_old_data / on_error
+
+Constants:
+----------
+    STATE_QUERY: session state, ask for the next search
+    STATE_RESTART: session state, ask if the user wants to search again
+    STATE_EXIT: session state, the session is over
+
 """
 
+STATE_QUERY = 'query'
+STATE_RESTART = 'restart'
+STATE_EXIT = 'exit'
+
 
 def get_report_name() -> str:
     """
@@ -92,9 +112,7 @@ def on_new_data(file_name=None, data_list=None):
         print(f"Data retrieved, response saved to: {file_name} ")
         # check if user wants to print results
         user_response = validation.get_yes_or_no("Would you like to print the data? :  ")
-        if user_response == "NO":
-            restart_program_check()
-        elif user_response == "YES":
+        if user_response == "YES":
             display_results(data_list)
 
 
@@ -107,47 +125,60 @@ def on_old_data(file_name, data_list):
     """
     print(f"This data has been retrieved before, it exists in file: {file_name}")
     user_response = validation.get_yes_or_no("Would you like to print the data? :  ")
-    if user_response == "NO":
-        restart_program_check()
-    elif user_response == "YES":
+    if user_response == "YES":
         display_results(data_list)
 
+
 def on_error(error_message=None):
     """
     Prints a message to the console upon encountering an error.
     :param error_message: (optional) error message
-    :return: n/a, calls restart_program_check()
+    :return: n/a
     """
     print("Sorry, an error was encountered.")
     if error_message != None:
         print(error_message)
-    restart_program_check()
 
 
+class ConsolePresenter(business.Presenter):
+    def on_new_data(self, file_name=None, data_list=None):
+        return on_new_data(file_name, data_list)
+
+    def on_old_data(self, file_name, data_list):
+        return on_old_data(file_name, data_list)
+
+    def on_error(self, error_message=None):
+        return on_error(error_message)
+
 
 def display_results(data_list):
     """
-    Takes a list (data_list), and prints that list line-by-line to the console.
-    :param data_list: list of data to print
-    :return: n/a, calls restart_program_check()
+    Takes a list or other iterable (data_list), and prints it line-by-line to the console. Lines are printed as they are
+        read, so a lazily read file shows its first line straight away.
+    :param data_list: list (or iterable) of data to print
+    :return: n/a
     """
-    if len(data_list) == 0:
+    printed = 0
+    try:
+        for line in data_list:
+            print(f"{line}")
+            printed += 1
+    except DalException as dal_err:
+        print(f"Sorry, could not finish reading the data: {dal_err}")
+    if printed == 0:
         print("Looks like there was no data.")
-    for line in data_list:
-        print(f"{line}")
-    restart_program_check()
 
 
-def restart_program_check():
+def restart_program_check() -> bool:
     """
     Checks if the user would like to restart the program
-    :return: n/a
+    :return: true to search again, false to quit
     """
     user_response = validation.get_yes_or_no("Would you like to restart the program? :  ")
     if user_response == "NO":
         print("Bye!")
-    elif user_response == "YES":
-        run()
+        return False
+    return True
 
 
 def list_options(which_option):
@@ -179,10 +210,11 @@ def print_by_four(list: list):
     print()  # for a newline
 
 
-def run():
+def run_query() -> str:
     """
-    This is the function to call in main to start the program.
-    :return: calls either business.check_current_files(), or on_error()
+    Asks for one report/agency/date and shows its data (via business.check_current_files). Everything the query
+        touched is released when this returns.
+    :return: the next session state, STATE_RESTART, or STATE_EXIT if the user entered 'exit'
     """
     report_name = get_report_name()
     if report_name == "LIST":
@@ -190,16 +222,33 @@ def run():
         report_name = get_report_name()
     if report_name == "EXIT":
         print('bye')
-        exit()
+        return STATE_EXIT
     agency_name = get_agency_name()
     if agency_name == "LIST":
         list_options('agency')
         agency_name = get_agency_name()
     if agency_name == "EXIT":
         print('bye')
-        exit()
+        return STATE_EXIT
     date = get_date(report_name, agency_name)
     try:
-        return business.check_current_files(report_name, agency_name, date)
+        business.check_current_files(report_name, agency_name, date)
     except BusinessLogicException:
-        return on_error()
+        on_error()
+    return STATE_RESTART
+
+
+def run():
+    """
+    This is the function to call in main to start the program. Runs the interactive session until the user quits.
+    :return: n/a
+    """
+    state = STATE_QUERY
+    while state != STATE_EXIT:
+        if state == STATE_QUERY:
+            state = run_query()
+        elif state == STATE_RESTART:
+            state = STATE_QUERY if restart_program_check() else STATE_EXIT
+
+
+business.set_presenter(ConsolePresenter())
@@ -0,0 +1,229 @@
+import argparse
+import json
+import re
+import sys
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import config
+import business
+import dal
+from exceptions import BusinessLogicException, DalException
+from logging_config import get_logger
+import validation
+
+"""
+This module contains the http query service, so other tools can read reports from this cache over http instead of
+running their own copy of the program. It is built on the standard library's ThreadingHTTPServer (one thread per
+connection), and answers:
+
+    GET /reports/{report}/agencies/{agency}?date=YYYY-MM-DD[&offset=N][&limit=N][&format=jsonl|json]
+        The report's records, streamed (chunked) as JSON Lines (default) or a JSON array. Keys that aren't cached yet
+        are fetched first, and concurrent requests missing on the same key share one upstream fetch. The X-Cache
+        response header says whether the data was 'cached' or 'fetched'.
+    GET /stats
+        Request, cache and fetch coalescing counters, as JSON
+
+Methods:
+--------
+    parse_date(value: str) -> str:
+        Validates a YYYY-MM-DD date that isn't in the future
+    serve(host: str = None, port: int = None):
+        Runs the service until interrupted
+    main(argv=None) -> int:
+        Parses --host / --port and runs the service
+
+Classes:
+--------
+    QueryServer(ThreadingHTTPServer):
+        The threaded server (daemon threads, so a stuck client never blocks shutdown)
+    QueryRequestHandler(BaseHTTPRequestHandler):
+        Routes and answers requests
+
+Constants:
+----------
+    REPORT_PATH: regex matching /reports/{report}/agencies/{agency}
+    CHUNK_SIZE: bytes of output collected before a chunk is sent
+"""
+
+logger = get_logger(__name__)
+
+REPORT_PATH = re.compile(r'^/reports/(?P<report>[^/]+)/agencies/(?P<agency>[^/]+)/?$')
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_date(value: str) -> str:
+    """
+    Validates a YYYY-MM-DD date that isn't in the future
+    :param value: the date
+    :return: the date, or None if it isn't valid
+    """
+    try:
+        day = datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+    return value if day <= datetime.today() else None
+
+
+class QueryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # needed for chunked responses and keep-alive
+    server_version = 'OpenDataQueryService/1.0'
+
+    def log_message(self, format, *args):
+        logger.info("%s " + format, self.address_string(), *args)
+
+    def do_GET(self):
+        """
+        Routes a GET request
+        :return: n/a
+        """
+        url = urlsplit(self.path)
+        if url.path == '/stats':
+            return self.send_json(200, {'requests': dal.get_request_stats(), 'cache': business.get_cache_stats(),
+                                        'fetches': business.FETCHES.stats()})
+        match = REPORT_PATH.match(url.path)
+        if match is None:
+            return self.send_json(404, {'error': f"No such resource {url.path}"})
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        return self.get_report(match.group('report'), match.group('agency'), query)
+
+    def get_report(self, report_name: str, agency_name: str, query: dict):
+        """
+        Answers GET /reports/{report}/agencies/{agency}: validates the request, looks the key up (fetching it if
+            needed) and streams its records
+        :param report_name: report name from the path
+        :param agency_name: agency name from the path
+        :param query: dict of query string params
+        :return: n/a
+        """
+        if report_name not in validation.REPORTS_LIST:
+            return self.send_json(404, {'error': f"{report_name} is not a valid report name"})
+        if agency_name not in validation.AGENCY_LIST:
+            return self.send_json(404, {'error': f"{agency_name} is not a valid agency name"})
+        date = parse_date(query.get('date'))
+        if date is None:
+            return self.send_json(400, {'error': "date must be a YYYY-MM-DD date that isn't in the future"})
+        output_format = query.get('format', 'jsonl')
+        if output_format not in ('jsonl', 'json'):
+            return self.send_json(400, {'error': "format must be 'jsonl' or 'json'"})
+        try:
+            offset = int(query.get('offset', 0))
+            limit = int(query['limit']) if 'limit' in query else None
+            if offset < 0 or (limit is not None and limit < 0):
+                raise ValueError
+        except ValueError:
+            return self.send_json(400, {'error': "offset and limit must be non-negative integers"})
+        try:
+            file_name, fetched = business.lookup(report_name, agency_name, date)
+            records = business.read_records(file_name, date, offset, limit)
+        except (BusinessLogicException, DalException) as e:
+            logger.error("Lookup of %s/%s/%s failed: %s", report_name, agency_name, date, e)
+            return self.send_json(502, {'error': f"Could not get {report_name}/{agency_name}/{date} {e}".strip()})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson' if output_format == 'jsonl' else 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('X-Cache', 'fetched' if fetched else 'cached')
+        self.end_headers()
+        self.stream_records(records, output_format)
+
+    def stream_records(self, records, output_format: str):
+        """
+        Streams records as chunks of JSON Lines or of a JSON array, as they are read. A read error mid-stream can't
+            change the (already sent) status, so the connection is closed without the final chunk and the client sees
+            a truncated response instead of a complete-looking one.
+        :param records: iterable of records
+        :param output_format: 'jsonl' or 'json'
+        :return: n/a
+        """
+        buffer = ['['] if output_format == 'json' else []
+        size = 0
+        first = True
+        try:
+            for record in records:
+                line = json.dumps(record, ensure_ascii=False)
+                if output_format == 'json':
+                    line = line if first else ',' + line
+                    first = False
+                else:
+                    line += '\n'
+                buffer.append(line)
+                size += len(line)
+                if size >= CHUNK_SIZE:
+                    self.send_chunk(''.join(buffer))
+                    buffer, size = [], 0
+        except DalException as e:
+            logger.error("Aborting response, could not read records: %s", e)
+            self.close_connection = True
+            return
+        if output_format == 'json':
+            buffer.append(']\n')
+        self.send_chunk(''.join(buffer))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_chunk(self, text: str):
+        """
+        Sends one chunk of a chunked response
+        :param text: the chunk's text (nothing is sent if it is empty, an empty chunk ends the response)
+        :return: n/a
+        """
+        data = text.encode('utf-8')
+        if data:
+            self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b'\r\n')
+
+    def send_json(self, status: int, body: dict):
+        """
+        Sends a small JSON response
+        :param status: the response code
+        :param body: the JSON body
+        :return: n/a
+        """
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', f"{len(data)}")
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(host: str = None, port: int = None):
+    """
+    Runs the service until interrupted (ctrl+c)
+    :param host: address to listen on (defaults to SERVER_HOST)
+    :param port: port to listen on, 0 picks a free one (defaults to SERVER_PORT)
+    :return: n/a
+    """
+    host = config.SERVER_HOST if host is None else host
+    port = config.SERVER_PORT if port is None else port
+    server = QueryServer((host, port), QueryRequestHandler)
+    print(f"Serving reports on http://{server.server_address[0]}:{server.server_address[1]} (ctrl+c to stop)")
+    logger.info("Query service listening on %s", server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info("Query service stopped")
+
+
+def main(argv=None) -> int:
+    """
+    Parses --host / --port and runs the service
+    :param argv: the arguments after 'serve'
+    :return: exit code
+    """
+    parser = argparse.ArgumentParser(prog='main.py serve', description="Serve cached DAP reports over http")
+    parser.add_argument('--host', help="address to listen on (default: [SERVER] host in config.ini, or 127.0.0.1)")
+    parser.add_argument('--port', type=int, help="port to listen on (default: [SERVER] port in config.ini, or 8080)")
+    args = parser.parse_args(argv)
+    try:
+        business.prepare_database()
+    except BusinessLogicException as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    serve(args.host, args.port)
+    return 0
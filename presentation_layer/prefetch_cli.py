@@ -0,0 +1,106 @@
+import argparse
+import sys
+import business
+from exceptions import BusinessLogicException
+import validation
+from .batch_cli import parse_date, resolve_names, resolve_end_date, positive_int, non_negative_int, discard_stdout, \
+    EXIT_OK, EXIT_FAILURES, EXIT_USAGE
+
+"""
+This module contains the prefetch command, which warms the cache for a date window by fetching every report x agency x
+date key that isn't cached yet (see business/prefetch.py). It prints one tab separated line per job: with --dry-run the
+plan (nothing is fetched), otherwise each job's status as it finishes.
+
+    python main.py prefetch --date 2024-01-01 --end-date yesterday --budget 500 --dry-run
+
+Methods:
+--------
+    build_parser() -> argparse.ArgumentParser:
+        Builds the argument parser of the prefetch command
+    format_job(job: dict) -> str:
+        Formats a job (or a job's result) as one tab separated line
+    main(argv=None) -> int:
+        Runs the prefetch command and returns its exit code
+"""
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Builds the argument parser of the prefetch command
+    :return: the parser
+    """
+    parser = argparse.ArgumentParser(prog='main.py prefetch', description="Fetch every report/agency/date of a date "
+                                     "window that isn't cached yet, hottest first, within a request budget. Re-run "
+                                     "the same command to resume an interrupted run.")
+    parser.add_argument('-r', '--report', nargs='+', default=['all'], metavar='REPORT',
+                        help="report name(s), or 'all' (default)")
+    parser.add_argument('-a', '--agency', nargs='+', default=['all'], metavar='AGENCY',
+                        help="agency name(s), or 'all' (default)")
+    parser.add_argument('-d', '--date', required=True, type=parse_date,
+                        help="first date of the window (YYYY-MM-DD, 'today' or 'yesterday')")
+    parser.add_argument('-e', '--end-date', type=parse_date, help="last date of the window (default: --date)")
+    parser.add_argument('--budget', type=non_negative_int,
+                        help="max api requests, 0 for no limit (default: [PREFETCH] max_requests in config.ini, or 0)")
+    parser.add_argument('--workers', type=positive_int,
+                        help="max concurrent fetches (default: [BATCH] max_workers in config.ini, or 8)")
+    parser.add_argument('--state-file',
+                        help="progress file used to resume (default: [PREFETCH] state_path in config.ini, or "
+                             "database/prefetch_state.json)")
+    parser.add_argument('--dry-run', action='store_true', help="print the plan without fetching anything")
+    return parser
+
+
+def format_job(job: dict) -> str:
+    """
+    Formats a job (or a job's result) as one tab separated line
+    :param job: job or result dict (see business.plan_prefetch / business.run_prefetch)
+    :return: the line
+    """
+    return '\t'.join(f"{value or ''}" for value in
+                     (job.get('status', 'planned'), job['report_name'], job['agency_name'], job['dates'][0],
+                      job['dates'][-1], len(job['dates']), 'retry' if job['retry'] else '', job.get('error')))
+
+
+def main(argv=None) -> int:
+    """
+    Runs the prefetch command and returns its exit code: EXIT_OK if every job succeeded (or was planned), EXIT_FAILURES
+        if any failed or was deferred by the budget, EXIT_USAGE for invalid arguments
+    :param argv: the arguments after 'prefetch'
+    :return: the exit code
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        report_names = resolve_names(args.report, validation.REPORTS_LIST, 'report')
+        agency_names = resolve_names(args.agency, validation.AGENCY_LIST, 'agency')
+        end_date = resolve_end_date(args.date, args.end_date)
+    except argparse.ArgumentTypeError as e:
+        parser.print_usage(sys.stderr)
+        print(f"{parser.prog}: error: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    try:
+        business.prepare_database()
+        plan = business.plan_prefetch(report_names, agency_names, args.date, end_date, args.state_file)
+        if args.dry_run:
+            for job in plan['jobs']:
+                print(format_job(job))
+            print(f"{plan['missing']} missing keys in {len(plan['jobs'])} jobs (at least {len(plan['jobs'])} "
+                  f"requests)", file=sys.stderr)
+            return EXIT_OK
+        counts = {}
+        for result in business.run_prefetch(plan, args.budget, args.workers, args.state_file):
+            print(format_job(result), flush=True)
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+    except BusinessLogicException as e:
+        print(f"error: {e}", file=sys.stderr)
+        return EXIT_FAILURES
+    except BrokenPipeError:  # the reader stopped reading (e.g. piped into head), which stops the run like ctrl-c would
+        discard_stdout()
+        return EXIT_OK if args.dry_run else EXIT_FAILURES
+    except OSError as e:
+        print(f"error: could not write the prefetch state: {e}", file=sys.stderr)
+        return EXIT_FAILURES
+    print(f"{len(plan['jobs'])} jobs: " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())),
+          file=sys.stderr)
+    return EXIT_OK if set(counts) <= {business.STATUS_FETCHED} else EXIT_FAILURES
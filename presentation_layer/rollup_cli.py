@@ -0,0 +1,99 @@
+import argparse
+import sys
+import business
+from exceptions import BusinessLogicException
+import validation
+from .batch_cli import parse_date, resolve_names, positive_int, resolve_end_date, write_rows, ROW_WRITERS, EXIT_OK, \
+    EXIT_FAILURES, EXIT_USAGE
+
+"""
+This module contains the rollup command, which answers range queries from the precomputed rollups (see
+business/rollups.py) and rebuilds them from the cache:
+
+    python main.py rollup totals --report os --date 2024-01-01 --end-date 2024-01-31 --by agency
+    python main.py rollup top --report browser --date 2024-01-01 --end-date 2024-01-31 --limit 5
+    python main.py rollup rebuild --workers 8
+
+Methods:
+--------
+    build_parser() -> argparse.ArgumentParser:
+        Builds the argument parser of the rollup command
+    main(argv=None) -> int:
+        Runs the rollup command and returns its exit code
+"""
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Builds the argument parser of the rollup command
+    :return: the parser
+    """
+    parser = argparse.ArgumentParser(prog='main.py rollup', description="Query or rebuild the precomputed rollups.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rebuild = commands.add_parser('rebuild', help="recompute rollups from the cache files, in parallel")
+    rebuild.add_argument('-r', '--report', help="only this report")
+    rebuild.add_argument('-a', '--agency', help="only this agency")
+    rebuild.add_argument('--missing', action='store_true', help="only keys that have no rollups yet")
+    rebuild.add_argument('--workers', type=positive_int,
+                         help="worker processes (default: [BATCH] max_workers in config.ini, or 8)")
+
+    for name, description in (('totals', "record counts and metric totals of a date window"),
+                              ('top', "top values of a text field over a date window")):
+        query = commands.add_parser(name, help=description)
+        query.add_argument('-r', '--report', required=True, help="report name")
+        query.add_argument('-a', '--agency', nargs='+', default=['all'], metavar='AGENCY',
+                           help="agency name(s), or 'all' (default)")
+        query.add_argument('-d', '--date', required=True, type=parse_date,
+                           help="first date of the window (YYYY-MM-DD, 'today' or 'yesterday')")
+        query.add_argument('-e', '--end-date', type=parse_date, help="last date of the window (default: --date)")
+        query.add_argument('-f', '--format', choices=list(ROW_WRITERS), default='csv',
+                           help="output format (default: csv)")
+        query.add_argument('-o', '--output', default='-', help="output file (default: - for stdout)")
+        if name == 'totals':
+            query.add_argument('--by', nargs='*', choices=['agency', 'date'], default=['agency', 'date'],
+                               help="group by agency and/or date (default: both, none for a grand total)")
+        else:
+            query.add_argument('--field', help="text field (default: the report's main dimension)")
+            query.add_argument('--limit', type=positive_int, default=10, help="number of values (default: 10)")
+    return parser
+
+
+def main(argv=None) -> int:
+    """
+    Runs the rollup command and returns its exit code: EXIT_OK, EXIT_FAILURES if the query or (part of) the rebuild
+        failed, EXIT_USAGE for invalid arguments
+    :param argv: the arguments after 'rollup'
+    :return: the exit code
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'rebuild':
+            report_name = args.report and resolve_names([args.report], validation.REPORTS_LIST, 'report')[0]
+            agency_name = args.agency and resolve_names([args.agency], validation.AGENCY_LIST, 'agency')[0]
+        else:
+            report_name = resolve_names([args.report], validation.REPORTS_LIST, 'report')[0]
+            agency_names = resolve_names(args.agency, validation.AGENCY_LIST, 'agency')
+            end_date = resolve_end_date(args.date, args.end_date)
+    except argparse.ArgumentTypeError as e:
+        parser.print_usage(sys.stderr)
+        print(f"{parser.prog}: error: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    try:
+        business.prepare_database()
+        if args.command == 'rebuild':
+            counts = business.rebuild_rollups(report_name, agency_name, args.missing, args.workers)
+            print(f"rebuilt the rollups of {counts['rebuilt']} keys, {counts['failed']} failed", file=sys.stderr)
+            return EXIT_FAILURES if counts['failed'] else EXIT_OK
+        if args.command == 'totals':
+            rows = business.rollup_totals(report_name, args.date, end_date, agency_names, args.by)
+        else:
+            rows = business.rollup_top(report_name, args.date, end_date, args.field, agency_names, args.limit)
+    except BusinessLogicException as e:
+        print(f"error: {e}", file=sys.stderr)
+        return EXIT_FAILURES
+    if not write_rows(rows, args.format, args.output):
+        return EXIT_FAILURES
+    return EXIT_OK
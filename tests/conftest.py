@@ -0,0 +1,147 @@
+import json
+import os
+import sys
+import threading
+import time
+from datetime import date as date_type, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+"""
+Shared fixtures of the tests: every test session runs in an empty working directory with its own config.ini (so the
+search db, cache files and logs are throwaway), and api requests go to Upstream, a scripted stand-in for the DAP api on
+localhost.
+
+Fixtures:
+---------
+    work_dir: the session's working directory (autouse)
+    upstream: the stand-in api, reset for every test
+
+Constants:
+----------
+    CONFIG: the config.ini of the session (quick retries, a rate limit that never gets in the way)
+"""
+
+CONFIG = """
+[DATABASE]
+path = database/search_log.db
+
+[APIKEY]
+key = test-key
+page_size = 0
+
+[RATELIMIT]
+requests_per_second = 1000
+burst = 100
+
+[RETRY]
+max_attempts = 3
+backoff_base = 0.01
+backoff_max = 2
+"""
+
+
+class Upstream:
+    """
+    The stand-in api: answers GET /agencies/{agency}/reports/{report}/data with two records for every date of the
+        after/before window, unless a scripted response is queued (see respond_with)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = []
+        self.script = []
+        self.delay = 0.0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.build_handler())
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset(self):
+        with self._lock:
+            self.calls, self.script, self.delay = [], [], 0.0
+
+    def respond_with(self, *responses):
+        """
+        Queues responses for the next calls, each a (status, headers) tuple; the calls after them are answered as usual
+        """
+        with self._lock:
+            self.script.extend(responses)
+
+    def next_response(self, path: str, query: dict):
+        with self._lock:
+            self.calls.append((path, query))
+            return self.script.pop(0) if self.script else (200, {})
+
+    def build_handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                status, headers = upstream.next_response(url.path, query)
+                time.sleep(upstream.delay)
+                body = b''
+                if status == 200:
+                    parts = url.path.strip('/').split('/')
+                    agency_name, report_name = parts[-4], parts[-2]
+                    body = json.dumps(records_between(report_name, agency_name, query['after'],
+                                                      query['before'])).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', f"{len(body)}")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def records_between(report_name: str, agency_name: str, after: str, before: str) -> list:
+    """
+    The records Upstream answers with: two per date of the window, newest first like the api
+    """
+    first, last = date_type.fromisoformat(after), date_type.fromisoformat(before)
+    records = []
+    for offset in range((last - first).days, -1, -1):
+        for number, name in enumerate(('Linux', 'Windows')):
+            records.append({'date': f"{first + timedelta(days=offset)}", 'report_name': report_name,
+                            'report_agency': agency_name, report_name: name, 'visits': number + 1})
+    return records
+
+
+@pytest.fixture(scope='session', autouse=True)
+def work_dir(tmp_path_factory):
+    path = tmp_path_factory.mktemp('work')
+    (path / 'config.ini').write_text(CONFIG)
+    previous = os.getcwd()
+    os.chdir(path)
+    yield path
+    os.chdir(previous)
+
+
+@pytest.fixture(scope='session')
+def _upstream_server(work_dir):
+    import dal
+    upstream = Upstream()
+    dal.OpenDataAPIAdapter.BASE_URL = upstream.base_url
+    yield upstream
+    dal.OpenDataAPIAdapter.BASE_URL = None
+    upstream.server.shutdown()
+    upstream.server.server_close()
+
+
+@pytest.fixture
+def upstream(_upstream_server):
+    _upstream_server.reset()
+    return _upstream_server
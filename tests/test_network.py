@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import requests
+import business
+import dal
+from exceptions import DalException
+from presentation_layer.http_server import QueryServer, QueryRequestHandler
+
+"""
+Tests of the network paths: retries of the api client (dal.make_request) against the stand-in api, request coalescing
+(business.SingleFlight), and the answers of the http query service.
+"""
+
+
+def get_once(date: str):
+    response = dal.make_request('os', 'justice', business.build_date_params(date))
+    try:
+        return response.status_code, response.json()
+    finally:
+        response.close()
+
+
+def test_transient_errors_are_retried(upstream):
+    upstream.respond_with((503, {}), (500, {}))
+    retries = dal.get_request_stats()['retries']
+    status, records = get_once('2024-01-01')
+    assert status == 200
+    assert {record['date'] for record in records} == {'2024-01-01'}
+    assert len(upstream.calls) == 3
+    assert dal.get_request_stats()['retries'] == retries + 2
+
+
+def test_retry_after_is_honored(upstream):
+    upstream.respond_with((429, {'Retry-After': '1'}))
+    start = time.monotonic()
+    status, _ = get_once('2024-01-01')
+    assert status == 200
+    assert len(upstream.calls) == 2
+    assert time.monotonic() - start >= 0.9
+
+
+def test_gives_up_after_max_attempts(upstream):
+    upstream.respond_with(*[(503, {})] * 3)
+    give_ups = dal.get_request_stats()['give_ups']
+    with pytest.raises(DalException):
+        get_once('2024-01-01')
+    assert len(upstream.calls) == 3
+    assert dal.get_request_stats()['give_ups'] == give_ups + 1
+
+
+def test_client_errors_are_not_retried(upstream):
+    upstream.respond_with((404, {}))
+    with pytest.raises(DalException):
+        get_once('2024-01-01')
+    assert len(upstream.calls) == 1
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = business.SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        release.wait(5)
+        return 'result'
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(flight.do, 'key', work) for _ in range(8)]
+        deadline = time.monotonic() + 5
+        while flight.stats()['shared'] < 7 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        results = [future.result(5) for future in futures]
+    assert results == ['result'] * 8
+    assert len(calls) == 1
+    assert flight.stats()['calls'] == 1 and flight.stats()['shared'] == 7
+    assert flight.in_flight() == 0
+
+
+def test_single_flight_shares_errors_and_forgets_finished_calls():
+    flight = business.SingleFlight()
+
+    def fail():
+        raise ValueError('upstream down')
+
+    with pytest.raises(ValueError):
+        flight.do('key', fail)
+    assert flight.do('key', lambda: 'fresh') == 'fresh'
+    assert flight.stats()['calls'] == 2
+
+
+@pytest.fixture(scope='module')
+def service():
+    server = QueryServer(('127.0.0.1', 0), QueryRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_service_streams_records(service, upstream):
+    response = requests.get(f"{service}/reports/os/agencies/justice", params={'date': '2024-02-01'})
+    assert response.status_code == 200
+    assert response.headers['X-Cache'] == 'fetched'
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert [record['os'] for record in records] == ['Linux', 'Windows']
+
+    response = requests.get(f"{service}/reports/os/agencies/justice",
+                            params={'date': '2024-02-01', 'format': 'json', 'offset': 1})
+    assert response.status_code == 200
+    assert response.headers['X-Cache'] == 'cached'
+    assert [record['os'] for record in response.json()] == ['Windows']
+    assert len(upstream.calls) == 1
+
+
+def test_service_coalesces_concurrent_misses(service, upstream):
+    upstream.delay = 0.3
+    url = f"{service}/reports/os/agencies/justice"
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(lambda _: requests.get(url, params={'date': '2024-02-02'}), range(8)))
+    assert [response.status_code for response in responses] == [200] * 8
+    assert len({response.text for response in responses}) == 1
+    assert len(upstream.calls) == 1
+
+
+@pytest.mark.parametrize('params', [{'date': '2024-13-01'}, {}, {'date': '2999-01-01'},
+                                    {'date': '2024-02-01', 'limit': '-1'}, {'date': '2024-02-01', 'format': 'xml'}])
+def test_service_rejects_bad_requests(service, upstream, params):
+    response = requests.get(f"{service}/reports/os/agencies/justice", params=params)
+    assert response.status_code == 400
+    assert 'error' in response.json()
+    assert upstream.calls == []
+
+
+@pytest.mark.parametrize('path', ['/nothing', '/reports/nope/agencies/justice', '/reports/os/agencies/nope'])
+def test_service_answers_404(service, upstream, path):
+    response = requests.get(f"{service}{path}", params={'date': '2024-02-01'})
+    assert response.status_code == 404
+    assert 'error' in response.json()
+    assert upstream.calls == []
+
+
+def test_service_answers_502_when_the_api_fails(service, upstream):
+    upstream.respond_with((404, {}))
+    response = requests.get(f"{service}/reports/os/agencies/justice", params={'date': '2024-02-03'})
+    assert response.status_code == 502
+    assert '2024-02-03' in response.json()['error']
+    assert len(upstream.calls) == 1
+
+
+def test_service_stats(service):
+    response = requests.get(f"{service}/stats")
+    assert response.status_code == 200
+    assert set(response.json()) == {'requests', 'cache', 'fetches'}